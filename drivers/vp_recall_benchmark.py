@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Recall against latency of approximate similarity searches
+
+Builds a vantage point tree over timeseries made by tsmaker, runs the same
+queries with an exact search of the tree and with smaller and smaller
+budgets of distances, or an epsilon, and reports for each the recall@k
+(fraction of the k nearest returned, found by brute force over every
+timeseries), the mean latency and the mean number of distances computed.
+The curve is plotted if matplotlib is installed.
+
+    python drivers/vp_recall_benchmark.py -n 1000 -k 5 --plot recall.png
+"""
+import argparse
+import time
+import numpy as np
+import vptrees
+from procs._corr import tsmaker, stand, kernel_corr
+
+def kernel_dist(x, y):
+    "kernel correlation distance of two standardized timeseries, as in procs.corr"
+    return float(np.sqrt(max(0.0, 2*(1 - kernel_corr(x, y, 5)))))
+
+def make_series(n):
+    "n standardized timeseries with the parameters of go_client"
+    mus = np.random.uniform(low=0.0, high=1.0, size=n)
+    sigs = np.random.uniform(low=0.05, high=0.4, size=n)
+    jits = np.random.uniform(low=0.05, high=0.2, size=n)
+    series = []
+    for m, s, j in zip(mus, sigs, jits):
+        _, t = tsmaker(m, s, j)
+        series.append(stand(t, t.mean(), t.std()))
+    return series
+
+def run(tree, dist_arg, queries, exact, k, **budget):
+    "mean recall@k, latency in ms and distances computed of the queries with a budget"
+    recalls, times, distances = [], [], []
+    for query, wanted in zip(queries, exact):
+        start = time.perf_counter()
+        found = tree.knn(query, k, dist_arg, **budget)
+        times.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(set(pk for pk, _ in found) & wanted) / k)
+        distances.append(tree.last_search['distances'])
+    return np.mean(recalls), np.mean(times), np.mean(distances)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=1000, help='number of timeseries')
+    parser.add_argument('-k', type=int, default=5, help='number of neighbours')
+    parser.add_argument('--vps', type=int, default=20, help='number of vantage points')
+    parser.add_argument('--queries', type=int, default=50, help='number of queries')
+    parser.add_argument('--seed', type=int, default=207)
+    parser.add_argument('--plot', help='file to save the plot of recall against latency to')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    series = make_series(args.n)
+    pks = ['ts-{}'.format(i) for i in range(args.n)]
+    points = dict(zip(pks, series))
+    vps = [pks[i] for i in np.random.choice(args.n, size=args.vps, replace=False)]
+    dist = lambda vp, pks: [kernel_dist(points[vp], points[p]) for p in pks]
+    dist_arg = lambda pk, arg: kernel_dist(points[pk], arg)
+    tree = vptrees.VPTree(pks, vps, dist)
+
+    queries = make_series(args.queries)
+    # the ground truth does not depend on the tree, whose exact search is
+    # measured against it as the other settings
+    exact = [set(sorted(pks, key=lambda p: dist_arg(p, query))[:args.k]) for query in queries]
+
+    settings = [('exact tree', {})]
+    settings += [('epsilon={}'.format(e), {'epsilon': e}) for e in (0.1, 0.25, 0.5)]
+    settings += [('max_distances={}'.format(m), {'max_distances': m})
+                 for m in sorted(set(max(args.k, int(args.n * f)) for f in (0.5, 0.25, 0.1, 0.05, 0.02)),
+                                 reverse=True)]
+    print("{:>20} {:>10} {:>10} {:>10}".format('search', 'recall@'+str(args.k), 'ms', 'distances'))
+    curve = []
+    for name, budget in settings:
+        recall, ms, distances = run(tree, dist_arg, queries, exact, args.k, **budget)
+        curve.append((name, recall, ms))
+        print("{:>20} {:>10.3f} {:>10.2f} {:>10.1f}".format(name, recall, ms, distances))
+
+    if args.plot:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+        except ImportError:
+            print("matplotlib is not installed, not plotting")
+            return
+        plt.plot([ms for _, _, ms in curve], [recall for _, recall, _ in curve], 'o-')
+        for name, recall, ms in curve:
+            plt.annotate(name, xy=(ms, recall), xytext=(5, -10), textcoords='offset points', fontsize=7)
+        plt.xlabel('mean latency (ms)')
+        plt.ylabel('recall@{}'.format(args.k))
+        plt.title('{} timeseries, {} vantage points'.format(args.n, args.vps))
+        plt.savefig(args.plot)
+
+if __name__ == '__main__':
+    main()
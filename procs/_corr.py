@@ -58,6 +58,43 @@ def kernel_corr(ts1, ts2, mult=1):
     denom = np.sqrt(np.sum(np.exp(mult*ccor(ts1, ts1)))*np.sum(np.exp(mult*ccor(ts2, ts2))))
     return num/denom
 
+def stand_many(matrix):
+    "standardizes every row of an (n, L) matrix of timeseries values to have 0 mean and 1 sd"
+    matrix = np.asarray(matrix, dtype=float)
+    return (matrix - matrix.mean(axis=1, keepdims=True)) / matrix.std(axis=1, keepdims=True)
+
+def kernel_corr_many(query, matrix, mult=1):
+    """compute the kernelized correlation of a timeseries with many at once
+
+    The same as kernel_corr(row, query, mult) for every row of matrix, with
+    one real FFT of the query and one over all the rows: the
+    cross-correlations and the autocorrelations of the rows all come from
+    these, and the autocorrelation of the query is only computed once.
+
+    Parameters
+    ----------
+    query : array
+        standardized values of a timeseries, of length L
+    matrix : array
+        (n, L) standardized values of n timeseries, one per row
+
+    Returns
+    -------
+    array
+        the n kernelized correlations
+    """
+    query = np.asarray(query, dtype=float)
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    n = query.shape[-1]
+    f_query = nfft.rfft(query)
+    f_matrix = nfft.rfft(matrix, axis=1)
+    cross_corr = nfft.irfft(f_matrix * np.conj(f_query), n=n, axis=1) / n
+    auto_matrix = nfft.irfft(np.abs(f_matrix)**2, n=n, axis=1) / n
+    auto_query = nfft.irfft(np.abs(f_query)**2, n=n) / n
+    num = np.sum(np.exp(mult*cross_corr), axis=1)
+    denom = np.sqrt(np.sum(np.exp(mult*auto_query)) * np.sum(np.exp(mult*auto_matrix), axis=1))
+    return num/denom
+
 
 #this is for a quick and dirty test of these functions
 #you might need to add procs to pythonpath for this to work
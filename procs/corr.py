@@ -6,16 +6,23 @@ Notes
 proc_main
     the function called by the database on augmented selects
 
+proc_main_many
+    the same over many rows at once, which the server calls when a proc has it
+
 main
     the function called by the database on triggers
 """
 import timeseries as ts
 import numpy as np
+import logging
 
-from ._corr import stand, kernel_corr
+from ._corr import stand, kernel_corr, stand_many, kernel_corr_many
 
 import asyncio
 
+# the size of the batches, too many to print for every call
+logger = logging.getLogger(__name__)
+
 # this function is directly used for augmented selects
 def proc_main(pk, row, arg):
     """ Compute the kernel correlation distance of a TimeSeries to a given reference TimeSeries
@@ -55,6 +62,47 @@ def proc_main(pk, row, arg):
     print("[[[[[[[[[[[CORR]]]]]]]]]]]]",kerndist)
     return [float(kerndist)]
 
+def proc_main_many(pks, rows, arg):
+    """ Compute the kernel correlation distances of many TimeSeries to a given reference TimeSeries
+
+    Parameters
+    ----------
+    pks : list
+        the primary keys of the rows of the database
+    rows : list
+        dictionaries consisting of column_name: value, for each of these rows
+    arg : list
+        TimeSeries in list form to which we will compute the kerndists
+
+    Returns
+    -------
+    list
+        [kerndist] of the TimeSeries in each row to the `arg`, as proc_main
+
+    Notes
+    -----
+    The timeseries of the rows with as many points as the `arg` are
+    standardized and correlated to it all at once, as a matrix, by
+    kernel_corr_many. Those of other lengths, in a database of variable
+    length timeseries, are left to proc_main one by one.
+
+    """
+    argts = ts.TimeSeries(*arg)
+    stand_argts = stand(argts, argts.mean(), argts.std())
+    batch = [n for n, row in enumerate(rows) if len(row['ts']) == len(argts)]
+    results = [None] * len(rows)
+    if batch:
+        matrix = stand_many([rows[n]['ts'].values for n in batch])
+        kerncorr = kernel_corr_many(stand_argts.values, matrix, 5)
+        kerndists = np.sqrt(np.maximum(0.0, 2*(1-kerncorr)))
+        logger.debug("[[[[[[[[[[[CORR]]]]]]]]]]]] %d rows", len(batch))
+        for n, kerndist in zip(batch, kerndists):
+            results[n] = [float(kerndist)]
+    for n, result in enumerate(results):
+        if result is None:
+            results[n] = proc_main(pks[n], rows[n], arg)
+    return results
+
 #the function is wrapped in a coroutine for triggers
 async def main(pk, row, arg):
     """ Compute the kernel correlation distance of a TimeSeries to a given reference TimeSeries
@@ -0,0 +1,45 @@
+import unittest
+from tsdb.bitmap import Bitmap, ARRAY_MAX
+import numpy as np
+
+class BitmapTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # sparse rows, and a dense run that is stored as a bitset
+        self.a_rows = set(rng.randint(0, 1 << 20, 3000).tolist()) | set(range(70000, 80000))
+        self.b_rows = set(rng.randint(0, 1 << 20, 3000).tolist()) | set(range(75000, 76000))
+        self.a = Bitmap(sorted(self.a_rows))
+        self.b = Bitmap(sorted(self.b_rows))
+
+    def test_containers(self):
+        self.assertEqual(self.a.containers[1].dtype, np.uint64)
+        self.assertEqual(self.a.containers[0].dtype, np.uint16)
+        self.assertEqual(len(self.a), len(self.a_rows))
+
+    def test_operations(self):
+        self.assertEqual(list(self.a & self.b), sorted(self.a_rows & self.b_rows))
+        self.assertEqual(list(self.a | self.b), sorted(self.a_rows | self.b_rows))
+        self.assertEqual(list(self.a - self.b), sorted(self.a_rows - self.b_rows))
+        self.assertEqual(list(self.b - self.a), sorted(self.b_rows - self.a_rows))
+
+    def test_add_discard(self):
+        bitmap = Bitmap()
+        for row_id in range(ARRAY_MAX + 10):
+            bitmap.add(row_id * 2)
+        self.assertEqual(bitmap.containers[0].dtype, np.uint64)
+        self.assertTrue(8 in bitmap)
+        bitmap.discard(8)
+        bitmap.discard(9)
+        self.assertFalse(8 in bitmap)
+        self.assertEqual(len(bitmap), ARRAY_MAX + 9)
+
+    def test_serialize(self):
+        for bitmap in (self.a, self.b - self.a, Bitmap()):
+            data = b'xx' + bitmap.tobytes()
+            loaded, end = Bitmap.frombytes(data, 2)
+            self.assertEqual(loaded, bitmap)
+            self.assertEqual(end, len(data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,10 +28,10 @@ class BitmapIndexTests(unittest.TestCase):
             os.removedirs(self.dirPath)
 
     def test_getEqual(self):
-        self.assertEqual(set(self.space_index.getEqual('alien')),set([b'ts-4',b'ts-5']))
+        self.assertEqual(set(self.space_index.getEqual('alien')),set(['ts-4','ts-5']))
 
     def test_getNotEq(self):
-        self.assertEqual(set(self.space_index.getNotEq('comet')),set([b'ts-4',b'ts-5',b'ts-6']))
+        self.assertEqual(set(self.space_index.getNotEq('comet')),set(['ts-4','ts-5','ts-6']))
 
     def test_fakeField(self):
         with self.assertRaises(ValueError):
@@ -39,26 +39,46 @@ class BitmapIndexTests(unittest.TestCase):
 
     def test_update(self):
         self.space_index.insert('alien','ts-1')
-        self.assertEqual(set(self.space_index.getEqual('alien')), set([b'ts-1', b'ts-4',b'ts-5']))
+        self.assertEqual(set(self.space_index.getEqual('alien')), set(['ts-1', 'ts-4','ts-5']))
+
+    def test_getValue(self):
+        self.assertEqual(self.space_index.getValue('ts-6'), 'satellite')
 
     def test_get(self):
-        self.assertEqual(set(self.space_index.get('ts-6')), set('satellite'))
+        self.assertEqual(self.space_index.get('alien'), set(['ts-4','ts-5']))
+        self.assertEqual(self.space_index.get('alien', 3), set(['ts-1','ts-2','ts-3','ts-6']))
+        # values compare as given
+        self.assertEqual(self.space_index.get('comet', 0), set(['ts-4','ts-5']))
+        self.assertEqual(self.space_index.get('comet', 5), set(['ts-1','ts-2','ts-3','ts-6']))
+
+    def test_bitmaps(self):
+        comets = self.space_index.getBitmap('comet')
+        self.assertEqual(list(comets), [0, 1, 2])
+        self.assertEqual(self.space_index.rowids.to_pks(comets | self.space_index.getBitmap('satellite')),
+                         ['ts-1','ts-2','ts-3','ts-6'])
+        self.assertEqual(len(comets & self.space_index.getBitmap('alien')), 0)
 
     def test_remove(self):
-        self.space_index.remove('ts-1')
-        self.assertEqual(set(self.space_index.getEqual('alien')), set([b'ts-4', b'ts-5']))
+        self.space_index.remove('comet', 'ts-1')
+        self.assertEqual(set(self.space_index.getEqual('alien')), set(['ts-4', 'ts-5']))
 
     def test_allKeys_andInsertNew(self):
         self.space_index.insert('satellite','ts-7')
-        self.assertEqual(set(self.space_index.allKeys()), set([b'ts-1', b'ts-2', b'ts-3', b'ts-4', b'ts-5', b'ts-6', b'ts-7']))
+        self.assertEqual(set(self.space_index.allKeys()), set(['ts-1', 'ts-2', 'ts-3', 'ts-4', 'ts-5', 'ts-6', 'ts-7']))
 
-    def test_insert_withBytes(self):
-        self.space_index.insert('satellite',b'ts-7')
-        self.assertEqual(set(self.space_index.get('ts-7')), set('satellite'))
+    def test_insert_many(self):
+        self.space_index.insert_many([('satellite', 'ts-'+str(i)) for i in range(5000)])
+        self.assertEqual(len(self.space_index.getEqual('satellite')), 5000)
+        self.assertEqual(self.space_index.getEqual('alien'), set())
+        del self.space_index
+        self.space_index = BitmapIndex(values = ['comet','alien','satellite'],\
+                            database_name='testing',fieldName='outerspace')
+        self.assertEqual(len(self.space_index.getEqual('satellite')), 5000)
+        self.assertEqual(self.space_index.getValue('ts-4'), 'satellite')
 
     def test_remove_invalidKey(self):
         with self.assertRaises(KeyError):
-            self.space_index.remove('ts-9')
+            self.space_index.remove('comet', 'ts-9')
 
     def test_getEqual_invalidValue(self):
         with self.assertRaises(ValueError):
@@ -72,7 +92,7 @@ class BitmapIndexTests(unittest.TestCase):
         del self.space_index
         self.space_index = BitmapIndex(values = ['comet','alien','satellite'],\
                             database_name='testing',fieldName='outerspace')
-        self.assertEqual(set(self.space_index.allKeys()), set([b'ts-1', b'ts-2', b'ts-3', b'ts-4', b'ts-5', b'ts-6']))
+        self.assertEqual(set(self.space_index.allKeys()), set(['ts-1', 'ts-2', 'ts-3', 'ts-4', 'ts-5', 'ts-6']))
 
     def test_loadFromFile_withOverwrites(self):
         self.space_index.insert('alien', 'ts-6')
@@ -81,11 +101,11 @@ class BitmapIndexTests(unittest.TestCase):
         del self.space_index
         self.space_index = BitmapIndex(values = ['comet','alien','satellite'],\
                             database_name='testing',fieldName='outerspace')
-        self.assertEqual(set(self.space_index.allKeys()), set([b'ts-1', b'ts-2', b'ts-3', b'ts-4', b'ts-5', b'ts-6', b'ts-7']))
+        self.assertEqual(set(self.space_index.allKeys()), set(['ts-1', 'ts-2', 'ts-3', 'ts-4', 'ts-5', 'ts-6', 'ts-7']))
 
     def test_handles_a_deletion_after_reloading_file(self):
-        self.space_index.remove('ts-5')
-        self.space_index.remove('ts-4')
+        self.space_index.remove('alien', 'ts-5')
+        self.space_index.remove('alien', 'ts-4')
         del self.space_index
         self.space_index = BitmapIndex(values = ['comet','alien','satellite'],\
                             database_name='testing',fieldName='outerspace')
@@ -0,0 +1,101 @@
+import unittest
+import os
+from tsdb.bufferpool import BufferPool
+from tsdb.wal import WriteAheadLog
+
+class BufferPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirPath = "files/testing"
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+        self.filename = self.dirPath+'/test_pool.heap'
+        with open(self.filename, 'wb') as fd:
+            fd.write(bytes(range(256)) * 4)
+        self.fd = open(self.filename, 'r+b', buffering=0)
+
+    def tearDown(self):
+        self.fd.close()
+        os.remove(self.filename)
+
+    def _on_disk(self):
+        with open(self.filename, 'rb') as fd:
+            return fd.read()
+
+    def test_read_hits_and_misses(self):
+        pool = BufferPool(cache_size=1024, page_size=256)
+        file_id = pool.register(self.fd, 1024)
+        self.assertEqual(pool.read(file_id, 250, 10), bytes(range(250, 256)) + bytes(range(4)))
+        self.assertEqual((pool.hits, pool.misses), (0, 2))
+        self.assertEqual(pool.read(file_id, 0, 4), bytes(range(4)))
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+
+    def test_lru_eviction(self):
+        pool = BufferPool(cache_size=512, page_size=256)
+        file_id = pool.register(self.fd, 1024)
+        pool.read(file_id, 0, 1)
+        pool.read(file_id, 256, 1)
+        pool.read(file_id, 0, 1) # page 0 is now the most recent
+        pool.read(file_id, 512, 1)
+        self.assertEqual(pool.evictions, 1)
+        self.assertEqual(set(pool.pages.keys()), set([(file_id, 0), (file_id, 2)]))
+
+    def test_write_back(self):
+        pool = BufferPool(cache_size=512, page_size=256)
+        file_id = pool.register(self.fd, 1024)
+        pool.write(file_id, 10, b'abc')
+        pool.write(file_id, 1024, b'tail')
+        self.assertEqual(pool.read(file_id, 10, 3), b'abc')
+        self.assertEqual(len(self._on_disk()), 1024)
+        self.assertTrue(pool.is_dirty(file_id))
+        pool.flush(file_id)
+        data = self._on_disk()
+        self.assertEqual(data[10:13], b'abc')
+        self.assertEqual(data[9], 9)
+        self.assertEqual(data[1024:], b'tail')
+        self.assertFalse(pool.is_dirty(file_id))
+
+    def test_dirty_page_written_on_eviction(self):
+        pool = BufferPool(cache_size=256, page_size=256)
+        file_id = pool.register(self.fd, 1024)
+        pool.write(file_id, 0, b'xyz')
+        pool.read(file_id, 300, 1)
+        self.assertEqual(pool.writebacks, 1)
+        self.assertEqual(self._on_disk()[:3], b'xyz')
+
+    def test_log_before_page(self):
+        wal = WriteAheadLog(self.dirPath+'/test_pool_wal.log', sync_every=100, sync_ms=100000)
+        try:
+            pool = BufferPool(cache_size=256, page_size=256)
+            pool.attach_wal(wal)
+            file_id = pool.register(self.fd, 1024)
+            wal.append('upsert_meta', 'ts-0', {})
+            pool.write(file_id, 0, b'xyz')
+            self.assertEqual(wal.synced_lsn, 0)
+            # evicting the page makes the record it depends on durable first
+            pool.read(file_id, 300, 1)
+            self.assertEqual(wal.synced_lsn, 1)
+            self.assertEqual(self._on_disk()[:3], b'xyz')
+        finally:
+            wal.close()
+            os.remove(self.dirPath+'/test_pool_wal.log')
+
+    def test_write_through(self):
+        pool = BufferPool(cache_size=1024, page_size=256, write_back=False)
+        file_id = pool.register(self.fd, 1024)
+        pool.read(file_id, 0, 1)
+        pool.write(file_id, 1, b'ab')
+        self.assertEqual(self._on_disk()[:3], b'\x00ab')
+        self.assertEqual(pool.read(file_id, 0, 3), b'\x00ab')
+        self.assertFalse(pool.dirty)
+
+    def test_unregister(self):
+        pool = BufferPool(cache_size=1024, page_size=256)
+        file_id = pool.register(self.fd, 1024)
+        pool.write(file_id, 0, b'q')
+        pool.unregister(file_id)
+        self.assertEqual(self._on_disk()[:1], b'q')
+        self.assertEqual(len(pool.pages), 0)
+
+if __name__ == '__main__':
+    unittest.main()
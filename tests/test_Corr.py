@@ -0,0 +1,60 @@
+from procs._corr import stand, kernel_corr, stand_many, kernel_corr_many
+from procs import corr
+import timeseries as ts
+import unittest
+from unittest import mock
+import numpy as np
+
+class CorrTests(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(207)
+        t = list(range(64))
+        self.query = ts.TimeSeries(t, np.random.randn(64))
+        self.rows = [{'ts': ts.TimeSeries(t, np.random.randn(64))} for i in range(20)]
+        self.rows.append({'ts': ts.TimeSeries(t, self.query.values)})
+
+    def test_kernel_corr_many(self):
+        q = stand(self.query, self.query.mean(), self.query.std())
+        matrix = stand_many([row['ts'].values for row in self.rows])
+        many = kernel_corr_many(q.values, matrix, 5)
+        self.assertEqual(many.shape, (len(self.rows),))
+        for row, value in zip(self.rows, many):
+            x = stand(row['ts'], row['ts'].mean(), row['ts'].std())
+            self.assertAlmostEqual(value, kernel_corr(x, q, 5))
+        self.assertAlmostEqual(many[-1], 1.0)
+
+    def test_proc_main_many(self):
+        arg = self.query.to_json()
+        pks = list(range(len(self.rows)))
+        # the batch is only logged, at debug level
+        with self.assertLogs('procs.corr', 'DEBUG') as logs:
+            many = corr.proc_main_many(pks, self.rows, arg)
+        self.assertEqual(logs.output, ['DEBUG:procs.corr:[[[[[[[[[[[CORR]]]]]]]]]]]] 21 rows'])
+        self.assertEqual(len(many), len(self.rows))
+        for pk, row, result in zip(pks, self.rows, many):
+            self.assertAlmostEqual(result[0], corr.proc_main(pk, row, arg)[0])
+        self.assertAlmostEqual(many[-1][0], 0.0)
+        self.assertEqual(corr.proc_main_many([], [], arg), [])
+
+    def test_proc_main_many_ragged(self):
+        # rows of another length than the arg are left to proc_main
+        short = [{'ts': ts.TimeSeries(list(range(32)), np.random.randn(32))} for i in range(3)]
+        rows = self.rows[:5] + short[:2] + self.rows[5:] + short[2:]
+        pks = list(range(len(rows)))
+        arg = self.query.to_json()
+        with mock.patch.object(corr, 'proc_main', return_value=[-1.0]) as proc_main:
+            many = corr.proc_main_many(pks, rows, arg)
+        self.assertEqual([call[0][0] for call in proc_main.call_args_list], [5, 6, len(rows) - 1])
+        self.assertEqual([result[0] for result in many[5:7] + many[-1:]], [-1.0] * 3)
+        for pk, row, result in zip(pks, rows, many):
+            if len(row['ts']) == len(self.query):
+                self.assertAlmostEqual(result[0], corr.proc_main(pk, row, arg)[0])
+        # which fails as it does on its own
+        with self.assertRaises(ValueError):
+            corr.proc_main_many(pks, rows, arg)
+        many = corr.proc_main_many(pks[5:7], short[:2], short[0]['ts'].to_json())
+        self.assertAlmostEqual(many[0][0], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
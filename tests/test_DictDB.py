@@ -144,6 +144,108 @@ class DictDBTests(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.db.delete_ts('five')
 
+    def test_insert_many(self):
+        pks = self.db.insert_many([('five', ts.TimeSeries([1, 2, 3],[1, 2, 3]), {'order': 5}),
+                                   ('six', ts.TimeSeries([1, 2, 3],[1, 2, 4]))])
+        self.assertEqual(pks, ['five', 'six'])
+        pks, payload = self.db.select({'order': 5}, None, None)
+        self.assertEqual(pks, ['five'])
+        with self.assertRaises(ValueError):
+            self.db.insert_many([('seven', ts.TimeSeries([1, 2, 3],[1, 2, 3])),
+                                 ('one', ts.TimeSeries([1, 2, 3],[1, 2, 3]))])
+        self.assertTrue('seven' not in self.db.rows)
+
+    def test_range_queries(self):
+        self.db.upsert_meta('two', {'mean': 2.5})
+        self.db.upsert_meta('three', {'mean': 0.5})
+        self.assertEqual(set(self.db.select({'order': {'>=': 2}}, None, None)[0]), set(['two', 'four']))
+        self.assertEqual(set(self.db.select({'order': {'<': 2}}, None, None)[0]), set(['one', 'three']))
+        self.assertEqual(set(self.db.select({'order': {'!=': 1}}, None, None)[0]), set(['two', 'four']))
+        self.assertEqual(set(self.db.select({'mean': {'<=': 2.5}, 'order': 2}, None, None)[0]), set(['two']))
+        self.assertEqual(self.db.select({'order': {'>': 5}}, None, None)[0], [])
+        self.assertEqual(self.db.indexes['order'].values, [1, 2])
+
+    def test_upsert_updates_index(self):
+        self.db.upsert_meta('one', {'order': 7})
+        self.assertEqual(self.db.indexes['order'][1], set(['three']))
+        self.assertEqual(set(self.db.select({'order': {'>': 1}}, None, None)[0]), set(['one', 'two', 'four']))
+        self.db.delete_ts('three')
+        self.assertEqual(self.db.indexes['order'].values, [2, 7])
+        # a value that does not convert leaves the row and its indexes alone
+        with self.assertRaises(ValueError):
+            self.db.upsert_meta('one', {'blarg': 3, 'order': 'x'})
+        self.assertEqual(self.db.select({'order': 7}, ['blarg'], None)[1], [{'blarg': 1}])
+
+    def test_sort_limit_from_index(self):
+        self.db.upsert_meta('one', {'order': 7})
+        pks, payload = self.db.select({}, ['order'], {'sort_by': '-order', 'limit': 2})
+        self.assertEqual(pks[0], 'one')
+        self.assertEqual(payload, [{'order': 7}, {'order': 2}])
+        # 'two' has no blarg, and goes last
+        pks, payload = self.db.select({}, None, {'sort_by': '+blarg', 'limit': 4})
+        self.assertEqual(pks[0], 'one')
+        self.assertEqual(pks[-1], 'two')
+        # a few matches are sorted rather than looked for in the index
+        walked = []
+        ordered = self.db.indexes['order'].ordered
+        self.db.indexes['order'].ordered = lambda reverse: walked.append(reverse) or ordered(reverse)
+        pks, payload = self.db.select({'blarg': 2}, ['order'], {'sort_by': '-order', 'limit': 1})
+        self.assertEqual(pks, ['four'])
+        self.assertEqual(walked, [])
+        self.db.select({}, None, {'sort_by': '-order', 'limit': 1})
+        self.assertEqual(walked, [True])
+
+    def test_explain(self):
+        self.assertEqual(self.db.indexes['order'].estimate('==', 1), 2)
+        self.assertEqual(self.db.indexes['order'].estimate('>', 1), 2)
+        self.assertEqual(self.db.indexes['blarg'].estimate('!=', 2), 1)
+        plan = self.db.explain({'order': {'>=': 1}, 'blarg': 1, 'useless': 'x'}, None, None)
+        self.assertEqual([step['field'] for step in plan['steps']], ['blarg', 'order', 'useless'])
+        self.assertEqual([step['access'] for step in plan['steps']], ['index', 'filter', 'filter'])
+        self.assertEqual(plan['rows'], 0)
+        # nothing is left to check after an empty match
+        plan = self.db.explain({'order': 5, 'blarg': 1}, None, None)
+        self.assertEqual(len(plan['steps']), 1)
+        self.assertEqual(self.db.index_stats()['order'], {'rows': 4, 'distinct': 2, 'min': 1, 'max': 2})
+
+    def test_offset(self):
+        self.db.upsert_meta('two', {'mean': 2.5})
+        self.db.upsert_meta('three', {'mean': 0.5})
+        self.db.upsert_meta('four', {'mean': 1.5})
+        pks, payload = self.db.select({}, None, {'sort_by': '-mean', 'limit': 2, 'offset': 1})
+        self.assertEqual(pks, ['four', 'three'])
+        pks, payload = self.db.select({}, None, {'sort_by': '+pk', 'limit': 2, 'offset': 1})
+        self.assertEqual(pks, ['one', 'three'])
+        self.assertEqual(len(self.db.select({}, None, {'offset': 3})[0]), 1)
+
+    def test_aggregate(self):
+        self.db.upsert_meta('two', {'mean': 2.5})
+        self.db.upsert_meta('three', {'mean': 0.5})
+        self.assertEqual(self.db.aggregate({}, ['count', 'count(blarg)', 'min(order)', 'max(mean)']),
+                         {'count': 4, 'count(blarg)': 3, 'min(order)': 1, 'max(mean)': 2.5})
+        self.assertEqual(self.db.aggregate({'order': 1}, ['sum(blarg)', 'mean(mean)', 'max(std)']),
+                         {'sum(blarg)': 3, 'mean(mean)': 0.5, 'max(std)': None})
+        groups = self.db.aggregate({}, ['count', 'sum(order)'], group_by='blarg')
+        self.assertEqual(groups, [{'blarg': 1, 'count': 1, 'sum(order)': 1},
+                                  {'blarg': 2, 'count': 2, 'sum(order)': 3},
+                                  {'blarg': None, 'count': 1, 'sum(order)': 2}])
+        histogram = self.db.aggregate({}, ['histogram(order)'], bins=2)['histogram(order)']
+        self.assertEqual(histogram, {'counts': [2, 2], 'edges': [1.0, 1.5, 2.0]})
+        with self.assertRaises(ValueError):
+            self.db.aggregate({}, ['mean'])
+        with self.assertRaises(ValueError):
+            self.db.aggregate({}, ['mean(nothing)'])
+        # only counts are taken of fields that are not numeric
+        self.db.upsert_meta('one', {'useless': 'a'})
+        self.db.upsert_meta('two', {'useless': 'b'})
+        self.assertEqual(self.db.aggregate({}, ['count(useless)', 'count(ts)']),
+                         {'count(useless)': 2, 'count(ts)': 4})
+        for name in ('min(useless)', 'sum(ts)', 'histogram(ts)'):
+            with self.assertRaises(ValueError):
+                self.db.aggregate({}, [name])
+        with self.assertRaises(ValueError):
+            self.db.aggregate({}, ['mean(useless)'], group_by='blarg')
+
     def test_select11(self):
         with self.assertRaises(Exception):
             pks, payload = self.db.select({'order': {'>': 1}}, [], {'sort_by':'+order',
@@ -0,0 +1,146 @@
+import unittest
+from tsdb import PKIndex
+from tsdb.indices import RowIds, ROW_ID_RECORD
+import pickle
+import os
+
+class PKIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirPath = "files/testing"
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+            self._createdDirs = True
+        else:
+            self._createdDirs = False
+
+        self.pks = PKIndex('testing')
+        for i in range(10):
+            self.pks['ts-'+str(i)] = i * 100
+
+    def tearDown(self):
+        self.pks.close()
+        os.remove(self.pks.filename)
+        if self._createdDirs:
+            os.removedirs(self.dirPath)
+
+    def test_get(self):
+        self.assertEqual(self.pks['ts-3'], 300)
+        self.assertTrue('ts-9' in self.pks)
+        self.assertFalse('ts-10' in self.pks)
+        with self.assertRaises(KeyError):
+            self.pks['ts-10']
+        self.assertEqual(len(self.pks), 10)
+        self.assertEqual(sorted(self.pks.keys()), sorted('ts-'+str(i) for i in range(10)))
+
+    def test_update_and_remove(self):
+        self.pks['ts-3'] = 7
+        self.assertEqual(self.pks['ts-3'], 7)
+        self.pks.remove('ts-4')
+        self.assertFalse('ts-4' in self.pks)
+        self.assertEqual(len(self.pks), 9)
+        with self.assertRaises(KeyError):
+            self.pks.remove('ts-4')
+        self.pks['ts-4'] = 1
+        self.assertEqual(len(self.pks), 10)
+
+    def test_long_and_odd_keys(self):
+        keys = ['a'*100, 'b:c', '', 'x\0', 'é'*20]
+        for n, key in enumerate(keys):
+            self.pks[key] = n
+        self.pks.close()
+        self.pks = PKIndex('testing')
+        for n, key in enumerate(keys):
+            self.assertEqual(self.pks[key], n)
+        self.assertEqual(set(self.pks.keys()) & set(keys), set(keys))
+
+    def test_grow(self):
+        n_slots = self.pks.n_slots
+        for i in range(10, 5000):
+            self.pks['ts-'+str(i)] = i * 100
+        for i in range(0, 5000, 2):
+            self.pks.remove('ts-'+str(i))
+        self.assertTrue(self.pks.n_slots > n_slots)
+        self.pks.close()
+        self.pks = PKIndex('testing')
+        self.assertEqual(len(self.pks), 2500)
+        self.assertEqual(self.pks['ts-4999'], 499900)
+        self.assertFalse('ts-4998' in self.pks)
+
+    def test_no_autosave(self):
+        self.pks.close()
+        self.pks = PKIndex('testing', autosave=False)
+        self.pks['ts-10'] = 1000
+        self.pks.remove('ts-0')
+        self.assertEqual(len(self.pks), 10)
+        self.assertTrue('ts-10' in self.pks.keys())
+        # nothing is written until flush
+        other = PKIndex('testing')
+        self.assertTrue('ts-0' in other)
+        self.assertFalse('ts-10' in other)
+        other.close()
+        self.pks.flush()
+        other = PKIndex('testing')
+        self.assertFalse('ts-0' in other)
+        self.assertEqual(other['ts-10'], 1000)
+        other.close()
+
+    def test_load_pickled(self):
+        self.pks.close()
+        os.remove(self.pks.filename)
+        with open('files/testing/pks.p', 'wb') as fd:
+            pickle.dump({'ts-1': 1, 'ts-2': 2}, fd)
+        with open('files/testing/writelog.idx', 'w') as fd:
+            fd.write('ts-3:3\n')
+        self.pks = PKIndex('testing')
+        self.assertEqual(sorted(self.pks.keys()), ['ts-1', 'ts-2', 'ts-3'])
+        self.assertFalse(os.path.exists('files/testing/pks.p'))
+
+class RowIdsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirPath = "files/testing"
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+        self.filename = self.dirPath+'/test_rowids.rid'
+        self.rowids = RowIds(self.filename)
+
+    def tearDown(self):
+        self.rowids.delete()
+
+    def test_ids(self):
+        self.assertEqual([self.rowids.id('ts-'+str(i)) for i in range(5)], list(range(5)))
+        self.assertEqual(self.rowids.id('ts-2'), 2)
+        self.rowids.flush()
+        self.assertEqual(self.rowids.id('a'*40), 5)
+        self.assertEqual(self.rowids.to_pks([5, 0, 3]), ['a'*40, 'ts-0', 'ts-3'])
+        self.assertEqual(self.rowids.get('missing'), None)
+        self.rowids.close()
+        # the pks are looked up on disk, not read in again
+        self.rowids = RowIds(self.filename)
+        self.assertEqual(len(self.rowids), 6)
+        self.assertEqual(self.rowids.get('a'*40), 5)
+        self.assertEqual(self.rowids[4], 'ts-4')
+        self.assertEqual(self.rowids.id('ts-6'), 6)
+
+    def test_recover(self):
+        for i in range(5):
+            self.rowids.id('ts-'+str(i))
+        self.rowids.close()
+        # records the other files miss, and a torn one, as after a crash or
+        # in a file written by an earlier version
+        os.remove(self.filename+'.off')
+        os.remove(self.filename+'.hash')
+        with open(self.filename, 'ab') as fd:
+            fd.write(ROW_ID_RECORD.pack(4) + b'ts-5' + ROW_ID_RECORD.pack(4) + b'ts')
+        self.rowids = RowIds(self.filename)
+        self.assertEqual(len(self.rowids), 6)
+        self.assertEqual(self.rowids.get('ts-5'), 5)
+        self.assertEqual(self.rowids.to_pks(range(6)), ['ts-'+str(i) for i in range(6)])
+        self.assertEqual(self.rowids.id('ts-6'), 6)
+        self.rowids.close()
+        self.rowids = RowIds(self.filename)
+        self.assertEqual(self.rowids[6], 'ts-6')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,18 @@
 import unittest
-from tsdb import PersistentDB
+from tsdb import PersistentDB, BitmapIndex, TreeIndex
+from tsdb.persistentdb import top_k
 import os
+import subprocess
+import sys
+import threading
 import timeseries as ts
 import numpy as np
 
 class PersistentDBTests(unittest.TestCase):
+    columnar = False
+    wal = False
+    ts_codec = None
+
     def setUp(self):
         self.dirPath = "files/testing"
         if not os.path.isdir(self.dirPath):
@@ -28,7 +36,7 @@ class PersistentDBTests(unittest.TestCase):
 
         self.tsLength = 1024
 
-        self.db = PersistentDB(schema, pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.db = PersistentDB(schema, pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, columnar=self.columnar, wal=self.wal, ts_codec=self.ts_codec)
 
         for i in range(100):
             pk = 'ts-'+str(i)
@@ -104,6 +112,48 @@ class PersistentDBTests(unittest.TestCase):
             r_ts = self.db._return_ts(pk)
             self.assertEqual(series,r_ts)
 
+    def test_read_ts_mmap(self):
+        r_ts = self.db._return_ts('ts-3')
+        # zero-copy views into the mapped tsheap, which are read-only, even
+        # with the page cache
+        self.assertTrue(self.db.pool is not None)
+        self.assertFalse(r_ts._values.flags.writeable)
+        mapped = np.frombuffer(self.db.tsheap.mmap, dtype=np.uint8)
+        self.assertTrue(np.shares_memory(r_ts._times, mapped))
+        self.assertTrue(np.shares_memory(r_ts._values, mapped))
+        # the map grows as new series are appended to the heap
+        values = np.array(range(self.tsLength)) + 1000
+        series = ts.TimeSeries(values, values)
+        self.db.insert_ts('ts-new', series)
+        self.assertEqual(self.db._return_ts('ts-new'), series)
+        self.assertEqual(r_ts, self.db._return_ts('ts-3'))
+
+    def test_read_ts_no_mmap(self):
+        self.db.tsheap.use_mmap = False
+        for i in range(5):
+            pk = 'ts-'+str(i)
+            values = np.array(range(self.tsLength)) + i
+            self.assertEqual(ts.TimeSeries(values, values), self.db._return_ts(pk))
+
+    def test_page_cache(self):
+        self.db._return_ts('ts-7')
+        self.db['ts-7']
+        misses = self.db.pool.misses
+        for _ in range(3):
+            self.db._return_ts('ts-7')
+            self.db['ts-7']
+        self.assertEqual(self.db.pool.misses, misses)
+        self.assertTrue(self.db.pool.hits > 0)
+
+    def test_no_page_cache(self):
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, cache_size=0)
+        self.assertTrue(self.db.pool is None)
+        values = np.array(range(self.tsLength)) + 7
+        self.assertEqual(self.db._return_ts('ts-7'), ts.TimeSeries(values, values))
+        self.db.upsert_meta('ts-7', {'order': 2})
+        self.assertEqual(self.db['ts-7']['order'], 2)
+
     def test_select(self):
         self.db.select({'pk':'ts-0'})
         self.db.select({'pk':'ts-35'})
@@ -120,6 +170,336 @@ class PersistentDBTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             self.db.select({'order':{'>=':2}},('pk','blarg'),{'sort_by':'-order', 'limit':10})
 
+    def test_select_sorted_projection(self):
+        pks, rows = self.db.select({}, ['mean'], {'sort_by': '-mean'})
+        self.assertEqual(len(pks), 100)
+        self.assertEqual(pks[0], 'ts-99')
+        means = [r['mean'] for r in rows]
+        self.assertEqual(means, sorted(means, reverse=True))
+        self.assertEqual(rows[5]['mean'], self.db._get_meta_dict(pks[5])['mean'])
+        # unset columns are reported as missing, and sort last
+        self.db.upsert_meta('ts-7', {'d-vp1': 0.5})
+        pks, rows = self.db.select({}, ['d-vp1', 'pk'], {'sort_by': '+d-vp1', 'limit': 2})
+        self.assertEqual(rows[0], {'d-vp1': 0.5, 'pk': 'ts-7'})
+        self.assertEqual(rows[1]['d-vp1'], 'NA')
+        pks, rows = self.db.select({'pk': 'ts-7'}, [], None)
+        self.assertEqual(set(rows[0].keys()), set(['pk', 'order', 'blarg', 'mean', 'std', 'vp', 'd-vp1']))
+
+    def test_projection_skips_ts(self):
+        reads = []
+        read_ts = self.db.tsheap.read_and_decode_ts
+        def counting_read(*args):
+            reads.append(args)
+            return read_ts(*args)
+        self.db.tsheap.read_and_decode_ts = counting_read
+        self.db.select({'blarg': 1}, ['order'], {'sort_by': '-mean'})
+        self.db.upsert_meta('ts-1', {'order': 4})
+        self.db.delete_ts('ts-2')
+        row = self.db['ts-1']
+        self.assertEqual(row['order'], 4)
+        self.assertTrue('ts' in row)
+        self.assertEqual(reads, [])
+        values = np.array(range(self.tsLength)) + 1
+        self.assertEqual(row['ts'], ts.TimeSeries(values, values))
+        self.assertEqual(row.get('ts'), row['ts'])
+        self.assertEqual(len(reads), 1)
+        pks, rows = self.db.select({'order': 4}, ['ts'])
+        self.assertEqual(len(reads), 1 + len(pks))
+
+    def test_snapshot(self):
+        with self.db.snapshot() as snap:
+            self.db.upsert_meta('ts-1', {'order': 5, 'mean': 1.5})
+            self.db.delete_ts('ts-2')
+            values = np.array(range(self.tsLength)) + 100
+            self.db.insert_ts('ts-100', ts.TimeSeries(values, values))
+            self.db.upsert_meta('ts-100', {'order': 1})
+            # the snapshot does not see the changes
+            self.assertEqual(len(snap), 100)
+            self.assertEqual(len(self.db), 100)
+            self.assertEqual(snap['ts-1']['order'], -4)
+            self.assertEqual(snap['ts-2']['order'], -3)
+            values = np.array(range(self.tsLength)) + 2
+            self.assertEqual(snap['ts-2']['ts'], ts.TimeSeries(values, values))
+            with self.assertRaises(KeyError):
+                snap['ts-100']
+            self.assertEqual(self.db['ts-1']['order'], 5)
+            self.assertEqual(set(snap.select({'order': 1})[0]), set(self.db.select({'order': 1})[0]) - {'ts-100'})
+            self.assertEqual(set(snap.select({'order': -4})[0]), set(self.db.select({'order': -4})[0]) | {'ts-1'})
+            self.assertEqual(set(snap.select({'order': -3})[0]), set(self.db.select({'order': -3})[0]) | {'ts-2'})
+            self.assertEqual(set(snap.select({'order': 5})[0]), set(self.db.select({'order': 5})[0]) - {'ts-1'})
+            self.assertEqual(snap.select({'pk': 'ts-2'}, ['pk'])[1], [{'pk': 'ts-2'}])
+            pks, rows = snap.select({'blarg': 2}, ['mean'], {'sort_by': '-mean', 'limit': 5})
+            self.assertEqual(pks, ['ts-99', 'ts-97', 'ts-95', 'ts-93', 'ts-91'])
+            pks, rows = snap.select({'mean': {'<=': 513.5}}, [], {'sort_by': '+mean'})
+            self.assertEqual(pks, ['ts-0', 'ts-1', 'ts-2'])
+            self.assertEqual(rows[1]['mean'], 512.5)
+            self.assertEqual(rows[2]['order'], -3)
+            self.assertEqual(self.db.select({'mean': {'<=': 513.5}}, None, {'sort_by': '+mean'})[0], ['ts-1', 'ts-0'])
+            # a later snapshot sees them
+            with self.db.snapshot() as snap2:
+                self.db.upsert_meta('ts-1', {'order': 4})
+                self.assertEqual(snap2['ts-1']['order'], 5)
+                self.assertEqual(snap['ts-1']['order'], -4)
+                self.assertEqual(len(snap2), 100)
+        self.assertEqual(self.db._versions, {})
+        with self.assertRaises(ValueError):
+            snap.select({})
+
+    def test_snapshot_keeps_slots(self):
+        with self.db.snapshot() as snap:
+            self.db.delete_ts('ts-3')
+            values = np.array(range(self.tsLength)) + 100
+            self.db.insert_ts('ts-100', ts.TimeSeries(values, values))
+            # the slot of ts-3 is not reused while the snapshot can read it
+            values = np.array(range(self.tsLength)) + 3
+            self.assertEqual(snap['ts-3']['ts'], ts.TimeSeries(values, values))
+            with self.assertRaises(RuntimeError):
+                self.db.vacuum()
+        self.assertEqual(len(self.db.tsheap.free_slots), 1)
+        self.assertTrue(self.db.vacuum() > 0)
+
+    def test_snapshot_concurrent_writes(self):
+        errors = []
+        def scan(snap):
+            try:
+                for _ in range(20):
+                    pks, rows = snap.select({'blarg': 1}, ['order'], {'sort_by': '+order'})
+                    assert len(pks) == 50, len(pks)
+                    assert snap[pks[0]]['ts'] is not None
+            except Exception as e:
+                errors.append(e)
+        with self.db.snapshot() as snap:
+            reader = threading.Thread(target=scan, args=(snap,))
+            reader.start()
+            for i in range(100, 150):
+                values = np.array(range(self.tsLength)) + i
+                self.db.insert_ts('ts-'+str(i), ts.TimeSeries(values, values))
+                self.db.upsert_meta('ts-'+str(i), {'blarg': 1})
+                self.db.delete_ts('ts-'+str(i - 99))
+            reader.join()
+        self.assertEqual(errors, [])
+
+    def test_snapshot_scan_unlocked(self):
+        with self.db.snapshot() as snap:
+            read_raws = snap._raws
+            def write_during_scan(*args):
+                # the scan does not hold the lock, so a writer gets through
+                writer = threading.Thread(target=self.db.upsert_meta, args=('ts-4', {'order': 50}))
+                writer.start()
+                writer.join(5)
+                self.assertFalse(writer.is_alive())
+                snap._raws = read_raws
+                return read_raws(*args)
+            snap._raws = write_during_scan
+            pks, rows = snap.select({}, ['order'], {'sort_by': '-order', 'limit': 1})
+            # ts-4 changed during the scan and is read from its old version
+            self.assertNotEqual(pks, ['ts-4'])
+            self.assertEqual(rows[0]['order'], 5)
+            self.assertEqual(snap.select({'pk': 'ts-4'}, ['order'])[1], [{'order': -1}])
+            self.assertEqual(self.db['ts-4']['order'], 50)
+            # a row keeps one version per snapshot taken since it changed
+            self.db.upsert_meta('ts-4', {'order': 51})
+            self.assertEqual(len(self.db._versions['ts-4']), 1)
+            with self.db.snapshot():
+                self.db.upsert_meta('ts-4', {'order': 52})
+                self.db.upsert_meta('ts-4', {'order': 53})
+                self.assertEqual(len(self.db._versions['ts-4']), 2)
+
+    def test_bitmap_indexes(self):
+        self.assertIsInstance(self.db.indexes['blarg'], BitmapIndex)
+        self.assertIsInstance(self.db.indexes['vp'], BitmapIndex)
+        self.assertIsInstance(self.db.indexes['order'], TreeIndex)
+        self.db.upsert_meta('ts-4', {'vp': True})
+        self.db.upsert_meta('ts-6', {'vp': True})
+        self.db.upsert_meta('ts-7', {'vp': True})
+        self.assertEqual(set(self.db.select({'blarg': 1, 'vp': True})[0]), set(['ts-4', 'ts-6']))
+        self.assertEqual(set(self.db.select({'blarg': {'!=': 1}, 'vp': True})[0]), set(['ts-7']))
+        self.assertEqual(set(self.db.select({'blarg': {'>': 1}, 'vp': True, 'order': {'>': 0}})[0]), set(['ts-7']))
+        self.assertEqual(self.db.select({'blarg': 3})[0], [])
+        self.db.delete_ts('ts-6')
+        self.assertEqual(self.db.select({'blarg': 1, 'vp': True})[0], ['ts-4'])
+        # an index missing on disk is built again when the database is opened
+        self.db.close()
+        os.remove('files/testing/vp.bmi')
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(set(self.db.select({'vp': True})[0]), set(['ts-4', 'ts-7']))
+        self.assertEqual(len(self.db.select({'blarg': 2})[0]), 50)
+
+    def test_lazy_indexes(self):
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertFalse(self.db.indexes.is_loaded('order'))
+        self.assertTrue('order' in self.db.indexes)
+        self.assertTrue('not loaded' in self.db.startup_report())
+        self.assertEqual(len(self.db.select({'order': 2})[0]), 9)
+        self.assertTrue(self.db.indexes.is_loaded('order'))
+        self.assertFalse(self.db.indexes.is_loaded('mean'))
+        self.assertTrue('order' in self.db.load_times and 'pks' in self.db.load_times)
+        self.db.upsert_meta('ts-7', {'mean': 1.5})
+        self.assertEqual(self.db.select({'mean': 1.5})[0], ['ts-7'])
+        # opened in the background
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, warm_up=True)
+        self.db._warmer.join()
+        self.assertTrue(all(self.db.indexes.is_loaded(field) for field in self.db.indexFields))
+        self.assertFalse('not loaded' in self.db.startup_report())
+        self.assertEqual(self.db.select({'mean': 1.5})[0], ['ts-7'])
+
+    def test_composite_index(self):
+        self.db.delete_database()
+        schema = dict(self.schema)
+        schema[('blarg', 'order')] = {'covering': ['mean', 'd-vp1']}
+        self.db = PersistentDB(schema, pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True,
+                               columnar=self.columnar, wal=self.wal, ts_codec=self.ts_codec)
+        rows = []
+        for i in range(100):
+            values = np.array(range(self.tsLength)) + i
+            rows.append(('ts-'+str(i), ts.TimeSeries(values, values),
+                         {'order': i % 11 - 5, 'blarg': i % 2 + 1, 'mean': float(values.mean())}))
+        self.db.insert_many(rows[:50])
+        for pk, series, meta in rows[50:]:
+            self.db.insert_ts(pk, series)
+            self.db.upsert_meta(pk, meta)
+        index = self.db.indexes[('blarg', 'order')]
+        self.assertEqual(len(index.tree), 100)
+        metas = {pk: meta for pk, _, meta in rows}
+        expected = lambda test: set(pk for pk, meta in metas.items() if test(meta))
+        self.assertEqual(set(self.db.select({'blarg': 2, 'order': 3})[0]),
+                         expected(lambda m: m['blarg'] == 2 and m['order'] == 3))
+        self.assertEqual(set(self.db.select({'order': {'>=': 1}, 'blarg': 1})[0]),
+                         expected(lambda m: m['blarg'] == 1 and m['order'] >= 1))
+        self.assertEqual(set(self.db.select({'order': {'<': 0}, 'blarg': 1, 'mean': {'>': 540.0}})[0]),
+                         expected(lambda m: m['blarg'] == 1 and m['order'] < 0 and m['mean'] > 540))
+        # covered: read from the index only
+        pks, data = self.db.select({'blarg': 2, 'order': {'>': 3}}, ['mean', 'order', 'd-vp1', 'pk'],
+                                   {'sort_by': '-mean', 'limit': 3})
+        self.assertEqual(pks, ['ts-97', 'ts-87', 'ts-75'])
+        self.assertEqual(data[0], {'mean': metas['ts-97']['mean'], 'order': 4, 'd-vp1': 'NA', 'pk': 'ts-97'})
+        self.assertEqual(self.db.select({'blarg': 2, 'order': {'>': 3}}, ['mean'])[1],
+                         self.db.select({'blarg': 2, 'order': {'>': 3}, 'mean': {'>': 0}}, ['mean'])[1])
+        # kept up to date
+        self.db.upsert_meta('ts-97', {'order': 0, 'd-vp1': 1.5})
+        self.db.delete_ts('ts-87')
+        self.assertEqual(self.db.select({'blarg': 2, 'order': {'>': 3}}, ['mean'], {'sort_by': '-mean', 'limit': 1})[0],
+                         ['ts-75'])
+        self.assertEqual(self.db.select({'blarg': 2, 'order': 0}, ['d-vp1'])[1], [{'d-vp1': 'NA'}]*5 + [{'d-vp1': 1.5}])
+        self.db.close()
+        os.remove('files/testing/blarg+order.idx')
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(len(self.db.indexes[('blarg', 'order')].tree), 99)
+        self.assertEqual(set(self.db.select({'blarg': 2, 'order': 3})[0]),
+                         expected(lambda m: m['blarg'] == 2 and m['order'] == 3) - set(['ts-87']))
+
+    def test_composite_index_bad(self):
+        self.db.delete_database()
+        schema = dict(self.schema)
+        schema[('blarg', 'pk')] = {}
+        with self.assertRaises(ValueError):
+            self.db = PersistentDB(schema, pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.db = PersistentDB(self.schema, pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+
+    def test_explain(self):
+        # mean is 511.5 + i, order 3 holds 9 rows and vp is never 1
+        self.assertTrue(abs(self.db.indexes['mean'].estimate(600.0, 1) - 11) <= 2)
+        self.assertEqual(self.db.indexes['order'].estimate(3), 9)
+        meta = {'mean': {'>': 600.0}, 'order': 3, 'blarg': 1}
+        plan = self.db.explain(meta)
+        self.assertEqual([step['field'] for step in plan['steps']], ['order', 'mean', 'blarg'])
+        self.assertEqual(plan['steps'][-1]['access'], 'filter')
+        self.assertEqual(plan['rows'], len(self.db.select(meta)[0]))
+        self.assertTrue(set(['match', 'sort', 'fetch', 'total']) <= set(plan['ms']))
+        plan = self.db.explain({'mean': {'>': 600.0}, 'vp': 1, 'order': 3})
+        self.assertEqual([(step['field'], step['rows']) for step in plan['steps']], [('vp', 0)])
+        # kept up to date by inserts and upserts
+        self.db.upsert_meta('ts-0', {'mean': 1000.0})
+        self.assertEqual(self.db.index_stats()['mean']['max'], 1000.0)
+        self.assertEqual(self.db.index_stats()['order']['rows'], 100)
+
+    def test_aggregate(self):
+        # order is i % 11 - 5, blarg i % 2 + 1 and mean 511.5 + i
+        self.db.upsert_meta('ts-3', {'d-vp1': 2.0})
+        self.assertEqual(self.db.aggregate({}, ['count', 'min(order)', 'max(mean)', 'count(d-vp1)', 'max(blarg)']),
+                         {'count': 100, 'min(order)': -5, 'max(mean)': 610.5, 'count(d-vp1)': 1, 'max(blarg)': 2})
+        result = self.db.aggregate({'blarg': 1}, ['count', 'sum(order)', 'mean(mean)', 'max(d-vp1)'])
+        self.assertEqual(result, {'count': 50, 'sum(order)': sum(i % 11 - 5 for i in range(0, 100, 2)),
+                                  'mean(mean)': 511.5 + 49, 'max(d-vp1)': None})
+        groups = self.db.aggregate({'order': {'>=': 4}}, ['count', 'min(mean)', 'histogram(mean)'],
+                                   group_by='blarg', bins=4)
+        self.assertEqual([(g['blarg'], g['count'], g['min(mean)']) for g in groups],
+                         [(1, 9, 511.5 + 10), (2, 9, 511.5 + 9)])
+        self.assertEqual(sum(groups[0]['histogram(mean)']['counts']), 9)
+        self.assertEqual(self.db.aggregate({}, ['count'], group_by='d-vp1'),
+                         [{'d-vp1': 2.0, 'count': 1}, {'d-vp1': None, 'count': 99}])
+        with self.assertRaises(ValueError):
+            self.db.aggregate({}, ['sum(ts)'])
+
+    def test_top_k(self):
+        values = np.array([3, 1, 2, 1, 3, 0, 2])
+        for k in range(1, 8):
+            self.assertEqual(top_k(values, k).tolist(), np.argsort(values, kind='stable')[:k].tolist())
+            self.assertEqual(top_k(values, k, True).tolist(), np.argsort(values, kind='stable')[::-1][:k].tolist())
+        self.db.upsert_meta('ts-3', {'std': 10.0})
+        means = {'ts-'+str(i): 511.5 + i for i in range(100)}
+        by_mean = sorted(means, key=means.get)
+        # in the order of the mean index, with no criteria
+        pks, data = self.db.select({}, ['mean'], {'sort_by': '-mean', 'limit': 3, 'offset': 2})
+        self.assertEqual(pks, by_mean[::-1][2:5])
+        self.assertEqual(data[0], {'mean': means[by_mean[-3]]})
+        plan = self.db.explain({}, None, {'sort_by': '+mean', 'limit': 3})
+        self.assertEqual(plan['order'], 'index')
+        # partitioned from the sort column of the matches
+        blarg1 = [pk for pk in by_mean if int(pk[3:]) % 2 == 0]
+        self.assertEqual(self.db.select({'blarg': 1}, None, {'sort_by': '+mean', 'limit': 4, 'offset': 1})[0],
+                         blarg1[1:5])
+        self.assertEqual(self.db.select({'blarg': 1}, None, {'sort_by': '-mean', 'offset': 48})[0],
+                         blarg1[1::-1])
+        self.assertEqual(self.db.select({'blarg': 1}, None, {'sort_by': '+pk', 'limit': 2})[0],
+                         sorted(blarg1)[:2])
+        # rows where the field is not set go last
+        self.assertEqual(self.db.select({}, None, {'sort_by': '+d-vp1', 'limit': 2})[0], list(self.db.pks.keys())[:2])
+
+    def test_wrong_layout(self):
+        self.db.close()
+        with self.assertRaises(ValueError):
+            self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, columnar=not self.columnar)
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(self.db.select({'order': 2}, ['order'])[1][0], {'order': 2})
+
+    def test_insert_many(self):
+        rows = []
+        for i in range(100, 2500):
+            values = np.array(range(self.tsLength)) + i
+            series = ts.TimeSeries(values, values)
+            if i % 2:
+                rows.append(('ts-'+str(i), series, {'order': i % 5, 'mean': float(series.mean())}))
+            else:
+                rows.append(('ts-'+str(i), series))
+        reports = []
+        pks = self.db.insert_many(rows, progress=lambda done, total: reports.append((done, total)))
+        self.assertEqual(pks, [row[0] for row in rows])
+        self.assertEqual(reports[-1], (2400, 2400))
+        self.assertTrue(len(reports) > 1)
+        self.assertEqual(len(self.db), 2500)
+        self.assertEqual(self.db._return_ts('ts-2001'), rows[1901][1])
+        self.assertEqual(self.db['ts-2001']['order'], 1)
+        self.assertTrue('order' not in self.db['ts-2000'])
+        self.assertTrue('ts-2001' in self.db.select({'order': 1})[0])
+        self.assertTrue('ts-2000' not in self.db.select({'order': 0})[0])
+        self.assertEqual(self.db.select({'mean': {'>': 2000.0}}, ['pk'], {'sort_by': '+mean', 'limit': 1})[0], ['ts-1489'])
+
+        # a bad row aborts the whole insert
+        values = np.array(range(self.tsLength))
+        with self.assertRaises(ValueError):
+            self.db.insert_many([('ok-1', ts.TimeSeries(values, values)), ('ts-5', ts.TimeSeries(values, values))])
+        with self.assertRaises(TypeError):
+            self.db.insert_many([('ok-1', ts.TimeSeries(values, values), {'order': 'one'})])
+        self.assertTrue('ok-1' not in self.db.pks)
+
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(len(self.db), 2500)
+        self.assertEqual(self.db['ts-2001']['mean'], float(rows[1901][1].mean()))
+
     def test_indices(self):
         "test indices via the select function, which calls on them"
         n_test = 10
@@ -207,6 +587,95 @@ class PersistentDBTests(unittest.TestCase):
             self.assertTrue(r_meta[self.db.metaheap.fields.index('mean')] == series.mean())
             self.assertTrue(r_meta[self.db.metaheap.fields.index('std')] == series.std())
 
+    def test_free_slots_reused(self):
+        tsheap_size = os.path.getsize(self.db.tsheap.filename)
+        self.db.delete_ts('ts-4')
+        values = np.array(range(self.tsLength)) * 2
+        series = ts.TimeSeries(values, values)
+        self.db.insert_ts('ts-reused', series)
+        self.assertEqual(os.path.getsize(self.db.tsheap.filename), tsheap_size)
+        self.assertEqual(self.db._return_ts('ts-reused'), series)
+        self.db.delete_ts('ts-5')
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(len(self.db.tsheap.free_slots), 1)
+
+    def test_held_series_across_reuse(self):
+        nines = np.ones(self.tsLength) * 9
+        values = np.array(range(self.tsLength))
+        # through the page cache, then straight from the memory map
+        for i, cache_size in ((4, None), (6, 0)):
+            if cache_size is not None:
+                self.db.close()
+                self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, wal=self.wal, cache_size=cache_size)
+            pks = ['ts-'+str(i), 'ts-'+str(i+1)]
+            held = self.db[pks[0]]['ts']
+            row = self.db[pks[1]] # its ts is read later
+            for pk in pks:
+                self.db.delete_ts(pk)
+            for pk in pks:
+                self.db.insert_ts(pk+'-nines', ts.TimeSeries(nines, nines))
+            self.assertEqual(held, ts.TimeSeries(values + i, values + i))
+            self.assertEqual(row['ts'], ts.TimeSeries(values + i + 1, values + i + 1))
+            # once nothing reads them, the slots are reused
+            del held, row
+            tsheap_size = os.path.getsize(self.db.tsheap.filename)
+            for pk in pks:
+                self.db.insert_ts(pk, ts.TimeSeries(nines, nines))
+            self.assertEqual(os.path.getsize(self.db.tsheap.filename), tsheap_size)
+            self.assertEqual(self.db[pks[1]]['ts'], ts.TimeSeries(nines, nines))
+
+    def test_vacuum(self):
+        for i in range(0, 100, 3):
+            self.db.delete_ts('ts-'+str(i))
+        self.db.upsert_meta('ts-1', {'d-vp1': 1.5})
+        if self.columnar:
+            meta_bytes = sum(dtype.itemsize for dtype in self.db.metaheap.dtypes)
+        else:
+            meta_bytes = self.db.metaheap.byteArrayLength
+        if self.ts_codec is None:
+            ts_bytes = 34 * self.db.tsheap.byteArrayLength
+        else:
+            ts_bytes = sum(capacity for _, capacity in self.db.tsheap.free_slots)
+        reclaimed = self.db.vacuum()
+        self.assertEqual(reclaimed, ts_bytes + 34 * meta_bytes)
+        self.assertEqual(len(self.db), 66)
+        self.assertEqual(self.db.tsheap.free_slots, [])
+        for i in range(100):
+            pk = 'ts-'+str(i)
+            if i % 3 == 0:
+                self.assertTrue(pk not in self.db.pks)
+                continue
+            values = np.array(range(self.tsLength)) + i
+            self.assertEqual(self.db._return_ts(pk), ts.TimeSeries(values, values))
+            self.assertEqual(self.db[pk]['order'], self.schema['order']['values'][i % 11])
+        self.assertEqual(self.db['ts-1']['d-vp1'], 1.5)
+        self.assertEqual(set(self.db.select({'order': 1})[0]), set(['ts-17', 'ts-28', 'ts-50', 'ts-61', 'ts-83', 'ts-94']))
+        # the deleted pks gave up their row ids
+        self.assertEqual(len(self.db.rowids), 66)
+        pks = self.db.select({'blarg': 1, 'order': {'<=': -4}}, None, {'sort_by': '+order'})[0]
+        self.assertEqual(set(pks[:3]), set(['ts-22', 'ts-44', 'ts-88']))
+        self.assertEqual(set(pks[3:]), set(['ts-34', 'ts-56']))
+
+        # still usable, and reopens with the new files
+        values = np.array(range(self.tsLength))
+        self.db.insert_ts('ts-0', ts.TimeSeries(values, values))
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertEqual(len(self.db), 67)
+        self.assertEqual(len(self.db.rowids), 67)
+        self.assertEqual(set(self.db.select({'order': -5})[0]), set(['ts-11', 'ts-22', 'ts-44', 'ts-55', 'ts-77', 'ts-88']))
+        self.assertEqual(self.db._return_ts('ts-0'), ts.TimeSeries(values, values))
+        self.assertEqual(self.db['ts-98']['mean'], float(np.mean(np.arange(self.tsLength) + 98)))
+
+    def test_vacuum_leftovers_removed(self):
+        self.db.close()
+        with open(self.dirPath+'/tsheap.vacuum', 'wb') as fd:
+            fd.write(b'partial')
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertFalse(os.path.exists(self.dirPath+'/tsheap.vacuum'))
+        self.assertEqual(len(self.db), 100)
+
     def test_vps(self):
         self.db.add_vp('vp-0', 'ts-88')
         self.db.add_vp('vp-1', 'ts-87')
@@ -222,5 +691,174 @@ class PersistentDBTests(unittest.TestCase):
         self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
         self.assertTrue('vp-1' in self.db.vps)
 
+class ColumnarPersistentDBTests(PersistentDBTests):
+    "runs all of the tests above against the columnar metaheap"
+    columnar = True
+
+class CompressedPersistentDBTests(PersistentDBTests):
+    "runs all of the tests above with compressed timeseries records"
+    ts_codec = 'xor'
+
+    def test_read_ts_mmap(self):
+        # the times of the first series became the shared axis
+        r_ts = self.db._return_ts('ts-0')
+        self.assertTrue(np.shares_memory(r_ts._times, self.db.tsheap.times))
+        self.assertFalse(r_ts._times.flags.writeable)
+        values = np.array(range(self.tsLength)) + 3
+        self.assertEqual(self.db._return_ts('ts-3'), ts.TimeSeries(values, values))
+
+    def test_smaller_heap(self):
+        self.assertTrue(os.path.getsize(self.db.tsheap.filename) * 2 <= 100 * self.db.tsheap.byteArrayLength)
+
+    def test_codec_change(self):
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, ts_codec='zlib')
+        values = np.array(range(self.tsLength)) * 0.5
+        self.db.insert_ts('ts-zlib', ts.TimeSeries(values, values))
+        self.assertEqual(self.db._return_ts('ts-zlib'), ts.TimeSeries(values, values))
+        self.assertEqual(self.db._return_ts('ts-1'), ts.TimeSeries(values*2+1, values*2+1))
+
+class WALPersistentDBTests(PersistentDBTests):
+    "runs all of the tests above with a write ahead log"
+    wal = True
+
+    def _crash(self):
+        "stop the database as a crash would, without checkpointing"
+        self.db._closing.set()
+        self.db._checkpointer.join()
+        self.db.wal.close()
+
+    def test_recover_after_crash(self):
+        self.db.checkpoint()
+        self.assertEqual(len(self.db.wal), 0)
+        values = np.array(range(self.tsLength)) * 3
+        self.db.insert_ts('ts-new', ts.TimeSeries(values, values))
+        self.db.upsert_meta('ts-new', {'order': 3, 'mean': 2.5})
+        self.db.upsert_meta('ts-1', {'order': -5})
+        self.db.delete_ts('ts-2')
+        self.db.insert_many([('ts-many', ts.TimeSeries(values, values), {'blarg': 2})])
+        self.assertEqual(len(self.db.wal), 5)
+        self._crash()
+
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, wal=True)
+        self.assertEqual(len(self.db.wal), 0)
+        self.assertEqual(len(self.db), 101)
+        self.assertTrue('ts-2' not in self.db.pks)
+        self.assertEqual(self.db._return_ts('ts-new'), ts.TimeSeries(values, values))
+        self.assertEqual(self.db['ts-new']['order'], 3)
+        self.assertEqual(self.db['ts-new']['mean'], 2.5)
+        self.assertEqual(self.db['ts-1']['order'], -5)
+        self.assertTrue('ts-new' in self.db.select({'order': 3})[0])
+        self.assertTrue('ts-1' in self.db.select({'order': -5})[0])
+        self.assertTrue('ts-many' in self.db.select({'blarg': 2})[0])
+        self.assertTrue('ts-2' not in self.db.select({'blarg': 1})[0])
+        self.assertEqual(len(self.db.tsheap.free_slots), 1)
+
+    def test_recover_twice(self):
+        # changes already applied to the heaps are not applied twice
+        self.db.checkpoint()
+        self.db.delete_ts('ts-3')
+        self.db.upsert_meta('ts-4', {'std': 1.0})
+        self.db.wal.sync()
+        self.db.tsheap.sync()
+        self.db.pks.flush()
+        self._crash()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, wal=True)
+        self.assertEqual(len(self.db), 99)
+        self.assertEqual(self.db.tsheap.free_slots.count(self.db.tsheap.byteArrayLength*3), 1)
+        self.assertEqual(self.db['ts-4']['std'], 1.0)
+        self.assertEqual(self.db.select({'std': {'<=': 1.0}})[0], ['ts-4'])
+
+    def test_log_before_heap(self):
+        # the process dies right after a delete, without a cache the
+        # tombstone goes straight to the metaheap: its log record must too
+        self.db.close()
+        script = ("import os, sys; sys.path[:0] = {!r}\n"
+                  "from tsdb import PersistentDB\n"
+                  "db = PersistentDB(pk_field='pk', db_name='testing', ts_length={}, testing=True, wal=True, cache_size={})\n"
+                  "db.checkpoint()\n"
+                  "db.delete_ts('ts-1')\n"
+                  "os._exit(0)\n")
+        for cache_size in (0, 65536):
+            subprocess.check_call([sys.executable, '-c', script.format(sys.path, self.tsLength, cache_size)])
+            self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, wal=True)
+            self.assertTrue('ts-1' not in self.db.pks)
+            self.assertTrue('ts-1' not in self.db.select({})[0])
+            values = np.array(range(self.tsLength))
+            self.db.insert_ts('ts-1', ts.TimeSeries(values, values))
+            self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True, wal=True)
+
+    def test_log_before_slot_reuse(self):
+        depends_on = []
+        heap_depends_on = self.db.tsheap._depends_on
+        self.db.tsheap._depends_on = lambda offset: depends_on.append(heap_depends_on(offset)) or depends_on[-1]
+        self.db.delete_ts('ts-3')
+        freed = self.db.wal.last_lsn
+        values = np.array(range(self.tsLength)) + 200
+        self.db.insert_ts('ts-200', ts.TimeSeries(values, values))
+        self.db.insert_ts('ts-201', ts.TimeSeries(values, values))
+        # the freed slot waited for the delete to be durable, the append
+        # after it for nothing
+        self.assertEqual(depends_on, [freed, -1])
+        self.assertTrue(self.db.wal.synced_lsn > freed)
+
+    def test_reopen_without_wal(self):
+        self.db.upsert_meta('ts-5', {'order': 5})
+        self._crash()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=self.tsLength, testing=True)
+        self.assertFalse(os.path.exists(self.dirPath+'/wal.log'))
+        self.assertEqual(self.db['ts-5']['order'], 5)
+
+class VariableLengthPersistentDBTests(unittest.TestCase):
+
+    def setUp(self):
+        schema = {
+          'pk':    {'type': 'string', 'index': None},
+          'ts':    {'type': None,     'index': None},
+          'mean':  {'type': 'float',  'index': 1}
+        }
+        self.db = PersistentDB(schema, pk_field='pk', db_name='testing', ts_length=None, testing=True)
+        self.series = {}
+        for i in range(20):
+            times = np.arange(10 * (i + 1), dtype=float)
+            if i % 4 == 3:
+                times = times + 0.5 # off the shared time axis
+            self.series['ts-'+str(i)] = ts.TimeSeries(times, np.sin(times))
+        for pk in sorted(self.series)[:10]:
+            self.db.insert_ts(pk, self.series[pk])
+        self.db.insert_many([(pk, self.series[pk], {'mean': 1.0}) for pk in sorted(self.series)[10:]])
+
+    def tearDown(self):
+        self.db.delete_database()
+
+    def test_read(self):
+        for pk, series in self.series.items():
+            r_ts = self.db._return_ts(pk)
+            self.assertEqual(r_ts, series)
+            self.assertFalse(r_ts._values.flags.writeable)
+        self.assertEqual(len(self.db._return_ts('ts-0')), 10)
+        self.assertEqual(len(self.db._return_ts('ts-19')), 200)
+        self.assertEqual(set(self.db.select({'mean': 1.0})[0]), set(sorted(self.series)[10:]))
+
+    def test_delete_reuse_vacuum(self):
+        self.db.delete_ts('ts-5')
+        self.db.delete_ts('ts-6')
+        values = np.arange(15, dtype=float)
+        self.db.insert_ts('ts-short', ts.TimeSeries(values, values))
+        self.assertEqual(len(self.db.tsheap.free_slots), 1)
+        self.assertTrue(self.db.vacuum() > 0)
+        self.db.close()
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=None, testing=True)
+        self.assertEqual(self.db._return_ts('ts-short'), ts.TimeSeries(values, values))
+        self.assertEqual(self.db._return_ts('ts-7'), self.series['ts-7'])
+        self.assertEqual(len(self.db), 19)
+
+    def test_fixed_length_mismatch(self):
+        self.db.close()
+        with self.assertRaises(ValueError):
+            self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=1024, testing=True)
+        self.db = PersistentDB(pk_field='pk', db_name='testing', ts_length=None, testing=True)
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,9 @@ import timeseries as ts
 import numpy as np
 import asyncio
 import time
+import os
+import tempfile
+import vptrees
 
 class TSDBServerTest(unittest.TestCase):
 
@@ -128,6 +131,21 @@ class TSDBServerTest(unittest.TestCase):
         self.assertEqual(payload['two']['m'], np.mean([4, 9, 16]))
         self.assertEqual(payload['two']['sd'], np.std([4, 9, 16]))
 
+    def test_insert_many(self):
+        msg = TSDBOp_InsertMany([('five', ts.TimeSeries([1, 2, 3],[2, 4, 9]), {'order': 5}),
+                                 ('six', ts.TimeSeries([1, 2, 3],[3, 4, 9]))])
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.OK)
+
+        msg = TSDBOp_Select({'order': 5}, ['pk'], None)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(list(payload.keys()), ['five'])
+
+        msg = TSDBOp_InsertMany([('seven', ts.TimeSeries([1, 2, 3],[2, 4, 9])),
+                                 ('six', ts.TimeSeries([1, 2, 3],[3, 4, 9]))])
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.INVALID_KEY)
+
     def test_find_similar1(self):
 
         query = ts.TimeSeries([1, 2, 3],[4, 0, 3])
@@ -146,6 +164,106 @@ class TSDBServerTest(unittest.TestCase):
         near = list(payload.keys())[0]
         self.assertTrue(near in ['one','two','three','four'])
 
+    def test_find_similar_k(self):
+        query = ts.TimeSeries([1, 2, 3],[1, 4, 10])
+        msg = TSDBOp_FindSimilar(query, 3)
+        status, payload = self._mockSendingMessage(msg)
+        without_tree = list(payload.items())
+        self.assertEqual(len(without_tree), 3)
+        self.assertEqual(without_tree, sorted(without_tree, key=lambda item: item[1]))
+
+        # the d_vp-1 trigger does not run here, so make the tree directly
+        dist = lambda vp, pks: [self.server._dist_vp_arg(p, self.db[vp]['ts'].to_json()) for p in pks]
+        self.server.vptree = vptrees.VPTree(['one', 'two', 'three', 'four'], ['one', 'three'], dist)
+        msg = TSDBOp_FindSimilar(query, 3)
+        # the search counters are only logged, at debug level
+        with self.assertLogs('tsdb.tsdb_server', 'DEBUG') as logs:
+            status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(len(logs.records), 1)
+        self.assertTrue('1 searches' in logs.output[0])
+        # 'three' and 'four' are as far from the query
+        for d, (_, d_without) in zip(payload.values(), without_tree):
+            self.assertAlmostEqual(d, d_without)
+        self.assertEqual(self.server.vptree.searches, 1)
+
+        msg = TSDBOp_FindSimilar(query, 3, max_distances=2)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertTrue(payload['candidates'] <= 2)
+        self.assertTrue(len(payload['results']) <= 2)
+
+    def test_find_within(self):
+        # the d_vp-1 trigger does not run here, so upsert the distances to 'one'
+        vp = self.db['one']['ts'].to_json()
+        pks = ['one', 'two', 'three', 'four']
+        for pk in pks:
+            self.db.upsert_meta(pk, {'d_vp-1': self.server._dist_vp_arg(pk, vp)})
+        query = ts.TimeSeries([1, 2, 3],[1, 4, 10])
+        dists = {pk: self.server._dist_vp_arg(pk, query.to_json()) for pk in pks}
+        nearest = sorted(pks, key=dists.get)
+        radius = (dists[nearest[1]] + dists[nearest[2]]) / 2
+
+        msg = TSDBOp_FindWithin(query, radius)
+        # the select counters are only logged, at debug level
+        with self.assertLogs('tsdb.tsdb_server', 'DEBUG') as logs:
+            status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(len(logs.records), 1)
+        self.assertTrue('Find Within :: Select returned' in logs.output[0])
+        self.assertEqual(status, TSDBStatus.OK)
+        self.assertEqual(list(payload.keys()), nearest[:2])
+        self.assertAlmostEqual(payload[nearest[0]], dists[nearest[0]])
+
+        msg = TSDBOp_FindWithin(query, radius, 1)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(list(payload.keys()), nearest[:1])
+
+        msg = TSDBOp_FindWithin(query, 0.0)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(len(payload), 0)
+
+    def test_vp_tree_maintained(self):
+        msg = TSDBOp_MakeVPTree()
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.OK)
+        self.assertEqual(self.server.vptree.pks, {'one', 'two', 'three', 'four'})
+
+        msg = TSDBOp_InsertTS('five', ts.TimeSeries([1, 2, 3],[2, 5, 9]))
+        status, payload = self._mockSendingMessage(msg)
+        msg = TSDBOp_DeleteTS('two')
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(self.server.vptree.pks, {'one', 'three', 'four', 'five'})
+
+        query = ts.TimeSeries([1, 2, 3],[2, 5, 9])
+        msg = TSDBOp_FindSimilar(query, 5)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(list(payload.keys())[0], 'five')
+        self.assertEqual(set(payload.keys()), {'one', 'three', 'four', 'five'})
+
+        # changes made during a rebuild are replayed on the new tree
+        tree = self.server.vptree
+        self.server._vp_changes = []
+        self.db.delete_ts('three')
+        self.server._update_vp_tree('delete', ['three'])
+        self.server._rebuild_vp_tree(self.db)
+        self.assertFalse(self.server.vptree is tree)
+        self.assertEqual(self.server.vptree.pks, {'one', 'four', 'five'})
+        self.assertTrue(self.server._vp_changes is None)
+
+        # deleting a vantage point rebuilds the tree without it
+        msg = TSDBOp_DeleteTS('one')
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(self.server.vptree.pks, {'four', 'five'})
+        self.assertFalse(self.server.vptree.stale)
+
+    def test_vp_tree_saved(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'vptree.p')
+            server = TSDBServer(self.db, vptree_file=filename)
+            server.make_vp_tree()
+            server._update_vp_tree('delete', ['two'])
+            loaded = TSDBServer(self.db, vptree_file=filename).vptree
+            self.assertEqual(loaded.pks, {'one', 'three', 'four'})
+            self.assertEqual(loaded.deleted, {'two'})
+
 class TSDBServerTest2(unittest.TestCase):
 
     def setUp(self):
@@ -260,6 +378,26 @@ class TSDBServerTest2(unittest.TestCase):
         status, payload = self._mockSendingMessage(msg)
         self.assertEqual(set(payload.keys()), set(['two', 'four']))
 
+    def test_select_explain(self):
+        msg = TSDBOp_Select({'vp': True, 'order': {'>': 1}}, [], None, explain=True)
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.OK)
+        self.assertEqual(payload['rows'], 0)
+        self.assertEqual(payload['steps'][0]['field'], 'vp')
+        self.assertTrue('total' in payload['ms'])
+
+    def test_aggregate(self):
+        msg = TSDBOp_Aggregate({}, ['count', 'max(vp_num)', 'count(vp)'])
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.OK)
+        self.assertEqual(payload, {'count': 4, 'max(vp_num)': 1, 'count(vp)': 1})
+        msg = TSDBOp_Aggregate({}, ['count'], group_by='vp')
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(payload, [{'vp': True, 'count': 1}, {'vp': None, 'count': 3}])
+        msg = TSDBOp_Aggregate({}, ['median(vp_num)'])
+        status, payload = self._mockSendingMessage(msg)
+        self.assertEqual(status, TSDBStatus.INVALID_OPERATION)
+
     def test_select7(self):
         msg = TSDBOp_UpsertMeta('four', {'order': 3, 'blarg': 2})
         self._mockSendingMessage(msg)
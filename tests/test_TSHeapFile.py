@@ -0,0 +1,109 @@
+import unittest
+import os
+import pickle
+import numpy as np
+import timeseries as ts
+from tsdb.heap import TSHeapFile, CODECS
+
+class TSHeapFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirPath = "files/testing"
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+        self.filename = self.dirPath+'/test_tsheap'
+        self.times = np.arange(100, dtype=float)
+
+    def tearDown(self):
+        for f in os.listdir(self.dirPath):
+            if f.startswith('test_tsheap'):
+                os.remove(self.dirPath+'/'+f)
+
+    def test_codecs(self):
+        for codec in CODECS:
+            heap = TSHeapFile(self.filename+codec, 100, codec=codec)
+            shared = ts.TimeSeries(self.times, np.sin(self.times) * 100)
+            smooth = ts.TimeSeries(self.times, self.times * 4)
+            other = ts.TimeSeries(self.times + 0.5, self.times)
+            offsets = heap.encode_and_write_many([shared, smooth])
+            offsets.append(heap.encode_and_write_ts(other))
+            heap.close()
+
+            heap = TSHeapFile(self.filename+codec, 100)
+            self.assertEqual(heap.codec, codec)
+            self.assertEqual(list(heap.times), list(self.times))
+            r_shared, r_smooth, r_other = [heap.read_and_decode_ts(offset) for offset in offsets]
+            self.assertTrue(np.shares_memory(r_shared._times, heap.times))
+            self.assertEqual(r_smooth, smooth)
+            self.assertEqual(r_other, other)
+            if codec == 'float32':
+                self.assertTrue(np.allclose(r_shared._values, shared._values, rtol=1e-6))
+            else:
+                self.assertEqual(r_shared, shared)
+            heap.close()
+
+    def test_variable_length(self):
+        heap = TSHeapFile(self.filename, None)
+        self.assertEqual(heap.codec, 'raw')
+        short = ts.TimeSeries(self.times[:10], self.times[:10] * 2)
+        full = ts.TimeSeries(self.times, self.times * 3)
+        longer = ts.TimeSeries(np.arange(150, dtype=float), np.arange(150, dtype=float))
+        extents = heap.write_extents([full, short])
+        extents.append(heap.write_extent(longer))
+        for series, (offset, size) in zip([full, short, longer], extents):
+            self.assertEqual(heap.read_and_decode_ts(offset), series)
+            r_ts = heap.read_and_decode_ts(offset, size)
+            self.assertEqual(r_ts, series)
+            self.assertFalse(r_ts._values.flags.writeable)
+        # the short series shares the start of the time axis
+        self.assertTrue(np.shares_memory(heap.read_and_decode_ts(extents[1][0])._times, heap.times))
+        heap.close()
+
+    def test_free_slot_capacity(self):
+        heap = TSHeapFile(self.filename, 100, codec='zlib')
+        noisy = ts.TimeSeries(self.times, np.random.RandomState(0).rand(100))
+        offset = heap.encode_and_write_ts(noisy)
+        size = heap.writeptr
+        heap.free(offset)
+        # a smaller record goes in the freed slot, which keeps its capacity
+        flat = ts.TimeSeries(self.times, np.zeros(100))
+        self.assertEqual(heap.encode_and_write_ts(flat), offset)
+        self.assertEqual(heap.read_and_decode_ts(offset), flat)
+        heap.free(offset)
+        self.assertEqual(heap.free_slots, [(offset, size)])
+        self.assertEqual(heap.encode_and_write_ts(noisy), offset)
+        self.assertEqual(heap.writeptr, size)
+        heap.close()
+
+    def test_free_slot_held(self):
+        heap = TSHeapFile(self.filename, 100)
+        series = ts.TimeSeries(self.times, self.times * 2)
+        offset = heap.encode_and_write_ts(series)
+        view = heap.read_and_decode_ts(offset)
+        pin = heap.pin()
+        heap.free(offset)
+        self.assertEqual(heap.free_slots, [])
+        other = ts.TimeSeries(self.times, np.zeros(100))
+        self.assertNotEqual(heap.encode_and_write_ts(other), offset)
+        self.assertEqual(view, series)
+        del view
+        self.assertNotEqual(heap.encode_and_write_ts(other), offset)
+        del pin
+        self.assertEqual(heap.encode_and_write_ts(other), offset)
+        heap.close()
+
+    def test_old_metadata(self):
+        # heaps written before codecs keep their fixed length records
+        with open(self.filename+'_metadata.met', 'wb') as fd:
+            pickle.dump((100, 1600), fd)
+        heap = TSHeapFile(self.filename, 100)
+        self.assertTrue(heap.codec is None)
+        offset = heap.encode_and_write_ts(ts.TimeSeries(self.times, self.times))
+        self.assertEqual(heap.writeptr, 1600)
+        self.assertEqual(heap.read_and_decode_ts(offset), ts.TimeSeries(self.times, self.times))
+        heap.close()
+        with self.assertRaises(ValueError):
+            TSHeapFile(self.filename, 100, codec='xor')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
 from tsdb import TreeIndex
+from tsdb.btree import BPlusTree
+import bintrees
+import pickle
 import os
+import numpy as np
 
 class TreeIndexTests(unittest.TestCase):
 
@@ -49,6 +53,131 @@ class TreeIndexTests(unittest.TestCase):
     def test_missingPK(self):
         with self.assertRaises(ValueError):
             self.blarg_index.remove(fieldValue=8,pk='ts-100')
+        with self.assertRaises(ValueError):
+            self.blarg_index.remove(fieldValue=9,pk='ts-8')
+
+    def test_operators(self):
+        self.assertEqual(self.blarg_index.get(2, 4), set(['ts-1','ts-2','ts-3','ts-4','ts-5','ts-6','ts-9']))
+        self.assertEqual(self.blarg_index.get(7, 5), set(['ts-7','ts-8','ts-10']))
+        self.assertEqual(self.blarg_index.get(1, 3), set(['ts-6','ts-7','ts-8','ts-9','ts-10']))
+        self.assertEqual(self.blarg_index.get(7.5, 0), self.blarg_index.get(7, 4))
+
+    def test_getRows(self):
+        rows = self.blarg_index.getRows(1, 5)
+        self.assertEqual(rows.dtype, np.uint32)
+        self.assertEqual(rows.tolist(), list(range(10)))
+        self.assertEqual(self.blarg_index.rowids.to_pks(self.blarg_index.getRows(2).tolist()), ['ts-6','ts-9'])
+
+    def test_estimate(self):
+        # values 1 x5, 2 x2, 7, 8 x2
+        self.assertEqual(self.blarg_index.estimate(1), 2)
+        self.assertEqual(self.blarg_index.estimate(9), 0)
+        self.assertEqual(self.blarg_index.estimate(9, 3), 10)
+        self.assertEqual(self.blarg_index.estimate(5, 1), 3)
+        self.assertEqual(self.blarg_index.estimate(2, 0), 5)
+        self.blarg_index.insert(20, 'ts-11')
+        stats = self.blarg_index.stats()
+        self.assertEqual((stats.rows, stats.min, stats.max), (11, 1, 20))
+        self.blarg_index.remove(20, 'ts-11')
+        self.assertEqual(self.blarg_index.stats().rows, 10)
+
+    def test_ordered(self):
+        self.assertEqual(list(self.blarg_index.ordered()), [0, 1, 2, 3, 4, 5, 8, 6, 7, 9])
+        self.assertEqual(list(self.blarg_index.ordered(reverse=True)), [9, 7, 6, 8, 5, 4, 3, 2, 1, 0])
+        entries = [(float(i % 97), i) for i in range(3000)]
+        tree = self.blarg_index.tree
+        for key, row in entries:
+            tree.insert(key, row + 100)
+        self.assertEqual([entry[1] for entry in tree.reversed_items()],
+                         [entry[1] for entry in tree.items()][::-1])
+
+    def test_reopen(self):
+        self.blarg_index.remove(1, 'ts-3')
+        self.blarg_index.close()
+        self.blarg_index = TreeIndex(database_name='testing',fieldName='blarg')
+        self.assertEqual(self.blarg_index.getEqual(1), set(['ts-1','ts-2','ts-4','ts-5']))
+        self.assertEqual(len(self.blarg_index.tree), 9)
+
+    def test_many(self):
+        entries = [(i % 97, 'ts-'+str(i)) for i in range(5000)]
+        self.blarg_index.insert_many(entries)
+        # the tree is spread over many pages
+        self.assertTrue(self.blarg_index.tree.n_pages > 10)
+        self.assertEqual(self.blarg_index.getEqual(13), set(pk for v, pk in entries if v == 13))
+        self.assertEqual(self.blarg_index.getLowerThan(3),
+                         set(pk for v, pk in entries if v < 3) | set(['ts-1','ts-2','ts-3','ts-4','ts-5','ts-6','ts-9']))
+        for v, pk in entries[::2]:
+            self.blarg_index.remove(v, pk)
+        self.blarg_index.close()
+        self.blarg_index = TreeIndex(database_name='testing',fieldName='blarg')
+        self.assertEqual(self.blarg_index.getHigherThan(95), set(pk for v, pk in entries[1::2] if v > 95))
+
+    def test_convert_pickle(self):
+        self.blarg_index.deleteIndex()
+        avl = bintrees.AVLTree()
+        avl[1] = ['ts-1', 'ts-2']
+        avl[3] = ['ts-3']
+        with open(self.blarg_index.filename, 'wb') as f:
+            pickle.dump(avl, f)
+        self.blarg_index = TreeIndex(database_name='testing',fieldName='blarg')
+        self.assertTrue(BPlusTree.is_btree(self.blarg_index.filename))
+        self.assertEqual(self.blarg_index.getHigherOrEq(1), set(['ts-1','ts-2','ts-3']))
+
+
+class BPlusTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = 'test_btree.idx'
+        # small pages and cache, to exercise splits and evictions
+        self.tree = BPlusTree(self.filename, cache_size=16*256, page_size=256)
+
+    def tearDown(self):
+        self.tree.close()
+        os.remove(self.filename)
+
+    def test_order(self):
+        import random
+        entries = [(random.randint(0, 50), i) for i in range(2000)]
+        for key, row in entries:
+            self.assertTrue(self.tree.insert(key, row))
+        self.assertFalse(self.tree.insert(*entries[0]))
+        self.assertEqual(list(self.tree.items()), sorted((float(k), row) for k, row in entries))
+        self.assertTrue(self.tree.misses > 0)
+        for key, row in entries[:1000]:
+            self.assertTrue(self.tree.remove(key, row))
+        self.assertFalse(self.tree.remove(*entries[0]))
+        self.tree.close()
+        self.tree = BPlusTree(self.filename, cache_size=16*256)
+        self.assertEqual(self.tree.page_size, 256)
+        self.assertEqual(len(self.tree), 1000)
+        self.assertEqual(self.tree.range(10, 20, include_low=False).tolist(),
+                         sorted(row for k, row in entries[1000:] if 10 < k <= 20))
+
+    def test_range_rows(self):
+        for row in range(100):
+            self.tree.insert(row % 3, row)
+        rows = self.tree.range(1, 1)
+        self.assertEqual(rows.dtype, np.uint32)
+        self.assertEqual(rows.tolist(), list(range(1, 100, 3)))
+        self.assertEqual(len(self.tree.range(None, 1, include_high=False)), 34)
+        self.assertEqual(len(self.tree.range(3)), 0)
+
+    def test_composite_keys(self):
+        self.tree.close()
+        os.remove(self.filename)
+        self.tree = BPlusTree(self.filename, cache_size=16*256, page_size=256, key_width=2, value_width=1)
+        for row in range(300):
+            self.tree.insert((row % 3, row % 7), row, (row / 2,))
+        self.assertFalse(self.tree.insert((0, 0), 0, (1.0,)))
+        self.assertEqual(self.tree.range((1,), (1,)).tolist(), list(range(1, 300, 3)))
+        self.assertEqual(self.tree.range((1, 2), (1,), include_low=False).tolist(),
+                         sorted(row for row in range(1, 300, 3) if row % 7 > 2))
+        self.tree.close()
+        self.tree = BPlusTree(self.filename)
+        self.assertEqual((self.tree.key_width, self.tree.value_width), (2, 1))
+        self.assertEqual(list(self.tree.scan((2, 6), (2, 6)))[0], ((2.0, 6.0), 20, (10.0,)))
+        self.assertTrue(self.tree.remove((2, 6), 20))
+        self.assertEqual(len(self.tree.range((2, 6), (2, 6))), 13)
 
 if __name__ == '__main__':
     unittest.main()
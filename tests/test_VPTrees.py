@@ -2,6 +2,8 @@ from vptrees import *
 from graphviz import Digraph
 import unittest
 import numpy as np
+import os
+import tempfile
 
 class VPTreesTests(unittest.TestCase):
     def setUp(self):
@@ -45,5 +47,118 @@ class VPTreesTests(unittest.TestCase):
         assert nearestwanted in group
         #######################
 
+    def test_knn(self):
+        np.random.seed(207)
+        points = {'a'+str(i) : np.random.normal(0,10,2) for i in range(300)}
+        pks = list(points.keys())
+        vps = pks[:15]
+
+        def dist(vp,pks):
+            return [np.linalg.norm(points[vp] - points[p]) for p in pks]
+
+        def dist_arg(pk,arg):
+            return np.linalg.norm(points[pk] - arg)
+
+        t = VPTree(pks, vps, dist)
+        for n in range(20):
+            query = np.random.normal(0,10,2)
+            k = n % 5 + 1
+            nearest = t.knn(query, k, dist_arg)
+            wanted = sorted(pks, key=lambda p: dist_arg(p, query))[:k]
+            self.assertEqual([pk for pk, d in nearest], wanted)
+            self.assertAlmostEqual(nearest[-1][1], dist_arg(wanted[-1], query))
+        self.assertEqual(t.searches, 20)
+        self.assertEqual(t.distances + t.distances_saved, 20 * 300)
+        self.assertTrue(t.distances_saved > 0)
+        self.assertEqual(len(t.knn(query, 500, dist_arg)), 300)
+        self.assertEqual(t.knn(query, 0, dist_arg), [])
+
+        # approximate
+        for n in range(10):
+            query = np.random.normal(0,10,2)
+            exact = t.knn(query, 3, dist_arg)
+            self.assertTrue(len(t.knn(query, 3, dist_arg, max_distances=30)) <= 3)
+            self.assertTrue(t.last_search['distances'] <= 30)
+            t.knn(query, 3, dist_arg, max_leaves=1)
+            self.assertEqual(t.last_search['leaves'], 1)
+            approximate = t.knn(query, 3, dist_arg, epsilon=0.5)
+            for (_, d), (_, d_exact) in zip(approximate, exact):
+                self.assertTrue(d <= 1.5 * d_exact)
+    def test_insert_delete(self):
+        np.random.seed(207)
+        points = {'a'+str(i) : np.random.normal(0,10,2) for i in range(300)}
+        pks = list(points.keys())
+        vps = pks[:10]
+
+        def dist(vp,pks):
+            return [np.linalg.norm(points[vp] - points[p]) for p in pks]
+
+        def dist_arg(pk,arg):
+            return np.linalg.norm(points[pk] - arg)
+
+        t = VPTree(pks[:200], vps, dist)
+        for pk in pks[200:]:
+            t.insert(pk)
+        for pk in pks[150:250]:
+            t.delete(pk)
+        self.assertEqual(t.size, 200)
+        self.assertFalse(t.stale)
+        live = pks[:150] + pks[250:]
+        for n in range(10):
+            query = np.random.normal(0,10,2)
+            wanted = sorted(live, key=lambda p: dist_arg(p, query))[:5]
+            self.assertEqual([pk for pk, d in t.knn(query, 5, dist_arg)], wanted)
+
+        # inserting a deleted key again brings it back once
+        t.insert(pks[160])
+        self.assertEqual(len(t.knn(points[pks[160]], 300, dist_arg)), 201)
+        self.assertEqual(t.knn(points[pks[160]], 1, dist_arg)[0][0], pks[160])
+
+        # leaves overflow
+        self.assertFalse(t.needs_rebuild)
+        for n in range(t.max_leaf_size + 1):
+            points['b'+str(n)] = points['a0'] + n * 1e-6
+            t.insert('b'+str(n))
+        self.assertTrue(t.needs_rebuild)
+
+        t.delete('a0')
+        self.assertTrue(t.stale)
+        with self.assertRaises(ValueError):
+            t.insert('a1')
+
+    def test_save_load(self):
+        np.random.seed(207)
+        points = {'a'+str(i) : np.random.normal(0,10,2) for i in range(100)}
+        pks = list(points.keys())
+
+        def dist(vp,pks):
+            return [np.linalg.norm(points[vp] - points[p]) for p in pks]
+
+        def dist_arg(pk,arg):
+            return np.linalg.norm(points[pk] - arg)
+
+        t = VPTree(pks[:80], pks[:5], dist)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'vptree.p')
+            t.save(filename)
+            for pk in pks[80:]:
+                t.insert(pk)
+            t.delete('a50')
+            self.assertTrue(os.path.exists(filename+'.log'))
+
+            # the log is replayed without computing distances
+            loaded = VPTree.load(filename, None)
+            self.assertEqual(loaded.pks, t.pks)
+            self.assertEqual(loaded.deleted, {'a50'})
+            query = np.random.normal(0,10,2)
+            self.assertEqual(loaded.knn(query, 10, dist_arg), t.knn(query, 10, dist_arg))
+
+            loaded.dist_func = dist
+            loaded.delete('a51')
+            self.assertEqual(VPTree.load(filename, dist).deleted, {'a50', 'a51'})
+            loaded.save(filename)
+            self.assertFalse(os.path.exists(filename+'.log'))
+            self.assertEqual(VPTree.load(filename, dist).size, 98)
+
 if __name__ == '__main__':
     unittest.main()
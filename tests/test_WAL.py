@@ -0,0 +1,85 @@
+import unittest
+import os
+import time
+from tsdb.wal import WriteAheadLog, FILE_HEADER
+
+class WALTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirPath = "files/testing"
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+        self.filename = self.dirPath+'/test_wal.log'
+        self.wal = WriteAheadLog(self.filename, sync_every=3, sync_ms=1000)
+
+    def tearDown(self):
+        self.wal.close()
+        os.remove(self.filename)
+
+    def test_append_and_replay(self):
+        self.assertEqual(self.wal.append('insert_ts', 'ts-0', [1, 2]), 0)
+        self.assertEqual(self.wal.append('delete_ts', 'ts-0'), 1)
+        self.assertEqual(self.wal.replay(), [(0, 'insert_ts', ('ts-0', [1, 2])),
+                                             (1, 'delete_ts', ('ts-0',))])
+        self.wal.close()
+        self.wal = WriteAheadLog(self.filename)
+        self.assertEqual(len(self.wal), 2)
+        self.assertEqual(self.wal.append('delete_ts', 'ts-1'), 2)
+
+    def test_group_commit(self):
+        self.wal.append('delete_ts', 'ts-0')
+        self.wal.append('delete_ts', 'ts-1')
+        self.assertEqual(self.wal.synced_lsn, 0)
+        self.wal.append('delete_ts', 'ts-2')
+        self.assertEqual(self.wal.synced_lsn, 3)
+        self.wal.close()
+        self.wal = WriteAheadLog(self.filename, sync_every=100, sync_ms=5)
+        self.wal.append('delete_ts', 'ts-3')
+        time.sleep(0.1)
+        self.assertEqual(self.wal.synced_lsn, 4)
+
+    def test_append_reaches_os(self):
+        # a crash of the process does not lose records that are not fsync'd
+        self.wal.append('delete_ts', 'ts-0')
+        self.assertEqual(self.wal.synced_lsn, 0)
+        self.assertTrue(os.path.getsize(self.filename) > FILE_HEADER.size)
+
+    def test_sync_to(self):
+        self.wal.append('delete_ts', 'ts-0')
+        self.wal.sync_to(self.wal.last_lsn)
+        self.assertEqual(self.wal.synced_lsn, 1)
+        self.wal.append('delete_ts', 'ts-1')
+        self.wal.sync_to(0)
+        self.assertEqual(self.wal.synced_lsn, 1)
+
+    def test_torn_tail_dropped(self):
+        self.wal.append('delete_ts', 'ts-0')
+        self.wal.append('delete_ts', 'ts-1')
+        self.wal.close()
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'r+b') as fd:
+            fd.truncate(size - 3)
+        self.wal = WriteAheadLog(self.filename)
+        self.assertEqual(self.wal.replay(), [(0, 'delete_ts', ('ts-0',))])
+        self.assertEqual(self.wal.append('delete_ts', 'ts-2'), 1)
+
+    def test_bad_checksum(self):
+        self.wal.append('delete_ts', 'ts-0')
+        self.wal.close()
+        with open(self.filename, 'r+b') as fd:
+            fd.seek(-1, 2)
+            fd.write(b'\x00')
+        self.wal = WriteAheadLog(self.filename)
+        self.assertEqual(self.wal.replay(), [])
+
+    def test_truncate(self):
+        self.wal.append('delete_ts', 'ts-0')
+        self.wal.append('delete_ts', 'ts-1')
+        self.wal.truncate()
+        self.assertEqual(len(self.wal), 0)
+        self.assertEqual(os.path.getsize(self.filename), FILE_HEADER.size)
+        self.assertEqual(self.wal.append('delete_ts', 'ts-2'), 2)
+        self.assertEqual(self.wal.replay(), [(2, 'delete_ts', ('ts-2',))])
+
+if __name__ == '__main__':
+    unittest.main()
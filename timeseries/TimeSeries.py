@@ -44,6 +44,32 @@ class TimeSeries:
         self._times = np.array(times)
         self._values = np.array(values)
 
+    @classmethod
+    def from_arrays(cls, times, values):
+        """instantiate a TimeSeries that wraps two numpy arrays without copying
+
+        Used by the database to hand out views into its storage. The arrays
+        may be read-only, in which case setting values raises a ValueError.
+
+        Parameters
+        ----------
+        times : numpy.ndarray
+            the times of the TimeSeries
+
+        values : numpy.ndarray
+            the values of the TimeSeries
+
+        Returns
+        -------
+        TimeSeries
+            new TimeSeries object sharing memory with `times` and `values`
+        """
+        assert len(times) == len(values),"Array of Unequal Length"
+        obj = cls.__new__(cls)
+        obj._times = times
+        obj._values = values
+        return obj
+
     @property
     def values(self):
         "values of the TimeSeries"
@@ -0,0 +1,104 @@
+"""Aggregates of the rows matching a select, computed by the databases
+"""
+
+import re
+import numpy as np
+
+FUNCTIONS = ('count', 'sum', 'min', 'max', 'mean', 'histogram')
+_AGGREGATE = re.compile(r'^\s*(\w+)\s*(?:\(\s*([^()\s]*)\s*\))?\s*$')
+
+def parse_aggregate(aggregate):
+    """
+    helper function to split an aggregate such as 'mean(std)' into its
+    function and field. 'count' on its own counts rows, and has no field.
+    """
+    match = _AGGREGATE.match(aggregate) if isinstance(aggregate, str) else None
+    if match is None or match.group(1) not in FUNCTIONS:
+        raise ValueError("Unknown aggregate '{}', must be one of {} of a field".format(aggregate, FUNCTIONS))
+    func, field = match.group(1), match.group(2) or None
+    if field is None and func != 'count':
+        raise ValueError("Aggregate '{}' needs a field, as in '{}(field)'".format(aggregate, func))
+    return func, field
+
+def check_numeric(name, field, values):
+    """
+    helper function to raise a ValueError if the values of field, a numpy
+    array, are not numbers, which the aggregates but 'count' need
+    """
+    if values.dtype.kind not in 'biuf':
+        raise ValueError("Aggregate '{}' needs a numeric field, '{}' is not".format(name, field))
+
+def aggregate_rows(aggregates, n_rows, columns, bins=10):
+    """
+    Values of aggregates over rows.
+
+    Parameters
+    ----------
+    aggregates : list
+        (name, function, field) of every aggregate, see parse_aggregate()
+    n_rows : int
+        number of rows
+    columns : dict
+        field: (values, is_set) numpy arrays of the rows, for every field of
+        an aggregate. Values that are not set are left out of aggregates.
+    bins : int
+        number of equal width buckets of histograms
+
+    Returns a dictionary of name: value. Aggregates of no values are None,
+    and histograms are dictionaries of their 'counts' and bucket 'edges'.
+    Aggregates other than 'count' of fields that are not numeric raise a
+    ValueError.
+    """
+    result = {}
+    for name, func, field in aggregates:
+        if field is None:
+            result[name] = n_rows
+            continue
+        values, is_set = columns[field]
+        if func != 'count':
+            check_numeric(name, field, values)
+        values = values[is_set]
+        if func == 'count':
+            result[name] = len(values)
+        elif len(values) == 0:
+            result[name] = None
+        elif func == 'sum':
+            result[name] = values.sum().item()
+        elif func == 'min':
+            result[name] = values.min().item()
+        elif func == 'max':
+            result[name] = values.max().item()
+        elif func == 'mean':
+            result[name] = float(values.mean())
+        elif func == 'histogram':
+            counts, edges = np.histogram(values, bins=bins)
+            result[name] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+    return result
+
+def aggregate_groups(aggregates, n_rows, columns, group_by, bins=10):
+    """
+    Values of aggregates over the rows with each value of the field
+    group_by, whose (values, is_set) must be in columns, as aggregate_rows().
+
+    Returns a list of dictionaries, one per value in increasing order, of
+    the value of group_by and the values of the aggregates. Rows where
+    group_by is not set are grouped last, under None.
+    """
+    keys, key_set = columns[group_by]
+    set_rows = np.flatnonzero(key_set)
+    uniques, inverse = np.unique(keys[set_rows], return_inverse=True)
+    # rows of each group are contiguous in this order
+    order = set_rows[np.argsort(inverse, kind='stable')]
+    ends = np.cumsum(np.bincount(inverse, minlength=len(uniques)))
+    groups = [(value.item(), order[end-count:end])
+              for value, end, count in zip(uniques, ends, np.diff(ends, prepend=0))]
+    if len(set_rows) < n_rows:
+        groups.append((None, np.flatnonzero(~key_set)))
+    result = []
+    for value, rows in groups:
+        group = {group_by: value}
+        group.update(aggregate_rows(aggregates, len(rows),
+                                    {field: (values[rows], is_set[rows])
+                                     for field, (values, is_set) in columns.items()}, bins))
+        result.append(group)
+    return result
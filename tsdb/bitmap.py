@@ -0,0 +1,218 @@
+"""Compressed bitmaps of row ids, used by the bitmap indexes
+
+Row ids are split into their upper and lower 16 bits. Every upper half that
+has rows gets a container for the lower halves, which is a sorted array of
+uint16 while it holds at most ARRAY_MAX rows, and a bitset of 2**16 bits
+otherwise. This is the layout of roaring bitmaps, see
+http://roaringbitmap.org.
+"""
+
+import struct
+import numpy as np
+
+ARRAY_MAX = 4096 # rows, above which a container is stored as a bitset
+BITSET_WORDS = 1024 # uint64 words in a bitset container
+HEADER = struct.Struct('<I') # number of containers
+CONTAINER = struct.Struct('<HBI') # upper 16 bits, kind, number of rows
+ARRAY = 0
+BITSET = 1
+
+def _is_bitset(container):
+    return container.dtype == np.uint64
+
+def _to_bitset(array):
+    "helper function to turn a sorted uint16 array into a bitset container"
+    bits = np.zeros(BITSET_WORDS*64, dtype=np.uint8)
+    bits[array] = 1
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+def _to_array(bitset):
+    "helper function to turn a bitset container into a sorted uint16 array"
+    return np.flatnonzero(np.unpackbits(bitset.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+def _has(bitset, array):
+    "helper function to test which rows of an array are in a bitset"
+    words = array >> 6
+    return (bitset[words] >> (array & 63).astype(np.uint64)) & np.uint64(1) == 1
+
+def _shrink(container):
+    "helper function to store a container as an array if it is small enough"
+    if _is_bitset(container):
+        array = _to_array(container)
+        if len(array) <= ARRAY_MAX:
+            return array
+    return container
+
+
+class Bitmap:
+    """
+    Set of uint32 row ids, with fast union, intersection and difference.
+
+    Bitmaps are combined with `|`, `&` and `-`, which return new bitmaps,
+    and changed one row at a time with add and discard.
+    """
+    __slots__ = ('containers',)
+
+    def __init__(self, row_ids=None):
+        self.containers = {} # upper 16 bits: container of lower 16 bits
+        if row_ids is not None:
+            row_ids = np.unique(np.asarray(row_ids, dtype=np.uint32))
+            highs = row_ids >> 16
+            bounds = np.flatnonzero(np.diff(highs)) + 1
+            for chunk in np.split(row_ids, bounds):
+                if len(chunk):
+                    array = (chunk & 0xFFFF).astype(np.uint16)
+                    self.containers[int(chunk[0] >> 16)] = \
+                        array if len(array) <= ARRAY_MAX else _to_bitset(array)
+
+    def add(self, row_id):
+        high, low = row_id >> 16, row_id & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = np.array([low], dtype=np.uint16)
+        elif _is_bitset(container):
+            container[low >> 6] |= np.uint64(1) << np.uint64(low & 63)
+        else:
+            n = np.searchsorted(container, low)
+            if n < len(container) and container[n] == low:
+                return
+            container = np.insert(container, n, low)
+            self.containers[high] = container if len(container) <= ARRAY_MAX else _to_bitset(container)
+
+    def discard(self, row_id):
+        high, low = row_id >> 16, row_id & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            return
+        if _is_bitset(container):
+            # left as a bitset until the bitmap is saved
+            container[low >> 6] &= ~(np.uint64(1) << np.uint64(low & 63))
+        else:
+            n = np.searchsorted(container, low)
+            if n < len(container) and container[n] == low:
+                container = np.delete(container, n)
+                if len(container):
+                    self.containers[high] = container
+                else:
+                    del self.containers[high]
+
+    def __contains__(self, row_id):
+        high, low = row_id >> 16, row_id & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            return False
+        if _is_bitset(container):
+            return bool((container[low >> 6] >> np.uint64(low & 63)) & np.uint64(1))
+        n = np.searchsorted(container, low)
+        return n < len(container) and container[n] == low
+
+    def __len__(self):
+        return sum(len(_to_array(c)) if _is_bitset(c) else len(c)
+                   for c in self.containers.values())
+
+    def __bool__(self):
+        return any(len(c) if not _is_bitset(c) else c.any() for c in self.containers.values())
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and np.array_equal(self.to_array(), other.to_array())
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def __repr__(self):
+        return 'Bitmap({})'.format(self.to_array().tolist())
+
+    def copy(self):
+        new = Bitmap()
+        new.containers = {high: c.copy() for high, c in self.containers.items()}
+        return new
+
+    def to_array(self):
+        "sorted uint32 numpy array of the row ids"
+        chunks = [(np.uint32(high) << np.uint32(16)) |
+                  (_to_array(c) if _is_bitset(c) else c).astype(np.uint32)
+                  for high, c in sorted(self.containers.items())]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint32)
+
+    def __and__(self, other):
+        new = Bitmap()
+        for high in self.containers.keys() & other.containers.keys():
+            a, b = self.containers[high], other.containers[high]
+            if _is_bitset(a) and _is_bitset(b):
+                c = _shrink(a & b)
+            elif _is_bitset(a):
+                c = b[_has(a, b)]
+            elif _is_bitset(b):
+                c = a[_has(b, a)]
+            else:
+                c = np.intersect1d(a, b, assume_unique=True)
+            if len(c) and (not _is_bitset(c) or c.any()):
+                new.containers[high] = c
+        return new
+
+    def __or__(self, other):
+        new = Bitmap()
+        for high in self.containers.keys() | other.containers.keys():
+            a, b = self.containers.get(high), other.containers.get(high)
+            if a is None or b is None:
+                c = (a if b is None else b).copy()
+            elif _is_bitset(a) and _is_bitset(b):
+                c = a | b
+            elif _is_bitset(a) or _is_bitset(b):
+                c, array = (a.copy(), b) if _is_bitset(a) else (b.copy(), a)
+                np.bitwise_or.at(c, array >> 6, np.uint64(1) << (array & 63).astype(np.uint64))
+            else:
+                c = np.union1d(a, b)
+                if len(c) > ARRAY_MAX:
+                    c = _to_bitset(c)
+            new.containers[high] = c
+        return new
+
+    def __sub__(self, other):
+        new = Bitmap()
+        for high, a in self.containers.items():
+            b = other.containers.get(high)
+            if b is None:
+                c = a.copy()
+            elif _is_bitset(a) and _is_bitset(b):
+                c = _shrink(a & ~b)
+            elif _is_bitset(a):
+                c = a.copy()
+                np.bitwise_and.at(c, b >> 6, ~(np.uint64(1) << (b & 63).astype(np.uint64)))
+                c = _shrink(c)
+            elif _is_bitset(b):
+                c = a[~_has(b, a)]
+            else:
+                c = np.setdiff1d(a, b, assume_unique=True)
+            if len(c) and (not _is_bitset(c) or c.any()):
+                new.containers[high] = c
+        return new
+
+    def tobytes(self):
+        "serialize the bitmap, see frombytes"
+        parts = []
+        for high, c in sorted(self.containers.items()):
+            c = _shrink(c)
+            if not len(c):
+                continue
+            if _is_bitset(c):
+                parts.append(CONTAINER.pack(high, BITSET, BITSET_WORDS))
+            else:
+                parts.append(CONTAINER.pack(high, ARRAY, len(c)))
+            parts.append(c.astype('<u'+str(c.itemsize)).tobytes())
+        return HEADER.pack(len(parts) // 2) + b''.join(parts)
+
+    @classmethod
+    def frombytes(cls, buff, offset=0):
+        "return the bitmap serialized in buff at offset, and the offset after it"
+        new = cls()
+        n, = HEADER.unpack_from(buff, offset)
+        offset += HEADER.size
+        for _ in range(n):
+            high, kind, count = CONTAINER.unpack_from(buff, offset)
+            offset += CONTAINER.size
+            dtype = np.dtype('<u8') if kind == BITSET else np.dtype('<u2')
+            c = np.frombuffer(buff, dtype=dtype, count=count, offset=offset)
+            new.containers[high] = c.astype(np.uint64 if kind == BITSET else np.uint16)
+            offset += count*dtype.itemsize
+        return new, offset
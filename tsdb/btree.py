@@ -0,0 +1,364 @@
+"""Page based B+tree used by the tree indexes of the persistentdb implementation
+
+The file is a sequence of fixed size pages. Page 0 is the header
+
+    [magic : 8 bytes][page size : 4][root page : 4][page count : 4][entry count : 8]
+    [key width : 2][value width : 2]
+
+and every other page holds one node. Entries are (key, row id) pairs, with
+the keys stored as `key width` doubles and the row ids as uint32, so one key
+can map to many rows and every entry is unique. Leaves may also store
+`value width` doubles with each entry. Leaves are
+
+    [1 : 1 byte][entry count : 2][next leaf : 4] ([key][row id : 4][values]) * n
+
+and internal nodes
+
+    [2 : 1 byte][separator count : 2][first child : 4] ([key][row id : 4][child : 4]) * n
+
+where everything in a child is at least the separator before it, and less
+than the one after it.
+
+Keys are floats when the key width is 1, and tuples of floats otherwise,
+which compare field by field, so a tree over several fields can be searched
+by a prefix of them.
+"""
+
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import numpy as np
+
+MAGIC = b'TSBTREE3'
+FILE_HEADER = struct.Struct('<8sIIIQHH') # magic, page size, root, page count, entry count, key and value widths
+NODE_HEADER = struct.Struct('<BHi') # node type, number of keys, next leaf / first child
+LEAF = 1
+INTERNAL = 2
+PAGE_SIZE = 4096
+DEFAULT_CACHE_SIZE = 4 * 1024 * 1024 # bytes
+
+def _entry_dtype(key_width, value_width, leaf):
+    "helper function to return the numpy dtype of the entries of a node"
+    fields = [('key', '<f8') if key_width == 1 else ('key', '<f8', (key_width,)), ('row', '<u4')]
+    if not leaf:
+        fields.append(('child', '<i4'))
+    elif value_width:
+        fields.append(('values', '<f8', (value_width,)))
+    return np.dtype(fields)
+
+class _Node:
+    """
+    in memory copy of a page of the tree. Its keys are the (key, row id)
+    entries, or (key, row id, values) in the leaves of a tree with values
+    """
+    __slots__ = ('page', 'leaf', 'keys', 'children', 'next')
+
+    def __init__(self, page, leaf, keys=None, children=None, next=-1):
+        self.page = page
+        self.leaf = leaf
+        self.keys = keys if keys is not None else []
+        self.children = children if children is not None else []
+        self.next = next
+
+    def encode(self, page_size, dtype):
+        page = bytearray(page_size)
+        first = self.next if self.leaf else self.children[0]
+        NODE_HEADER.pack_into(page, 0, LEAF if self.leaf else INTERNAL, len(self.keys), first)
+        entries = np.zeros(len(self.keys), dtype=dtype)
+        if self.keys:
+            columns = list(zip(*self.keys))
+            entries['key'], entries['row'] = columns[0], columns[1]
+            if len(columns) > 2:
+                entries['values'] = columns[2]
+            if not self.leaf:
+                entries['child'] = self.children[1:]
+        data = entries.tobytes()
+        page[NODE_HEADER.size:NODE_HEADER.size+len(data)] = data
+        return page
+
+    @classmethod
+    def decode(cls, page_no, page, leaf_dtype, internal_dtype):
+        kind, n, first = NODE_HEADER.unpack_from(page, 0)
+        leaf = kind == LEAF
+        entries = np.frombuffer(page, dtype=leaf_dtype if leaf else internal_dtype,
+                                count=n, offset=NODE_HEADER.size)
+        keys = entries['key'].tolist()
+        if entries['key'].ndim > 1:
+            keys = [tuple(key) for key in keys]
+        columns = [keys, entries['row'].tolist()]
+        if leaf and 'values' in entries.dtype.names:
+            columns.append([tuple(values) for values in entries['values'].tolist()])
+        keys = list(zip(*columns))
+        if leaf:
+            return cls(page_no, leaf, keys, next=first)
+        return cls(page_no, leaf, keys, [first] + entries['child'].tolist())
+
+
+class BPlusTree:
+    """
+    B+tree of (key, row id) entries in a page file, read through a bounded
+    LRU cache of nodes.
+
+    Changes are made to the cached nodes, which are written back to their
+    pages when they are evicted, or by flush(). Deletes are lazy: entries are
+    removed from their leaf, but nodes are not merged, so a tree that shrank
+    a lot keeps its pages until it is rebuilt.
+
+    key_width and value_width are the number of doubles in a key, and
+    stored with each entry; they are read back from an existing file.
+
+    Attributes
+    ----------
+    hits, misses :
+        node lookups served from the cache, and read from the file
+    """
+    def __init__(self, filename, cache_size=DEFAULT_CACHE_SIZE, page_size=PAGE_SIZE,
+                 key_width=1, value_width=0):
+        self.filename = filename
+        self.max_nodes = max(16, cache_size // page_size)
+        self.cache = OrderedDict() # page number: _Node, oldest first
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0:
+            self.fd = open(self.filename, 'w+b', buffering=0)
+            self.page_size = page_size
+            self.key_width = key_width
+            self.value_width = value_width
+            self._set_dtypes()
+            self.n_pages = 1
+            self.n_entries = 0
+            self.root = self._new_node(leaf=True).page
+            self.flush()
+        else:
+            self.fd = open(self.filename, 'r+b', buffering=0)
+            magic, self.page_size, self.root, self.n_pages, self.n_entries, \
+                self.key_width, self.value_width = \
+                FILE_HEADER.unpack(os.pread(self.fd.fileno(), FILE_HEADER.size, 0))
+            if magic != MAGIC:
+                raise ValueError("'{}' is not a B+tree file".format(self.filename))
+            self._set_dtypes()
+
+    def _set_dtypes(self):
+        self.leaf_dtype = _entry_dtype(self.key_width, self.value_width, leaf=True)
+        self.internal_dtype = _entry_dtype(self.key_width, self.value_width, leaf=False)
+        self.leaf_capacity = (self.page_size - NODE_HEADER.size) // self.leaf_dtype.itemsize
+        self.internal_capacity = (self.page_size - NODE_HEADER.size) // self.internal_dtype.itemsize
+        if self.leaf_capacity < 3 or self.internal_capacity < 3:
+            raise ValueError("pages of {} bytes are too small for the entries".format(self.page_size))
+
+    @staticmethod
+    def is_btree(filename):
+        "whether filename starts like a B+tree file of this version"
+        with open(filename, 'rb') as fd:
+            return fd.read(len(MAGIC)) == MAGIC
+
+    def __len__(self):
+        return self.n_entries
+
+    def _key(self, key):
+        "helper function to return a key as it is stored"
+        if self.key_width == 1:
+            return float(key)
+        key = tuple(float(k) for k in key)
+        if len(key) != self.key_width:
+            raise ValueError("keys of this tree have {} fields".format(self.key_width))
+        return key
+
+    def _bound(self, bound):
+        "helper function to return a range bound, a key or a prefix of one, as it is compared"
+        if bound is None or self.key_width == 1:
+            return None if bound is None else float(bound)
+        if not isinstance(bound, tuple):
+            bound = (bound,)
+        return tuple(float(k) for k in bound)
+
+    def _new_node(self, leaf, keys=None, children=None, next=-1):
+        node = _Node(self.n_pages, leaf, keys, children, next)
+        self.n_pages += 1
+        self._mark_dirty(node)
+        return node
+
+    def _node(self, page_no):
+        "helper function to return a node, reading its page in on a miss"
+        node = self.cache.get(page_no)
+        if node is not None:
+            self.hits += 1
+            self.cache.move_to_end(page_no)
+            return node
+        self.misses += 1
+        page = os.pread(self.fd.fileno(), self.page_size, page_no*self.page_size)
+        node = _Node.decode(page_no, page, self.leaf_dtype, self.internal_dtype)
+        self.cache[page_no] = node
+        self._evict()
+        return node
+
+    def _mark_dirty(self, node):
+        "helper function to call after a node is changed"
+        self.cache[node.page] = node
+        self.cache.move_to_end(node.page)
+        self.dirty.add(node.page)
+        self._evict()
+
+    def _evict(self):
+        while len(self.cache) > self.max_nodes:
+            page_no, node = self.cache.popitem(last=False)
+            if page_no in self.dirty:
+                self._write_node(node)
+
+    def _write_node(self, node):
+        dtype = self.leaf_dtype if node.leaf else self.internal_dtype
+        os.pwrite(self.fd.fileno(), node.encode(self.page_size, dtype), node.page*self.page_size)
+        self.dirty.discard(node.page)
+
+    def flush(self, sync=False):
+        "write back the changed nodes and the header, and fsync if sync"
+        for page_no in sorted(self.dirty):
+            self._write_node(self.cache[page_no])
+        header = FILE_HEADER.pack(MAGIC, self.page_size, self.root, self.n_pages, self.n_entries,
+                                  self.key_width, self.value_width)
+        os.pwrite(self.fd.fileno(), header, 0)
+        if sync:
+            os.fsync(self.fd.fileno())
+
+    def close(self):
+        if not self.fd.closed:
+            self.flush()
+            self.fd.close()
+
+    def _find_leaf(self, entry, path=None):
+        "helper function to descend to the leaf where entry belongs"
+        node = self._node(self.root)
+        while not node.leaf:
+            n = bisect_right(node.keys, entry)
+            if path is not None:
+                path.append((node, n))
+            node = self._node(node.children[n])
+        return node
+
+    def insert(self, key, row, values=None):
+        """
+        insert the entry (key, row), with its values in a tree that stores
+        some, return whether it was new
+        """
+        entry = (self._key(key), int(row))
+        path = []
+        node = self._find_leaf(entry, path)
+        # (key, row) sorts before any (key, row, values)
+        n = bisect_left(node.keys, entry)
+        if n < len(node.keys) and node.keys[n][:2] == entry:
+            return False
+        if self.value_width:
+            values = tuple(float(v) for v in values)
+            if len(values) != self.value_width:
+                raise ValueError("entries of this tree have {} values".format(self.value_width))
+            node.keys.insert(n, entry + (values,))
+        else:
+            node.keys.insert(n, entry)
+        self.n_entries += 1
+        self._mark_dirty(node)
+
+        # split the nodes that overflowed, up to the root
+        while len(node.keys) > (self.leaf_capacity if node.leaf else self.internal_capacity):
+            separator, right = self._split(node)
+            if not path:
+                self.root = self._new_node(False, [separator], [node.page, right.page]).page
+                break
+            parent, n = path.pop()
+            parent.keys.insert(n, separator)
+            parent.children.insert(n+1, right.page)
+            self._mark_dirty(parent)
+            node = parent
+        return True
+
+    def _split(self, node):
+        """
+        helper function to move the upper half of node to a new node on its
+        right, return the separator between them and the new node
+        """
+        mid = len(node.keys) // 2
+        separator = node.keys[mid][:2]
+        if node.leaf:
+            right = self._new_node(True, node.keys[mid:], next=node.next)
+            node.next = right.page
+        else:
+            # the separator moves up, out of both halves
+            right = self._new_node(False, node.keys[mid+1:], node.children[mid+1:])
+            node.children = node.children[:mid+1]
+        node.keys = node.keys[:mid]
+        self._mark_dirty(node)
+        return separator, right
+
+    def remove(self, key, row):
+        "remove the entry (key, row), return whether it was there"
+        entry = (self._key(key), int(row))
+        node = self._find_leaf(entry)
+        n = bisect_left(node.keys, entry)
+        if n == len(node.keys) or node.keys[n][:2] != entry:
+            return False
+        del node.keys[n]
+        self.n_entries -= 1
+        self._mark_dirty(node)
+        return True
+
+    def _leftmost_leaf(self):
+        node = self._node(self.root)
+        while not node.leaf:
+            node = self._node(node.children[0])
+        return node
+
+    def items(self, start=None):
+        """
+        generator over the entries in order, from the first one with a key
+        of at least start (or a prefix of a key), or from the first one if None
+        """
+        if start is None:
+            node, n = self._leftmost_leaf(), 0
+        else:
+            # -1 sorts before every row id, and a prefix before its keys
+            entry = (self._bound(start), -1)
+            node = self._find_leaf(entry)
+            n = bisect_left(node.keys, entry)
+        while True:
+            # follow the links between leaves, skipping the emptied ones
+            yield from node.keys[n:]
+            if node.next < 0:
+                return
+            node, n = self._node(node.next), 0
+
+    def reversed_items(self):
+        "generator over the entries in reverse order, from the last one"
+        # leaves are only linked forwards, so walk down the tree from the right
+        def walk(page_no):
+            node = self._node(page_no)
+            if node.leaf:
+                yield from reversed(node.keys)
+            else:
+                for child in reversed(node.children):
+                    yield from walk(child)
+        yield from walk(self.root)
+
+    def scan(self, low=None, high=None, include_low=True, include_high=True):
+        """
+        generator over the entries with keys between low and high, None
+        meaning unbounded. In a tree over several fields the bounds can be
+        prefixes of keys, which are then compared on their first fields.
+        """
+        low, high = self._bound(low), self._bound(high)
+        cut = (lambda key, bound: key) if self.key_width == 1 else \
+              (lambda key, bound: key[:len(bound)])
+        for entry in self.items(low):
+            key = entry[0]
+            if high is not None:
+                head = cut(key, high)
+                if head > high or (head == high and not include_high):
+                    return
+            if low is not None and not include_low and cut(key, low) == low:
+                continue
+            yield entry
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        "sorted uint32 array of the rows with keys between low and high, see scan"
+        rows = [entry[1] for entry in self.scan(low, high, include_low, include_high)]
+        return np.unique(np.array(rows, dtype=np.uint32))
@@ -0,0 +1,167 @@
+"""A page cache shared by the heap files of the persistentdb implementation
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+PAGE_SIZE = 4096
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024 # bytes
+
+class BufferPool:
+    """
+    Bounded cache of fixed size pages of the heap files, with LRU eviction.
+
+    Heap files register their file descriptor and then read and write through
+    the pool instead of the file. With `write_back` set, writes only change
+    the cached pages, which go to disk when they are evicted or by flush (on
+    a checkpoint or when the file is closed). Otherwise writes go through to
+    the file straight away and the pool is only a read cache.
+
+    With a write ahead log attached (see attach_wal), every page remembers
+    the lsn of the last log record appended before it was changed, and the
+    log is made durable up to it before the page is written to disk.
+
+    Attributes
+    ----------
+    hits, misses :
+        page lookups served from the cache, and read from disk
+    evictions :
+        pages dropped to stay within the memory budget
+    writebacks :
+        dirty pages written to disk
+    """
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, page_size=PAGE_SIZE, write_back=True):
+        self.page_size = page_size
+        self.max_pages = max(1, cache_size // page_size)
+        self.write_back = write_back
+        self.pages = OrderedDict() # (file_id, page_no): bytearray, oldest first
+        self.dirty = set()
+        self.page_lsn = {} # (file_id, page_no): lsn the dirty page depends on
+        self.wal = None
+        self.files = {} # file_id: [fd, size]
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def attach_wal(self, wal):
+        "write no page to disk before the log records it depends on"
+        self.wal = wal
+
+    def register(self, fd, size):
+        "start caching an open file of `size` bytes, return its file id"
+        with self._lock:
+            file_id = self._next_id
+            self._next_id += 1
+            self.files[file_id] = [fd, size]
+            return file_id
+
+    def unregister(self, file_id):
+        "write back and drop the pages of a file, before it is closed"
+        with self._lock:
+            self.flush(file_id)
+            for key in [key for key in self.pages if key[0] == file_id]:
+                del self.pages[key]
+                self.page_lsn.pop(key, None)
+            del self.files[file_id]
+
+    def _page(self, file_id, page_no, load=True):
+        "helper function to return a cached page, reading it in on a miss"
+        key = (file_id, page_no)
+        page = self.pages.get(key)
+        if page is not None:
+            self.hits += 1
+            self.pages.move_to_end(key)
+            return page
+        self.misses += 1
+        page = bytearray(self.page_size)
+        if load:
+            fd = self.files[file_id][0]
+            data = os.pread(fd.fileno(), self.page_size, page_no*self.page_size)
+            page[:len(data)] = data
+        self.pages[key] = page
+        self._evict()
+        return page
+
+    def _evict(self):
+        while len(self.pages) > self.max_pages:
+            key, page = self.pages.popitem(last=False)
+            self.evictions += 1
+            if key in self.dirty:
+                self._write_page(key, page)
+
+    def _write_page(self, key, page):
+        "helper function to write a dirty page, up to the end of its file"
+        file_id, page_no = key
+        if key in self.page_lsn:
+            # write ahead: the log goes first
+            self.wal.sync_to(self.page_lsn.pop(key))
+        fd, size = self.files[file_id]
+        start = page_no*self.page_size
+        os.pwrite(fd.fileno(), bytes(page[:min(self.page_size, size - start)]), start)
+        self.dirty.discard(key)
+        self.writebacks += 1
+
+    def read(self, file_id, offset, length):
+        "return `length` bytes of a file from offset"
+        with self._lock:
+            chunks = []
+            pos, end = offset, offset + length
+            while pos < end:
+                page_no, start = divmod(pos, self.page_size)
+                n = min(self.page_size - start, end - pos)
+                chunks.append(self._page(file_id, page_no)[start:start+n])
+                pos += n
+            return b''.join(chunks)
+
+    def write(self, file_id, offset, data):
+        "write the bytes of data to a file at offset"
+        with self._lock:
+            old_size = self.files[file_id][1]
+            self.files[file_id][1] = max(old_size, offset + len(data))
+            view = memoryview(data)
+            lsn = self.wal.last_lsn if self.wal is not None else None
+            pos, end = offset, offset + len(data)
+            while pos < end:
+                page_no, start = divmod(pos, self.page_size)
+                page_start = page_no*self.page_size
+                n = min(self.page_size - start, end - pos)
+                # no need to read in the page if the write covers all of it
+                # that is on disk
+                load = page_start < old_size and \
+                       not (start == 0 and pos + n >= min(old_size, page_start + self.page_size))
+                page = self._page(file_id, page_no, load)
+                page[start:start+n] = view[pos-offset:pos-offset+n]
+                if self.write_back:
+                    self.dirty.add((file_id, page_no))
+                    if lsn is not None:
+                        self.page_lsn[(file_id, page_no)] = lsn
+                pos += n
+            if not self.write_back:
+                if lsn is not None:
+                    self.wal.sync_to(lsn)
+                os.pwrite(self.files[file_id][0].fileno(), data, offset)
+
+    def flush(self, file_id=None):
+        "write back the dirty pages of a file, or of every file"
+        with self._lock:
+            for key in sorted(self.dirty):
+                if file_id is None or key[0] == file_id:
+                    self._write_page(key, self.pages[key])
+
+    def is_dirty(self, file_id):
+        with self._lock:
+            return any(key[0] == file_id for key in self.dirty)
+
+    def stats(self):
+        "dictionary of the cache counters"
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'writebacks': self.writebacks,
+                'pages': len(self.pages),
+                'dirty': len(self.dirty),
+                'max_pages': self.max_pages}
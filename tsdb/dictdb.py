@@ -2,11 +2,14 @@
 """
 from .tsdb_error import TSDBStatus
 from .baseclasses import BaseDB
-from collections import defaultdict
-from operator import and_
-from functools import reduce
+from .aggregates import parse_aggregate, check_numeric, aggregate_rows, aggregate_groups
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain
+import heapq
+import numpy as np
 import operator
 import numbers
+import time
 
 # this dictionary will help you in writing a generic select operation
 OPMAP = {
@@ -18,6 +21,98 @@ OPMAP = {
     '>=': operator.ge
 }
 
+class SortedIndex:
+    """
+    In-memory index of a field, keeping its distinct values in a sorted list
+    (searched with bisect) next to the set of primary keys of every value,
+    so that it answers range predicates and iterates in value order.
+
+    Looking up a value returns its set of primary keys, as the dictionaries
+    used before.
+    """
+    def __init__(self):
+        self.values = [] # sorted distinct values
+        self.pks = {} # value: set of primary keys
+        self.n = 0 # primary keys in the index
+
+    def __getitem__(self, value):
+        return self.pks.get(value, set())
+
+    def __len__(self):
+        return self.n
+
+    def add(self, value, pk):
+        if value not in self.pks:
+            insort(self.values, value)
+            self.pks[value] = set()
+        if pk not in self.pks[value]:
+            self.pks[value].add(pk)
+            self.n += 1
+
+    def remove(self, value, pk):
+        "remove pk from the value, raise a KeyError if it is not there"
+        pks = self.pks[value]
+        pks.remove(pk)
+        self.n -= 1
+        if not pks:
+            del self.pks[value]
+            del self.values[bisect_left(self.values, value)]
+
+    def _slice(self, op, value):
+        "helper function to return the sorted values matching an operator other than !="
+        if op == '<':
+            return self.values[:bisect_left(self.values, value)]
+        elif op == '<=':
+            return self.values[:bisect_right(self.values, value)]
+        elif op == '>':
+            return self.values[bisect_right(self.values, value):]
+        elif op == '>=':
+            return self.values[bisect_left(self.values, value):]
+        elif op == '==':
+            return [value] if value in self.pks else []
+        raise ValueError(TSDBStatus.INVALID_OPERATION, "Unknown operator '{}'".format(op))
+
+    def match(self, op, value):
+        "set of the primary keys whose value compares with value by op (a key of OPMAP)"
+        if op == '!=':
+            return set(chain.from_iterable(pks for v, pks in self.pks.items() if v != value))
+        return set(chain.from_iterable(self.pks[v] for v in self._slice(op, value)))
+
+    def estimate(self, op, value):
+        """
+        number of primary keys matching op and value, exact for == and !=,
+        and estimated from the number of distinct values in range otherwise
+        """
+        if op in ('==', '!='):
+            equal = len(self.pks.get(value, ()))
+            return equal if op == '==' else self.n - equal
+        if not self.values:
+            return 0
+        d = len(self.values)
+        if op == '<':
+            in_range = bisect_left(self.values, value)
+        elif op == '<=':
+            in_range = bisect_right(self.values, value)
+        elif op == '>':
+            in_range = d - bisect_right(self.values, value)
+        elif op == '>=':
+            in_range = d - bisect_left(self.values, value)
+        else:
+            raise ValueError(TSDBStatus.INVALID_OPERATION, "Unknown operator '{}'".format(op))
+        return round(self.n * in_range / d)
+
+    def stats(self):
+        "number of 'rows' and 'distinct' values in the index, and its 'min' and 'max' value"
+        return {'rows': self.n, 'distinct': len(self.values),
+                'min': self.values[0] if self.values else None,
+                'max': self.values[-1] if self.values else None}
+
+    def ordered(self, reverse=False):
+        "generator over the primary keys in value order, ties in no given order"
+        for value in (reversed(self.values) if reverse else self.values):
+            yield from self.pks[value]
+
+
 class DictDB(BaseDB):
     """
     A database implementation in a dictionary
@@ -25,7 +120,7 @@ class DictDB(BaseDB):
     Attributes
     ----------
     indexes :
-        a default dict of primary keys and offsets in file of the values
+        a SortedIndex of the primary keys by value for every indexed field
     rows :
         contains the rows of data. Each entry points to a dictionary
     schema :
@@ -59,7 +154,7 @@ class DictDB(BaseDB):
             # later use binary search trees for highcard/numeric
             # bitmaps for lowcard/str_or_factor
             if indexinfo is not None:
-                self.indexes[s] = defaultdict(set)# create an index for every non-None schema
+                self.indexes[s] = SortedIndex()# create an index for every non-None schema
 
     def __getitem__(self,key):
         """Dunder method to get the the values at a given row"""
@@ -83,6 +178,26 @@ class DictDB(BaseDB):
         self.rows[pk]['ts'] = ts
         self.update_indices(pk)
 
+    def insert_many(self, rows):
+        """
+        Given (pk, ts) or (pk, ts, meta) tuples, insert them all. Every row is
+        checked before any is inserted. Returns the primary keys inserted.
+        """
+        rows = [tuple(row) for row in rows]
+        new_pks = set()
+        for row in rows:
+            pk, ts = row[0], row[1]
+            if len(ts) != self.ts_length:
+                raise ValueError(TSDBStatus.INVALID_OPERATION,'TimeSeries is of the wrong length. Should be '+ str(self.ts_length))
+            if pk in self.rows or pk in new_pks:
+                raise ValueError(TSDBStatus.INVALID_KEY,'Duplicate primary key found during insert')
+            new_pks.add(pk)
+        for row in rows:
+            self.insert_ts(row[0], row[1])
+            if len(row) > 2 and row[2] is not None:
+                self.upsert_meta(row[0], row[2])
+        return [row[0] for row in rows]
+
     def delete_ts(self,pk):
         "Given a pk, remove that timeseries from the database"
         if pk not in self.rows:
@@ -99,12 +214,19 @@ class DictDB(BaseDB):
         """
         #DNY written
         # assume meta is a dict, field->values
-        for field, value in meta.items():
-            if field in self.schema:# ignore all fields not in schema
-                if pk not in self.rows:# assert that timeseries already exists
-                    raise ValueError(TSDBStatus.INVALID_KEY,'Primary key not found in database')
-                fieldConvert = self.schema[field]['convert']
-                self.rows[pk][field] = fieldConvert(value)
+        if pk not in self.rows:# assert that timeseries already exists
+            raise ValueError(TSDBStatus.INVALID_KEY,'Primary key not found in database')
+        # every value is converted before the row or its indexes change, so
+        # that a failed conversion leaves them as they were
+        new_values = {field: self.schema[field]['convert'](value)
+                      for field, value in meta.items()
+                      if field in self.schema}# ignore all fields not in schema
+        row = self.rows[pk]
+        for field, value in new_values.items():
+            # the old value leaves the index
+            if field in self.indexes and field in row:
+                self.indexes[field].remove(row[field], pk)
+            row[field] = value
         self.update_indices(pk)
 
     def index_bulk(self, pks=[]):
@@ -119,8 +241,8 @@ class DictDB(BaseDB):
         for field in row:#DNY: eg 'pk' or 'ts', or any entry in self.schema
             v = row[field]
             if self.schema[field]['index'] is not None:
-                idx = self.indexes[field]# idx is a defaultdict(set)
-                idx[v].add(pk)#DNY: 'v' must be hashable
+                idx = self.indexes[field]# idx is a SortedIndex
+                idx.add(v, pk)#DNY: 'v' must be hashable and comparable
 
     def remove_from_indices(self, pk, row):
         "Remove pk from indices after deletion"
@@ -128,8 +250,8 @@ class DictDB(BaseDB):
         for field in row:
             v = row[field]
             if self.schema[field]['index'] is not None:
-                idx = self.indexes[field]# idx is a defaultdict(set)
-                idx[v].remove(pk)#DNY: 'v' must be hashable
+                idx = self.indexes[field]# idx is a SortedIndex
+                idx.remove(v, pk)
 
     #ASK: Helper func
     def _getDataForRows(self,pks_out,fields_to_ret):
@@ -174,38 +296,140 @@ class DictDB(BaseDB):
             Otherwise, the timeseries are returned.
         additional: a dictionary object
             additional computation to perform on the query matches before they're
-            returned. You can sort or limit the number of results that you receive.
+            returned. You can sort ('sort_by'), limit ('limit') and page through
+            ('offset') the results that you receive.
         """
-        pks_out = set(self.rows.keys())
+        return self._select(meta, fields_to_ret, additional)
 
-        for field,criteria in meta.items():
+    def aggregate(self, meta, aggregates, group_by=None, bins=10):
+        """
+        Compute aggregates of the rows matching the criteria of a select, as
+        PersistentDB.aggregate. With no criteria and no group_by, counts and
+        the min and max of indexed fields are read from the indexes.
+        """
+        specs = []
+        for name in aggregates:
+            func, field = parse_aggregate(name)
+            if field is not None and field not in self.schema:
+                raise ValueError(TSDBStatus.INVALID_OPERATION, "Aggregate column not in schema")
+            specs.append((name, func, field))
+        if group_by is not None and group_by not in self.schema:
+            raise ValueError(TSDBStatus.INVALID_OPERATION, "Group by column not in schema")
+
+        answered = {}
+        if not meta and group_by is None:
+            for name, func, field in specs:
+                if field is None:
+                    answered[name] = len(self.rows)
+                elif field in self.indexes and func in ('count', 'min', 'max'):
+                    index = self.indexes[field]
+                    if func == 'count':
+                        answered[name] = len(index)
+                    elif index.values:
+                        check_numeric(name, field, np.array([index.values[0], index.values[-1]]))
+                        answered[name] = index.values[0] if func == 'min' else index.values[-1]
+                    else:
+                        answered[name] = None
+            specs = [spec for spec in specs if spec[0] not in answered]
+            if not specs:
+                return {name: answered[name] for name in aggregates}
+
+        pks = self._select(meta, None, None)[0]
+        fields = set(field for _, _, field in specs if field is not None)
+        if group_by is not None:
+            fields.add(group_by)
+        columns = {}
+        for field in fields:
+            is_set = [field in self.rows[pk] for pk in pks]
+            # rows where the field is not set take the value of another, to keep one type
+            fill = next((self.rows[pk][field] for pk, was_set in zip(pks, is_set) if was_set), 0)
+            values = [self.rows[pk][field] if was_set else fill for pk, was_set in zip(pks, is_set)]
+            # other values, eg timeseries, are kept as objects rather than
+            # unpacked by numpy, and only counted
+            if all(isinstance(value, numbers.Number) for value in values):
+                values = np.array(values)
+            else:
+                values = np.fromiter(values, dtype=object, count=len(values))
+            columns[field] = (values, np.array(is_set, dtype=bool))
+        if group_by is not None:
+            return aggregate_groups(specs, len(pks), columns, group_by, bins)
+        answered.update(aggregate_rows(specs, len(pks), columns, bins))
+        return {name: answered[name] for name in aggregates}
+
+    def explain(self, meta, fields_to_ret, additional):
+        """
+        Run a select, and return how it was planned rather than its results,
+        as PersistentDB.explain. The access of a step is 'index', 'filter'
+        or 'scan'.
+        """
+        plan = {'steps': [], 'ms': {}}
+        start = time.perf_counter()
+        pks_out = self._select(meta, fields_to_ret, additional, plan)[0]
+        plan['rows'] = len(pks_out)
+        plan['ms']['total'] = (time.perf_counter() - start) * 1000
+        return plan
+
+    def index_stats(self):
+        "statistics of every index, by field, see SortedIndex.stats"
+        return {field: index.stats() for field, index in self.indexes.items()}
+
+    def _select(self, meta, fields_to_ret, additional, plan=None):
+        """
+        helper function to run a select, recording its steps and timings in
+        plan if it is a dictionary, see explain()
+        """
+        start = time.perf_counter()
+
+        # the criteria expected to match the fewest rows go first, and
+        # those on fields with no index last
+        criteria = []
+        for field,criterion in meta.items():
             if field in self.schema:
                 fieldConvert = self.schema[field]['convert']
-
-                #ASK: this is a range query. Not sure how to do this with indices with
-                #     current implementation
-                if(isinstance(criteria,dict)):
-                    op,val = list(criteria.items())[0]
-                    matches = [p for p in pks_out if field in self.rows[p] and
-                                    OPMAP[op](self.rows[p][field],fieldConvert(val))]
-                    pks_out = pks_out & set(matches)
-
-                #ASK: this is an exact query
+                if(isinstance(criterion,dict)):
+                    op,val = list(criterion.items())[0]
                 else:
-                    criteria = fieldConvert(criteria) #ASK: convert to the right format
-
-                    #ASK: we have an index for this field
-                    if field in self.indexes:
-                        matches = self.indexes[field][criteria]
-
-                    #ASK: we don't have an index for this field
-                    else:
-                        matches = [p for p in pks_out if field in self.rows[p] and
-                                    self.rows[p][field] == criteria]
-                    pks_out = pks_out & set(matches)
+                    op,val = '==',criterion
+                val = fieldConvert(val) #ASK: convert to the right format
+                if field in self.indexes:
+                    criteria.append((self.indexes[field].estimate(op, val), 'index', field, op, val))
+                else:
+                    criteria.append((len(self.rows), 'scan', field, op, val))
+        criteria.sort(key=lambda criterion: (criterion[1] == 'scan', criterion[0]))
+
+        # once fewer rows are left than a criterion is expected to match,
+        # they are checked one by one, and no rows left ends the search
+        pks_out = None
+        for estimate, access, field, op, val in criteria:
+            if pks_out is not None and not pks_out:
+                break
+            step_start = time.perf_counter()
+            if access == 'index' and (pks_out is None or len(pks_out) >= estimate):
+                matches = self.indexes[field].match(op, val)
+                pks_out = matches if pks_out is None else pks_out & matches
+            else:
+                if pks_out is not None:
+                    access = 'filter'
+                candidates = self.rows if pks_out is None else pks_out
+                pks_out = set(p for p in candidates if field in self.rows[p] and
+                              OPMAP[op](self.rows[p][field], val))
+            if plan is not None:
+                plan['steps'].append({'field': field, 'op': op, 'value': val, 'access': access,
+                                      'estimate': estimate, 'rows': len(pks_out),
+                                      'ms': (time.perf_counter() - step_start) * 1000})
+        if pks_out is None:
+            pks_out = set(self.rows.keys())
+        if plan is not None:
+            plan['ms']['match'] = (time.perf_counter() - start) * 1000
 
         #ASK: decide what to return
-        pks_out = list(pks_out)
+        # only the matches up to offset + limit are put in order
+        offset = 0
+        if additional and 'offset' in additional:
+            offset = int(additional['offset'])
+        limit = None
+        if additional and 'limit' in additional:
+            limit = offset + int(additional['limit'])
         if additional and 'sort_by' in additional:
             # print("Sorting by ",additional['sort_by'][1:]," in direction ",additional['sort_by'][0])
             sortfield = additional['sort_by'][1:]
@@ -213,15 +437,41 @@ class DictDB(BaseDB):
 
             if sortfield not in self.schema:
                 raise ValueError(TSDBStatus.INVALID_OPERATION,"Sort Column not in schema")
+            if sortdir not in ('+', '-'):
+                raise ValueError(TSDBStatus.INVALID_OPERATION,"Illdefined sort order. Must be '+' or '-'")
 
-            if sortdir == '+':
-                pks_out = sorted(pks_out,key=lambda p: self.rows[p][sortfield])
-            elif sortdir == '-':
-                pks_out = sorted(pks_out,key=lambda p: self.rows[p][sortfield],reverse=True)
+            key = lambda p: self.rows[p][sortfield]
+            # walk the index in order until there are enough matches, when
+            # that is expected to read fewer entries than there are matches
+            # to sort. They are assumed to be spread evenly through it
+            if sortfield in self.indexes and limit is not None and \
+               limit * len(self.indexes[sortfield]) < len(pks_out) * len(pks_out):
+                pks_out = self._ordered_matches(self.indexes[sortfield], pks_out, limit, sortdir == '-')
+            elif limit is not None:
+                # keep the first ones in a bounded heap
+                pick = heapq.nlargest if sortdir == '-' else heapq.nsmallest
+                pks_out = pick(limit, pks_out, key=key)
             else:
-                raise ValueError(TSDBStatus.INVALID_OPERATION,"Illdefined sort order. Must be '+' or '-'")
+                pks_out = sorted(pks_out,key=key,reverse=(sortdir == '-'))
+        else:
+            pks_out = list(pks_out)
 
-        if additional and 'limit' in additional:
-            pks_out = pks_out[:int(additional['limit'])]
+        pks_out = pks_out[offset:limit]
 
+        if plan is not None:
+            plan['ms']['sort'] = (time.perf_counter() - start) * 1000 - plan['ms']['match']
         return self._getDataForRows(pks_out,fields_to_ret)
+
+    def _ordered_matches(self, index, pks_out, limit, reverse):
+        "helper function to return the first `limit` of pks_out in the order of a SortedIndex"
+        ordered = []
+        if limit > 0:
+            for pk in index.ordered(reverse):
+                if pk in pks_out:
+                    ordered.append(pk)
+                    if len(ordered) == limit:
+                        return ordered
+        # rows where the field is not set go last
+        seen = set(ordered)
+        ordered += [pk for pk in pks_out if pk not in seen]
+        return ordered[:limit]
@@ -3,10 +3,14 @@
 
 # from .persistentdb import TYPES, TYPE_DEFAULT
 import os
+import mmap
 import struct
 import timeseries
 import json
 import pickle
+import zlib
+import weakref
+import numpy as np
 
 # see https://docs.python.org/3.4/library/struct.html#struct-format-strings
 TYPES = {
@@ -25,7 +29,18 @@ TS_FIELD_LENGTH = 4
 BYTES_PER_NUM = 8
 
 class HeapFile:
-    def __init__(self, heap_file_name):
+    """
+    Unbuffered heap file. If a BufferPool is given, records are read and
+    written through its cached pages instead.
+
+    With a write ahead log attached, a record written straight to the file
+    waits for the log to be durable up to the last record it depends on,
+    the last one appended unless _depends_on() says otherwise. Through a
+    pool, the pool takes care of it.
+    """
+    wal = None
+
+    def __init__(self, heap_file_name, pool=None):
         self.filename = heap_file_name
         if not os.path.exists(self.filename):
             #DNY: buffering=0 only allowed in binary mode, see python docs
@@ -35,13 +50,58 @@ class HeapFile:
         self.readptr = self.fd.tell()
         self.fd.seek(0,2)#DNY: seek the end of the file
         self.writeptr = self.fd.tell()
+        self.pool = pool
+        if self.pool is not None:
+            self.file_id = self.pool.register(self.fd, self.writeptr)
+
+    def _read(self, offset, length):
+        "read length bytes at offset"
+        if self.pool is not None:
+            return self.pool.read(self.file_id, offset, length)
+        # positional, so readers in other threads do not race on the offset
+        return os.pread(self.fd.fileno(), length, offset)
+
+    def _write(self, offset, byteArray):
+        "write byteArray at offset, moving writeptr if the file grew"
+        if self.pool is not None:
+            self.pool.write(self.file_id, offset, byteArray)
+        else:
+            if self.wal is not None:
+                self.wal.sync_to(self._depends_on(offset))
+            os.pwrite(self.fd.fileno(), byteArray, offset)
+        self.writeptr = max(self.writeptr, offset + len(byteArray))
+
+    def _depends_on(self, offset):
+        "helper function to return the lsn of the last log record a write at offset depends on"
+        return self.wal.last_lsn
+
+    def attach_wal(self, wal):
+        "write no record to disk before the log records it depends on"
+        self.wal = wal
+
+    def _flush_pages(self):
+        "write back cached pages, before the file is read around the pool"
+        if self.pool is not None:
+            self.pool.flush(self.file_id)
 
     def close(self):
+        if self.pool is not None:
+            self.pool.unregister(self.file_id)
+            self.pool = None
         self.fd.close()
 
+    def sync(self):
+        "force the records written so far to disk"
+        self._flush_pages()
+        os.fsync(self.fd.fileno())
+
+    def data_files(self):
+        "list of the files holding the records, swapped in by a vacuum"
+        return [self.filename]
+
 class MetaHeapFile(HeapFile):
-    def __init__(self, heap_file_name, schema):
-        super().__init__(heap_file_name)
+    def __init__(self, heap_file_name, schema, pool=None):
+        super().__init__(heap_file_name, pool)
         # if metaheap is new, write it to disk
         if not os.path.exists(heap_file_name+'_metadata.met'):
             self._create_compression_string(schema)
@@ -56,6 +116,22 @@ class MetaHeapFile(HeapFile):
             with open(heap_file_name+'_metadata.met','rb',buffering=0) as fd:
                 self.compression_string, self.fields, self.fieldsDefaultValues, self.byteArrayLength = pickle.load(fd)
             # print("old metaheap meta values loaded from disk")
+        self._create_record_dtype()
+
+    def _create_record_dtype(self):
+        """
+        numpy description of one packed record, so that whole columns can be
+        read out of the heap with a single memory map. The offset of each
+        field follows the native alignment used by struct.
+        """
+        offsets = []
+        for n, code in enumerate(self.compression_string):
+            offsets.append(struct.calcsize(self.compression_string[:n+1])
+                           - struct.calcsize(code))
+        self.record_dtype = np.dtype({'names': self.fields,
+                                      'formats': list(self.compression_string),
+                                      'offsets': offsets,
+                                      'itemsize': self.byteArrayLength})
 
     def _create_compression_string(self, schema):
         fieldList = sorted(list(schema.keys()))
@@ -89,61 +165,510 @@ class MetaHeapFile(HeapFile):
         self.check_byteArray(byteArray)
         if pk_offset is None:
             pk_offset = self.writeptr
-        self.fd.seek(pk_offset)
-        self.fd.write(byteArray)
-        # DNY: seek the end of the file in case new element written
-        self.fd.seek(0,2)
-        self.writeptr = self.fd.tell()
+        self._write(pk_offset, byteArray)
         return pk_offset
 
+    def encode_and_write_many(self, metas):
+        "appends many metadata lists with a single write, return their offsets"
+        byteArray = b''.join(struct.pack(self.compression_string,*meta) for meta in metas)
+        assert(len(byteArray) == len(metas)*self.byteArrayLength)
+        start = self.writeptr
+        self._write(start, byteArray)
+        return [start + n*self.byteArrayLength for n in range(len(metas))]
+
     def read_and_return_meta(self,pk_offset):
-        self.fd.seek(pk_offset)
-        buff = self.fd.read(self.byteArrayLength)
+        buff = self._read(pk_offset, self.byteArrayLength)
         #check that reading and writing worked
         # print(self.metaFields)
         # print(struct.unpack(self.compression_string,buff))
         return list(struct.unpack(self.compression_string,buff))
 
+    def read_fields(self, pk_offset, fields):
+        "read the given fields of the record at pk_offset, as a dictionary"
+        meta = struct.unpack(self.compression_string, self._read(pk_offset, self.byteArrayLength))
+        return {field: meta[self.fields.index(field)] for field in fields}
+
+    def read_columns(self, fields, pk_offsets):
+        """
+        read the given fields of the records at pk_offsets
+
+        Returns a dictionary of field: numpy array, in the order of pk_offsets
+        """
+        rows = np.asarray(pk_offsets, dtype=np.int64) // self.byteArrayLength
+        if self.writeptr == 0:
+            return {f: np.zeros(0, dtype=self.record_dtype[f]) for f in fields}
+        self._flush_pages()
+        records = np.memmap(self.filename, dtype=self.record_dtype, mode='r',
+                            shape=(self.writeptr // self.byteArrayLength,))
+        selected = records[rows]
+        return {f: np.array(selected[f]) for f in fields}
+
+class ColumnarMetaHeapFile(MetaHeapFile):
+    """
+    Metaheap stored column by column: every field (and every *_set flag) has
+    its own file of fixed width numpy values, built from the same TYPES
+    mapping as the packed records of MetaHeapFile.
+
+    It has the same interface as MetaHeapFile, except that offsets are row
+    numbers rather than byte offsets. Projections and sorts only read the
+    columns they need.
+    """
+    def __init__(self, heap_file_name, schema, pool=None):
+        self.filename = heap_file_name
+        # if metaheap is new, write it to disk
+        if not os.path.exists(heap_file_name+'_columns.met'):
+            self._create_compression_string(schema)
+            with open(heap_file_name+'_columns.met','xb',buffering=0) as fd:
+                pickle.dump((self.compression_string,
+                             self.fields,
+                             self.fieldsDefaultValues), fd)
+        # otherwise load it
+        else:
+            with open(heap_file_name+'_columns.met','rb',buffering=0) as fd:
+                self.compression_string, self.fields, self.fieldsDefaultValues = pickle.load(fd)
+        self.dtypes = [np.dtype(code) for code in self.compression_string]
+        # one unbuffered file per column
+        self.columns = [HeapFile(self._column_name(field), pool) for field in self.fields]
+        # DNY: row count is the shortest column, in case a write was cut short
+        self.writeptr = min(col.writeptr // dtype.itemsize
+                            for col, dtype in zip(self.columns, self.dtypes))
+
+    def _column_name(self, field):
+        return self.filename+'_'+field+'.col'
+
+    def encode_and_write_meta(self, meta, pk_offset=None):
+        "takes metadata and writes to the column files, return the row written"
+        assert(len(meta) == len(self.fields))
+        if pk_offset is None:
+            pk_offset = self.writeptr
+        for col, dtype, value in zip(self.columns, self.dtypes, meta):
+            col._write(pk_offset * dtype.itemsize, np.array([value], dtype=dtype).tobytes())
+        self.writeptr = max(self.writeptr, pk_offset + 1)
+        return pk_offset
+
+    def encode_and_write_many(self, metas):
+        "appends many metadata lists with one write per column, return their rows"
+        start = self.writeptr
+        for n, (col, dtype) in enumerate(zip(self.columns, self.dtypes)):
+            col._write(start * dtype.itemsize,
+                       np.array([meta[n] for meta in metas], dtype=dtype).tobytes())
+        self.writeptr = start + len(metas)
+        return list(range(start, self.writeptr))
+
+    def read_and_return_meta(self, pk_offset):
+        meta = []
+        for col, dtype in zip(self.columns, self.dtypes):
+            meta.append(np.frombuffer(col._read(pk_offset * dtype.itemsize, dtype.itemsize),
+                                      dtype=dtype)[0].item())
+        return meta
+
+    def read_fields(self, pk_offset, fields):
+        "read the given fields of the row at pk_offset, one column file each"
+        out = {}
+        for field in fields:
+            n = self.fields.index(field)
+            dtype = self.dtypes[n]
+            out[field] = np.frombuffer(self.columns[n]._read(pk_offset * dtype.itemsize, dtype.itemsize),
+                                       dtype=dtype)[0].item()
+        return out
+
+    def read_columns(self, fields, pk_offsets):
+        """
+        read the given fields of the rows at pk_offsets, one column file each
+
+        Returns a dictionary of field: numpy array, in the order of pk_offsets
+        """
+        rows = np.asarray(pk_offsets, dtype=np.int64)
+        out = {}
+        for field in fields:
+            n = self.fields.index(field)
+            dtype = self.dtypes[n]
+            if self.writeptr == 0:
+                out[field] = np.zeros(0, dtype=dtype)
+                continue
+            self.columns[n]._flush_pages()
+            column = np.memmap(self._column_name(field), dtype=dtype,
+                               mode='r', shape=(self.writeptr,))
+            out[field] = np.array(column[rows])
+        return out
+
+    def attach_wal(self, wal):
+        for col in self.columns:
+            col.attach_wal(wal)
+
+    def close(self):
+        for col in self.columns:
+            col.close()
+
+    def sync(self):
+        for col in self.columns:
+            col.sync()
+
+    def data_files(self):
+        return [col.filename for col in self.columns]
+
+# tsheap record codecs, see TSHeapFile. The tag is stored in every record.
+CODECS = {
+    'raw': 0,     # native floats
+    'float32': 1, # single precision floats, lossy
+    'xor': 2,     # each float XORed with the previous one (as in Gorilla),
+                  # bytes shuffled into planes, then zlib
+    'zlib': 3     # zlib of the native floats
+}
+# codec tag, flags, number of points, bytes of times, bytes of values,
+# bytes reserved for the record
+RECORD_HEADER = struct.Struct('<BBxxIIII4x')
+SHARED_TIMES = 1 # flag: the times are the heap's shared time axis, not stored
+
+def _encode_floats(tag, arr):
+    "helper function to encode an array of floats with the codec of tag"
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+    if tag == CODECS['raw']:
+        return arr.tobytes()
+    elif tag == CODECS['float32']:
+        return arr.astype(np.float32).tobytes()
+    elif tag == CODECS['xor']:
+        bits = arr.view(np.uint64)
+        deltas = bits.copy()
+        np.bitwise_xor(bits[1:], bits[:-1], out=deltas[1:])
+        # similar floats share their high bytes, which become runs of zeros
+        return zlib.compress(deltas.view(np.uint8).reshape(-1, 8).T.tobytes())
+    elif tag == CODECS['zlib']:
+        return zlib.compress(arr.tobytes())
+    raise ValueError("Unknown timeseries codec tag {}".format(tag))
+
+def _decode_floats(tag, buff, n):
+    """
+    helper function to decode n floats encoded with the codec of tag. Raw
+    floats are returned as a view into buff, without copying.
+    """
+    if tag == CODECS['raw']:
+        return np.frombuffer(buff, dtype=np.float64, count=n)
+    elif tag == CODECS['float32']:
+        return np.frombuffer(buff, dtype=np.float32, count=n).astype(np.float64)
+    elif tag == CODECS['xor']:
+        planes = np.frombuffer(zlib.decompress(buff), dtype=np.uint8).reshape(8, n)
+        deltas = np.ascontiguousarray(planes.T).view(np.uint64).ravel()
+        return np.bitwise_xor.accumulate(deltas).view(np.float64)
+    elif tag == CODECS['zlib']:
+        return np.frombuffer(zlib.decompress(buff), dtype=np.float64, count=n)
+    raise ValueError("Unknown timeseries codec tag {}".format(tag))
+
+class _Pin:
+    "token of the readers of a TSHeapFile, see TSHeapFile.pin()"
+
 class TSHeapFile(HeapFile):
-    def __init__(self, heap_file_name, ts_length):
-        super().__init__(heap_file_name)
-        if not os.path.exists(heap_file_name+'_metadata.met'):
+    """
+    Heap of timeseries records.
+
+    By default (codec=None) records are fixed length: all the times followed
+    by all the values, as native floats. With a codec, every record starts
+    with a RECORD_HEADER holding its codec tag and number of points, so
+    records may be written with different codecs and series may have any
+    length (ts_length=None, which defaults the codec to 'raw'). The times
+    are left out if they are the start of the shared time axis of the heap:
+    the times of the first series written, saved in the heap metadata.
+    Records are then variable length extents, padded to 8 bytes.
+
+    If `use_mmap` is set, reads are served from a read-only memory map of the
+    file and the returned TimeSeries wrap `np.frombuffer` views straight into
+    it, so no bytes are copied or unpacked. These views are read-only. With a
+    BufferPool, reads are served from its pages instead, wrapped the same way.
+    Values stored with a codec other than 'raw' are decoded into new arrays.
+
+    Slots of deleted timeseries are kept in a free-list (saved next to the
+    heap) and reused by encode_and_write_ts. If `autosave` is unset, the
+    free-list is only saved by sync. For records with a header, the
+    free-list holds (offset, capacity) pairs.
+
+    A freed slot is only reused once nothing can still read it: views into
+    the memory maps, and pins (see pin()) taken before it was freed. Until
+    then it waits in pending_slots. Freeing a slot drops the heap's own
+    reference to the current map, so the next read maps the file again.
+    """
+    def __init__(self, heap_file_name, ts_length, use_mmap=True, autosave=True, pool=None, codec=None):
+        super().__init__(heap_file_name, pool)
+        self.use_mmap = use_mmap
+        self.autosave = autosave
+        self.mmap = None
+        self.mmap_size = 0
+        self._pin = None
+        self._readers = [] # weak references to the maps and pins handed out
+        self.pending_slots = [] # (slot, readers alive when it was freed)
+        self._freed_lsn = {} # offset: last lsn logged when its slot was freed
+        self.free_file = heap_file_name+'_free.met'
+        if os.path.exists(self.free_file):
+            with open(self.free_file,'rb',buffering=0) as fd:
+                self.free_slots = pickle.load(fd)
+        else:
+            self.free_slots = []
+        self.meta_file = heap_file_name+'_metadata.met'
+        if not os.path.exists(self.meta_file):
             self.ts_length = ts_length
-            # DNY: Store as floats, *2 for both times and values
-            self.byteArrayLength = self.ts_length * 2 * BYTES_PER_NUM
-            with open(heap_file_name+'_metadata.met','xb',buffering=0) as fd:
-                pickle.dump((self.ts_length,self.byteArrayLength), fd)
+            if ts_length is None:
+                # variable length series need the record headers
+                self.byteArrayLength = None
+                self.codec = 'raw' if codec is None else codec
+            else:
+                # DNY: Store as floats, *2 for both times and values
+                self.byteArrayLength = self.ts_length * 2 * BYTES_PER_NUM
+                self.codec = codec
+            self.times = None
+            self._save_metadata(new=True)
             # print("new tsheap meta values written to disk")
         # otherwise load it
         else:
-            with open(heap_file_name+'_metadata.met','rb',buffering=0) as fd:
-                self.ts_length, self.byteArrayLength = pickle.load(fd)
+            with open(self.meta_file,'rb',buffering=0) as fd:
+                stored = pickle.load(fd)
+            # heaps written before codecs were added have no codec entries
+            self.ts_length, self.byteArrayLength = stored[:2]
+            self.codec, self.times = stored[2:] if len(stored) > 2 else (None, None)
+            if self.times is not None:
+                self.times.flags.writeable = False
+            if codec != self.codec and codec is not None:
+                if self.codec is None:
+                    raise ValueError("tsheap '{}' has fixed length records, it cannot use codec '{}'".format(heap_file_name, codec))
+                # later records are written with the new codec
+                self.codec = codec
+                self._save_metadata()
             # print("old tsheap meta values loaded from disk")
+        if self.codec is not None and self.codec not in CODECS:
+            raise ValueError("Unknown timeseries codec '{}'. Should be one of {}".format(self.codec, sorted(CODECS)))
 
+    def _save_metadata(self, new=False):
+        "helper function to write the heap metadata, swapping it in atomically"
+        if self.codec is None:
+            stored = (self.ts_length, self.byteArrayLength)
+        else:
+            stored = (self.ts_length, self.byteArrayLength, self.codec, self.times)
+        if new:
+            with open(self.meta_file,'xb',buffering=0) as fd:
+                pickle.dump(stored, fd)
+            return
+        with open(self.meta_file+'.tmp','wb',buffering=0) as fd:
+            pickle.dump(stored, fd)
+            os.fsync(fd.fileno())
+        os.replace(self.meta_file+'.tmp', self.meta_file)
 
-    def encode_and_write_ts(self, ts):
-        ts_items = ts.items
-        times = [float(i[0]) for i in ts_items]
-        values = [float(i[1]) for i in ts_items]
-        byteArray = struct.pack('%sd' % (2*self.ts_length), *times, *values)
+    def _encode_ts(self, ts):
+        "times then values as native floats, the same bytes as struct 'd'"
+        if self.codec is not None:
+            return self._encode_record(ts)
+        byteArray = np.concatenate((np.asarray(ts._times, dtype=np.float64),
+                                    np.asarray(ts._values, dtype=np.float64))).tobytes()
         assert(len(byteArray) == self.byteArrayLength)
+        return byteArray
+
+    def _encode_record(self, ts):
+        """
+        helper function to encode ts with the heap codec and a header. The
+        record is padded to its capacity, its size rounded up to 8
+        """
+        times = np.asarray(ts._times, dtype=np.float64)
+        if self.times is None:
+            # the first series written sets the shared time axis
+            self.times = np.array(times)
+            self.times.flags.writeable = False
+            self._save_metadata()
+        tag = CODECS[self.codec]
+        flags = 0
+        if len(times) <= len(self.times) and np.array_equal(times, self.times[:len(times)]):
+            flags |= SHARED_TIMES
+            times_bytes = b''
+        else:
+            times_bytes = _encode_floats(tag, times)
+        values_bytes = _encode_floats(tag, ts._values)
+        size = RECORD_HEADER.size + len(times_bytes) + len(values_bytes)
+        capacity = -(-size // 8) * 8
+        header = RECORD_HEADER.pack(tag, flags, len(times), len(times_bytes),
+                                    len(values_bytes), capacity)
+        return header + times_bytes + values_bytes + bytes(capacity - size)
+
+    def encode_and_write_many(self, ts_list):
+        """
+        appends many timeseries with a single write, return their offsets.
+        Free slots are left for single inserts, to keep the write contiguous.
+        """
+        return [offset for offset, _ in self.write_extents(ts_list)]
+
+    def write_extents(self, ts_list):
+        "same as encode_and_write_many, but return (offset, size) pairs"
+        records = [self._encode_ts(ts) for ts in ts_list]
+        start = self.writeptr
+        self._write(start, b''.join(records))
+        extents = []
+        for record in records:
+            extents.append((start, len(record)))
+            start += len(record)
+        return extents
+
+    def _save_free_slots(self, sync=False):
+        if not (self.autosave or sync):
+            return
+        # nothing reads the pending slots once the heap is opened again
+        with open(self.free_file+'.tmp','wb',buffering=0) as fd:
+            pickle.dump(self.free_slots + [slot for slot, _ in self.pending_slots], fd)
+            if sync:
+                os.fsync(fd.fileno())
+        os.replace(self.free_file+'.tmp', self.free_file)
+
+    def free(self, offset):
+        "mark the slot at offset as dead, to be reused by a later write"
+        freed = self.free_slots + [slot for slot, _ in self.pending_slots]
+        if self.codec is not None:
+            # the free-list holds (offset, capacity) pairs
+            if any(slot[0] == offset for slot in freed):
+                return
+            capacity = RECORD_HEADER.unpack(self._read(offset, RECORD_HEADER.size))[5]
+            slot = (offset, capacity)
+        else:
+            if offset in freed: # freeing twice would hand it out twice
+                return
+            slot = offset
+        if self.wal is not None:
+            self._freed_lsn[offset] = self.wal.last_lsn
+        # readers from now on can not see the slot, those alive may still
+        self.mmap = None
+        self.mmap_size = 0
+        self._pin = None
+        self._readers = [reader for reader in self._readers if reader() is not None]
+        if self._readers:
+            self.pending_slots.append((slot, list(self._readers)))
+        else:
+            self.free_slots.append(slot)
+        self._save_free_slots()
+
+    def _depends_on(self, offset):
+        """
+        helper function to return the lsn of the last log record a write at
+        offset depends on. Nothing points at a record appended to the heap
+        before the change adding it is logged, but a freed slot is only
+        overwritten once the change that freed it is durable.
+        """
+        return self._freed_lsn.pop(offset, -1)
+
+    def pin(self):
+        """
+        object that keeps the slots in use now from being reused while it
+        is alive, for readers that read a record later (see LazyRow)
+        """
+        if self._pin is None:
+            self._pin = _Pin()
+            self._readers.append(weakref.ref(self._pin))
+        return self._pin
+
+    def _release_pending(self):
+        "helper function to move the pending slots that nothing can read any more to the free-list"
+        if not self.pending_slots:
+            return
+        pending = []
+        for slot, readers in self.pending_slots:
+            if any(reader() is not None for reader in readers):
+                pending.append((slot, readers))
+            else:
+                self.free_slots.append(slot)
+        self.pending_slots = pending
+
+    def sync(self):
+        "force the records and the free-list to disk"
+        super().sync()
+        self._save_free_slots(sync=True)
+
+    def _take_free_slot(self, size):
+        "helper function to pop a free (offset, capacity) slot of at least size bytes"
+        for n in range(len(self.free_slots)-1, -1, -1):
+            if self.free_slots[n][1] >= size:
+                slot = self.free_slots.pop(n)
+                self._save_free_slots()
+                return slot
+        return None
+
+    def encode_and_write_ts(self, ts):
+        return self.write_extent(ts)[0]
+
+    def write_extent(self, ts):
+        """
+        writes ts to a free slot or the end of the heap, return the (offset,
+        size) of the record, which can be read back with a single read
+        """
+        byteArray = self._encode_ts(ts)
 
         # dataBytes = json.dumps(ts.to_json()).encode()
         # lengthFieldBytes = (len(dataBytes)+TS_FIELD_LENGTH).to_bytes(TS_FIELD_LENGTH, byteorder='little')
         # byteArray = lengthFieldBytes + dataBytes
 
-        self.fd.seek(self.writeptr)
-        ts_offset = self.fd.tell()
-        self.fd.write(byteArray)
-        self.fd.seek(0,2)#DNY: seek the end of the file
-        self.writeptr = self.fd.tell()
-        return ts_offset
+        self._release_pending()
+        if self.codec is not None:
+            # reuse the first slot of a deleted timeseries that is big enough
+            slot = self._take_free_slot(len(byteArray))
+            if slot is not None:
+                ts_offset, capacity = slot
+                # keep the capacity of the slot, for when it is freed again
+                fields = RECORD_HEADER.unpack_from(byteArray)
+                self._write(ts_offset, RECORD_HEADER.pack(*fields[:5], capacity)
+                                       + byteArray[RECORD_HEADER.size:])
+                return ts_offset, len(byteArray)
+        elif self.free_slots:
+            # reuse the slot of a deleted timeseries
+            ts_offset = self.free_slots.pop()
+            self._save_free_slots()
+            self._write(ts_offset, byteArray)
+            return ts_offset, len(byteArray)
+
+        ts_offset = self.writeptr
+        self._write(ts_offset, byteArray)
+        return ts_offset, len(byteArray)
 
-    def read_and_decode_ts(self, offset):
-        self.fd.seek(offset)
+    def _remap(self):
+        """
+        map the whole file again, after writes have grown it past the end of
+        the current map. The old map is not closed, as TimeSeries handed out
+        earlier may still point into it; it is released with its last view.
+        """
+        self.mmap = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mmap_size = len(self.mmap)
+        self._readers.append(weakref.ref(self.mmap))
+
+    def _read_view(self, offset, length):
+        "helper function to read bytes, as a view into the memory map if used"
+        if self.pool is None and self.use_mmap:
+            if offset + length > self.mmap_size:
+                self._remap()
+            return memoryview(self.mmap)[offset:offset+length]
+        return self._read(offset, length)
+
+    def read_and_decode_ts(self, offset, size=None):
+        """
+        return the timeseries stored at offset. If the size of the record is
+        given, it is read at once rather than header first.
+        """
+        if self.codec is not None:
+            if size is None:
+                header = self._read_view(offset, RECORD_HEADER.size)
+            else:
+                record = self._read_view(offset, size)
+                header = record[:RECORD_HEADER.size]
+            tag, flags, n, times_len, values_len, _ = RECORD_HEADER.unpack(header)
+            if size is None:
+                buff = self._read_view(offset + RECORD_HEADER.size, times_len + values_len)
+            else:
+                buff = record[RECORD_HEADER.size:RECORD_HEADER.size + times_len + values_len]
+            if flags & SHARED_TIMES:
+                times = self.times[:n]
+            else:
+                times = _decode_floats(tag, buff[:times_len], n)
+            values = _decode_floats(tag, buff[times_len:], n)
+            return timeseries.TimeSeries.from_arrays(times, values)
         # ts_length = int.from_bytes(self.fd.read(TS_FIELD_LENGTH), byteorder='little')
         # self.fd.seek(offset + TS_FIELD_LENGTH)
-        buff = self.fd.read(self.byteArrayLength)
-        items = struct.unpack('%sd' % (2*self.ts_length),buff)
-        return timeseries.TimeSeries(items[:self.ts_length], items[self.ts_length:])
+        arr = np.frombuffer(self._read_view(offset, self.byteArrayLength),
+                            dtype=np.float64, count=2*self.ts_length)
+        return timeseries.TimeSeries.from_arrays(arr[:self.ts_length],
+                                                 arr[self.ts_length:])
         # return timeseries.TimeSeries.from_json(json.loads(buff.decode()))
+
+    def close(self):
+        # views into the map may outlive the heap, so only drop our reference
+        self.mmap = None
+        self.mmap_size = 0
+        super().close()
@@ -2,26 +2,61 @@
 
 Currentlly:
     PKIndex: Primary Key Index
-    TreeIndex: Tree based index done using a AVL tree
+    TreeIndex: Tree based index done using an on-disk B+tree
     BitmapIndex: Bitmap index for low cardinality columns
+    CompositeIndex: Tree index of several columns, which may store others
 """
 
 # from .persistentdb import FILES_DIR
 from .baseclasses import BaseIndex
+from .btree import BPlusTree
+from .bitmap import Bitmap
+from .stats import IndexStats
 from collections import defaultdict
+from functools import reduce
+import operator
+import hashlib
+import mmap
 import pickle
 import os
-import bintrees
+import struct
 import numpy as np
 
-REFRESH_RATE = 50 # rate at which write_ahead log is flushed to disk
+PK_MAGIC = b'TSPKHSH1'
+PK_HEADER = struct.Struct('<8sQQQ32x') # magic, number of slots, number of pks, removed slots
+PK_SLOT = struct.Struct('<QqI4x24s') # hash, offset, length of the pk + 1, the pk or where it is
+PK_SLOT_DTYPE = np.dtype([('hash', '<u8'), ('value', '<i8'), ('length', '<u4'),
+                          ('pad', '<u4'), ('inline', 'S24')])
+PK_VALUE = struct.Struct('<q')
+PK_VALUE_OFFSET = 8
+PK_LENGTH = struct.Struct('<I')
+PK_LENGTH_OFFSET = 16
+PK_KEY_OFFSET = struct.Struct('<Q')
+PK_INLINE = 24 # longest pk stored in its slot, in bytes
+PK_EMPTY = 0
+PK_TOMBSTONE = 0xFFFFFFFF
+PK_MIN_SLOTS = 1024
+PK_MAX_LOAD = 0.7
+
+ROW_ID_RECORD = struct.Struct('<I') # length of the pk
+ROW_ID_OFFSET = struct.Struct('<Q') # where the record of a row id starts
+BITMAP_MAGIC = b'TSBITMP1'
+BITMAP_HEADER = struct.Struct('<8sIQ') # magic, number of values, end of the snapshot
+BITMAP_RECORD = struct.Struct('<iI') # index of the new value or -1 if removed, row id
+SNAPSHOT_MIN = 4096 # changes logged before a bitmap index is saved whole again
+# the OPMAP operators of persistentdb, by number
+BITMAP_OPERATORS = [operator.lt, operator.gt, operator.eq, operator.ne, operator.le, operator.ge]
+OPERATOR_NAMES = ['<', '>', '==', '!=', '<=', '>='] # by operator number
 
 class SimpleIndex(BaseIndex):
     """Very simple index that implements a default dict
     """
-    def __init__(self, fieldName='default', database_name='default'):
+    def __init__(self, fieldName='default', database_name='default', autosave=True):
         self.database_name = database_name
         self.name = fieldName
+        # if unset, changes are only saved to disk by flush()
+        self.autosave = autosave
+        self._dirty = False
         self.filename = 'files'+'/'+database_name+'/'+fieldName+'.idx'
         # DNY: temporary, in memory solution to be removed
         self.dict = defaultdict(set)
@@ -44,399 +79,907 @@ class SimpleIndex(BaseIndex):
         # return set of primary keys that match this fieldValue
         return self.dict[fieldValue]
 
+def _pk_hash(key):
+    "64 bit hash of an encoded pk, the same in every process unlike hash()"
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
 class PKIndex(BaseIndex):
     """
-    PK Index using Pickle serialization and a write ahead log.
-    Essentially a (pk: offset) dictionary with writelog and disk storage.
+    PK Index as a persistent, memory mapped hash table with open addressing.
+    Essentially a (pk: offset) dictionary that is not loaded into memory.
+
+    The file holds a header, a table of fixed size slots probed linearly,
+    and after it the pks too long to fit in their slot. The table is built
+    again, twice as large, once it is MAX_LOAD full (counting the slots of
+    removed pks).
+
+    If `autosave` is unset, changes are kept in memory and only written to
+    the table by flush(); the database's own write ahead log covers them.
+    With a `filename`, the table is kept there rather than as the primary
+    key index of the database, eg to map pks to other integers (RowIds).
     """
-    def __init__(self, database_name='default'):
-        # TODO DNY: write separate class for write ahead log?
-        self.filename = 'files/'+database_name+'/'+'pks.p'
-        self.writelog = 'files/'+database_name+'/'+'writelog.idx'
+    def __init__(self, database_name='default', autosave=True, filename=None):
+        self.autosave = autosave
+        self.filename = filename if filename is not None else 'files/'+database_name+'/'+'pks.hash'
+        self._pending = {} # pk: offset, or None if removed, not in the table yet
 
         # if file never created before, create it
         if not os.path.exists(self.filename):
-            self.dict = dict()
-            self.save_pickle(new=True)
-        else:
-            self.dict = self.load_pickle()
-
-        if not os.path.exists(self.writelog):
-            self.fd = open(self.writelog, 'x')
-        else: # if log had values, load, save, and wipe them
-            self.fd = self.load_and_clear_log()
-
-        self.pk_count = len(self.dict.keys())
+            self.write_file(self.filename, self._load_pickled(database_name) if filename is None else [])
+        self._open()
+        self.pk_count = self._table_count
 
-        self.fd.seek(0,2)#DNY: seek the end of the file
-        self.writeptr = self.fd.tell()
-
-    def load_and_clear_log(self, loaded=False, close=False):
+    def _load_pickled(self, database_name):
         """
-        if loaded, writelog assumed to be open. otherwise, closed.
-        loads values, clears writelog and opens.
-        if close, then file descriptor not return.
+        helper function to return the items of a pks.p pickle and writelog
+        saved by earlier versions, which are then removed
         """
-        if loaded:
-            self.fd.close()
-        self.fd = open(self.writelog,'r')
-        items = [l.strip().split(':') for l in self.fd.readlines()]
-        writelog_dict = {k:int(v) for k,v in items}
-        self.dict.update(writelog_dict)
-        self.save_pickle()
+        pickle_file = 'files/'+database_name+'/'+'pks.p'
+        writelog = 'files/'+database_name+'/'+'writelog.idx'
+        items = {}
+        if os.path.exists(pickle_file):
+            with open(pickle_file, 'rb', buffering=0) as fd:
+                items = pickle.load(fd)
+            os.remove(pickle_file)
+        if os.path.exists(writelog):
+            with open(writelog, 'r') as fd:
+                items.update((k, int(v)) for k, v in (l.strip().rsplit(':', 1) for l in fd if l.strip()))
+            os.remove(writelog)
+        return items.items()
+
+    @staticmethod
+    def write_file(filename, items):
+        "write a new hash table file holding the (pk, offset) items, which have unique pks"
+        items = list(items)
+        n_slots = PK_MIN_SLOTS
+        while len(items) > n_slots * PK_MAX_LOAD / 2:
+            n_slots *= 2
+        table = bytearray(n_slots * PK_SLOT.size)
+        mask = n_slots - 1
+        heap_start = PK_HEADER.size + len(table)
+        long_keys = []
+        heap_size = 0
+        for key, value in items:
+            key = key.encode()
+            key_hash = _pk_hash(key)
+            n = key_hash & mask
+            while PK_LENGTH.unpack_from(table, n*PK_SLOT.size + PK_LENGTH_OFFSET)[0] != PK_EMPTY:
+                n = (n + 1) & mask
+            if len(key) <= PK_INLINE:
+                inline = key
+            else:
+                inline = PK_KEY_OFFSET.pack(heap_start + heap_size)
+                long_keys.append(key)
+                heap_size += len(key)
+            PK_SLOT.pack_into(table, n*PK_SLOT.size, key_hash, value, len(key) + 1, inline)
+        with open(filename, 'wb', buffering=0) as fd:
+            fd.write(PK_HEADER.pack(PK_MAGIC, n_slots, len(items), 0))
+            fd.write(table)
+            fd.write(b''.join(long_keys))
+            os.fsync(fd.fileno())
+
+    def _open(self):
+        "helper function to map the table of the file"
+        self.fd = open(self.filename, 'r+b', buffering=0)
+        magic, self.n_slots, self._table_count, self._tombstones = \
+            PK_HEADER.unpack(os.pread(self.fd.fileno(), PK_HEADER.size, 0))
+        if magic != PK_MAGIC:
+            raise ValueError("'{}' is not a primary key index".format(self.filename))
+        self.mm = mmap.mmap(self.fd.fileno(), PK_HEADER.size + self.n_slots*PK_SLOT.size)
+        self._heap_end = os.fstat(self.fd.fileno()).st_size
+
+    def _close_file(self):
+        self.mm.close()
         self.fd.close()
-        open(self.writelog, 'w').close() # this deletes the log
-        if not close:
-            return open(self.writelog, 'w')
 
-    def save_pickle(self, new=False):
-        form = 'xb' if new else 'wb'
-        with open(self.filename, form, buffering=0) as fd:
-            pickle.dump(self.dict, fd)
+    def reopen(self):
+        "map the file again, after it was replaced (see PersistentDB.vacuum)"
+        self._close_file()
+        self._pending = {}
+        self._open()
+        self.pk_count = self._table_count
 
-    def load_pickle(self):
-        with open(self.filename, 'rb', buffering=0) as fd:
-            return pickle.load(fd)
+    def data_files(self):
+        return [self.filename]
+
+    def _slot_key(self, length, inline):
+        "helper function to return the encoded pk of a slot"
+        if length - 1 <= PK_INLINE:
+            return inline[:length-1]
+        offset, = PK_KEY_OFFSET.unpack_from(inline)
+        return os.pread(self.fd.fileno(), length - 1, offset)
+
+    def _find(self, key, key_hash):
+        """
+        helper function to probe the table for an encoded pk. Returns its
+        slot and offset, or -1 and the slot it can be inserted in.
+        """
+        mask = self.n_slots - 1
+        n = key_hash & mask
+        free = -1
+        while True:
+            slot_hash, value, length, inline = PK_SLOT.unpack_from(self.mm, PK_HEADER.size + n*PK_SLOT.size)
+            if length == PK_EMPTY:
+                return -1, (free if free >= 0 else n)
+            if length == PK_TOMBSTONE:
+                if free < 0:
+                    free = n
+            elif slot_hash == key_hash and length == len(key) + 1 \
+                 and self._slot_key(length, inline) == key:
+                return n, value
+            n = (n + 1) & mask
+
+    def _write_header(self):
+        PK_HEADER.pack_into(self.mm, 0, PK_MAGIC, self.n_slots, self._table_count, self._tombstones)
+
+    def _table_put(self, key, value):
+        "helper function to set the offset of a pk in the table, return whether it is new"
+        encoded = key.encode()
+        key_hash = _pk_hash(encoded)
+        n, found = self._find(encoded, key_hash)
+        if n >= 0:
+            PK_VALUE.pack_into(self.mm, PK_HEADER.size + n*PK_SLOT.size + PK_VALUE_OFFSET, value)
+            return False
+        if self._table_count + self._tombstones + 1 > self.n_slots * PK_MAX_LOAD:
+            self._grow()
+            return self._table_put(key, value)
+        n = found
+        if PK_LENGTH.unpack_from(self.mm, PK_HEADER.size + n*PK_SLOT.size + PK_LENGTH_OFFSET)[0] == PK_TOMBSTONE:
+            self._tombstones -= 1
+        if len(encoded) <= PK_INLINE:
+            inline = encoded
+        else:
+            # long pks go to the end of the file, before their slot points at them
+            inline = PK_KEY_OFFSET.pack(self._heap_end)
+            os.pwrite(self.fd.fileno(), encoded, self._heap_end)
+            self._heap_end += len(encoded)
+        PK_SLOT.pack_into(self.mm, PK_HEADER.size + n*PK_SLOT.size, key_hash, value, len(encoded) + 1, inline)
+        self._table_count += 1
+        self._write_header()
+        return True
+
+    def _table_remove(self, key):
+        "helper function to remove a pk from the table"
+        n, _ = self._find(key.encode(), _pk_hash(key.encode()))
+        if n < 0:
+            return
+        PK_LENGTH.pack_into(self.mm, PK_HEADER.size + n*PK_SLOT.size + PK_LENGTH_OFFSET, PK_TOMBSTONE)
+        self._table_count -= 1
+        self._tombstones += 1
+        self._write_header()
+
+    def _grow(self):
+        "helper function to build the table again, large enough for twice its pks"
+        items = self._table_items()
+        self.write_file(self.filename+'.tmp', items)
+        self._close_file()
+        os.replace(self.filename+'.tmp', self.filename)
+        self._open()
+
+    def _table_items(self):
+        "helper function to return the (pk, offset) pairs in the table"
+        table = np.frombuffer(self.mm[PK_HEADER.size:], dtype=PK_SLOT_DTYPE)
+        live = table[(table['length'] != PK_EMPTY) & (table['length'] != PK_TOMBSTONE)]
+        heap_start = PK_HEADER.size + self.n_slots*PK_SLOT.size
+        heap = None
+        items = []
+        for length, inline, value in zip(live['length'].tolist(), live['inline'].tolist(), live['value'].tolist()):
+            if length - 1 <= PK_INLINE:
+                # trailing zero bytes are stripped from the inline field
+                key = inline.ljust(length - 1, b'\0')
+            else:
+                if heap is None:
+                    heap = os.pread(self.fd.fileno(), self._heap_end - heap_start, heap_start)
+                offset = PK_KEY_OFFSET.unpack_from(inline.ljust(PK_INLINE, b'\0'))[0] - heap_start
+                key = heap[offset:offset + length - 1]
+            items.append((key.decode(), value))
+        return items
 
     def __getitem__(self, key):
-        return self.dict[key]
+        if key in self._pending:
+            value = self._pending[key]
+        else:
+            encoded = key.encode()
+            n, value = self._find(encoded, _pk_hash(encoded))
+            if n < 0:
+                value = None
+        if value is None:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        if key not in self.dict.keys():
-            self.pk_count += 1
-            self.dict[key] = value
-            self.fd.write(key+':'+str(value)+'\n')
-            if self.pk_count % REFRESH_RATE == 0:
-                self.fd = self.load_and_clear_log(loaded=True)
+        if self.autosave:
+            if self._table_put(key, value):
+                self.pk_count += 1
         else:
-            self.dict[key] = value
+            if key not in self:
+                self.pk_count += 1
+            self._pending[key] = value
 
     def __iter__(self):
-        return iter(self.dict.keys())
+        return iter(self.keys())
 
     def __contains__(self, key):
-        return key in self.dict.keys()
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
 
     def keys(self):
-        return self.dict.keys()
+        "list of the pks"
+        keys = [key for key, _ in self._table_items() if key not in self._pending]
+        keys += [key for key, value in self._pending.items() if value is not None]
+        return keys
+
+    def insert_many(self, items):
+        "insert many (key, value) pairs"
+        for key, value in items:
+            self[key] = value
+
+    def flush(self):
+        "write the pending changes to the table, and the table to disk"
+        for key, value in self._pending.items():
+            if value is None:
+                self._table_remove(key)
+            else:
+                self._table_put(key, value)
+        self._pending = {}
+        self.mm.flush()
+        os.fsync(self.fd.fileno())
 
     def __len__(self):
         return self.pk_count
 
     def insert(self, key, value):
-        # insert the value into the appropriate place in the tree
+        # insert the value into the appropriate place in the table
         # delegates to __setitem__
         self[key] = value
 
     def remove(self, key, value=None):
         # added to match interface. Value unnecessary here.
-        self.fd = self.load_and_clear_log(loaded=True)
-        del self.dict[key]
-        self.save_pickle()
+        if key not in self:
+            raise KeyError(key)
+        self.pk_count -= 1
+        if self.autosave:
+            self._table_remove(key)
+        else:
+            self._pending[key] = None
 
     def getEqual(self, key):
         return self[key]
 
     def close(self):
-        self.load_and_clear_log(loaded=True, close=True)
+        if self.fd.closed:
+            return
+        if self._pending:
+            self.flush()
+        self._close_file()
 
 class TreeIndex(SimpleIndex):
+    """
+    Index of a numeric field, kept in a page based B+tree file (see
+    btree.BPlusTree) so that a change only writes the pages it touched.
+
+    The tree holds row ids from `rowids`, a RowIds shared with the other
+    indexes of the database, or one of the index's own if None. Indexes
+    pickled as an AVL tree by earlier versions are converted on load.
+    """
+    def __init__(self, fieldName='default', database_name='default', autosave=True, rowids=None):
+        self._stats = None
+        self._own_rowids = rowids is None
+        if rowids is None:
+            rowids = RowIds('files/'+database_name+'/'+fieldName+'.rid')
+        self.rowids = rowids
+        super().__init__(fieldName, database_name, autosave)
 
     def _loadFromFile(self):
-        if os.path.isfile(self.filename):
-            with open(self.filename,'rb') as f:
-                self.tree = pickle.load(f)
-        else:
-            # print("Loading Empty Tree")
-            self.tree = bintrees.AVLTree()
+        self.created = not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0
+        if not self.created and not BPlusTree.is_btree(self.filename):
+            with open(self.filename, 'rb') as f:
+                old_btree = f.read(7) == b'TSBTREE'
+            if old_btree:
+                # a B+tree of pks rather than row ids, to be built again
+                os.remove(self.filename)
+                self.created = True
+            else:
+                self._convertPickle()
+        self.tree = self._open_tree()
+
+    def _open_tree(self):
+        return BPlusTree(self.filename)
+
+    def _convertPickle(self):
+        "rewrite an index pickled as a bintrees.AVLTree as a B+tree file"
+        with open(self.filename,'rb') as f:
+            avl = pickle.load(f)
+        if os.path.exists(self.filename+'.tmp'):
+            os.remove(self.filename+'.tmp')
+        tree = BPlusTree(self.filename+'.tmp')
+        for fieldValue, pks in avl.items():
+            for pk in pks:
+                tree.insert(fieldValue, self.rowids.id(pk))
+        self.rowids.flush(sync=True)
+        tree.flush(sync=True)
+        tree.close()
+        os.replace(self.filename+'.tmp', self.filename)
+
+    def _changed(self):
+        "write the changed pages, unless saving is left to flush()"
+        if self.autosave:
+            # the row ids they use go first
+            self.rowids.flush()
+            self.tree.flush()
+
+    def flush(self):
+        "write the changed pages to disk"
+        self.rowids.flush(sync=True)
+        self.tree.flush(sync=True)
 
-    def _saveToFile(self):
-        with open(self.filename,'wb') as f:
-            pickle.dump(self.tree, f)
+    def close(self):
+        self.tree.close()
+        if self._own_rowids:
+            self.rowids.close()
 
     def deleteIndex(self):
+        self.close()
         if os.path.isfile(self.filename):
             os.remove(self.filename)
-
-    def _checkStale(self):
-        if self._stale:
-            self._loadFromFile()
-            self._stale = False
+        if self._own_rowids:
+            self.rowids.delete()
 
     def insert(self,fieldValue, pk):
-        self._checkStale()
-
-        if fieldValue in self.tree:
-            if pk not in self.tree[fieldValue]:
-                self.tree[fieldValue] = self.tree[fieldValue] + [pk]
-        else:
-            self.tree[fieldValue] = [pk]
-        self._saveToFile()
-        self._stale = True
+        if self.tree.insert(fieldValue, self.rowids.id(pk)) and self._stats is not None:
+            self._stats.add(fieldValue)
+        self._changed()
+
+    def insert_many(self, entries):
+        "insert many (fieldValue, pk) pairs, writing the changed pages once"
+        rows = [(float(fieldValue), self.rowids.id(pk)) for fieldValue, pk in entries]
+        # in key order, so consecutive inserts land in the same leaves
+        for fieldValue, row in sorted(rows):
+            if self.tree.insert(fieldValue, row) and self._stats is not None:
+                self._stats.add(fieldValue)
+        self._changed()
 
     def remove(self, fieldValue, pk):
-        self._checkStale()
-        if fieldValue in self.tree:
-            matchingPks = self.tree[fieldValue]
-            if pk in matchingPks:
-                del matchingPks[matchingPks.index(pk)]
-                self.tree[fieldValue] = matchingPks
-            else:
+        row = self.rowids.get(pk)
+        if row is None or not self.tree.remove(fieldValue, row):
+            if len(self.tree.range(fieldValue, fieldValue)):
                 raise ValueError("TreeIndex.remove():: primary_key is not in the index")
-        else:
-            import pdb; pdb.set_trace()
             raise ValueError("TreeIndex.remove():: fieldValue is not in the index")
-        self._saveToFile()
-        self._stale = True
-
-    def get(self, fieldValue, operator_num=2):
+        if self._stats is not None:
+            self._stats.remove(fieldValue)
+        self._changed()
+
+    def stats(self):
+        "IndexStats of the values in the index, computed again from the tree when stale"
+        if self._stats is None or self._stats.stale:
+            self._stats = IndexStats(np.fromiter((entry[0] for entry in self.tree.items()),
+                                                 dtype=np.float64, count=len(self.tree)))
+        return self._stats
+
+    def estimate(self, fieldValue, operator_num=2):
+        "estimated number of rows matching fieldValue with the operator"
+        return self.stats().estimate(OPERATOR_NAMES[operator_num], fieldValue)
+
+    def getRows(self, fieldValue, operator_num=2):
         """
-        'get' wrapper function to delegate to other functions
-        based on submitted operator
+        sorted uint32 array of the row ids matching fieldValue with the
+        operator (see OPMAP in persistentdb)
         """
         if operator_num == 0:
-            return self.getLowerThan(fieldValue)
+            return self.tree.range(None, fieldValue, include_high=False)
         elif operator_num == 1:
-            return self.getHigherThan(fieldValue)
+            return self.tree.range(fieldValue, None, include_low=False)
         elif operator_num == 2:
-            return self.getEqual(fieldValue)
+            return self.tree.range(fieldValue, fieldValue)
         elif operator_num == 3:
-            return self.getNotEq(fieldValue)
+            return np.setdiff1d(self.allRows(), self.tree.range(fieldValue, fieldValue), assume_unique=True)
         elif operator_num == 4:
-            return self.getLowerOrEq(fieldValue)
+            return self.tree.range(None, fieldValue)
         elif operator_num == 5:
-            return self.getHigherOrEq(fieldValue)
+            return self.tree.range(fieldValue, None)
         raise RuntimeError("should be impossible")
 
-    def getEqual(self, fieldValue):
-        self._checkStale()
+    def allRows(self):
+        "sorted uint32 array of every row id in the index"
+        return self.tree.range()
 
-        if fieldValue in self.tree:
-            return set(self.tree[fieldValue])
-        else:
-            return set()
+    def ordered(self, reverse=False):
+        "generator over the row ids in the order of their values, largest first if reverse"
+        entries = self.tree.reversed_items() if reverse else self.tree.items()
+        for entry in entries:
+            yield entry[1]
 
-    def getLowerThan(self, fieldValue):
-        self._checkStale()
-        retList = set()
-        for v in self.tree[:fieldValue]:
-            retList = retList | self.getEqual(v)
+    def get(self, fieldValue, operator_num=2):
+        """
+        'get' wrapper function returning the set of primary keys matching
+        fieldValue with the operator
+        """
+        return set(self.rowids.to_pks(self.getRows(fieldValue, operator_num).tolist()))
+
+    def getEqual(self, fieldValue):
+        return self.get(fieldValue, 2)
 
-        return set(retList)
+    def getLowerThan(self, fieldValue):
+        return self.get(fieldValue, 0)
 
     def getHigherThan(self, fieldValue):
-        self._checkStale()
-        retList = set()
-        for v in self.tree[fieldValue:]:
-            if v != fieldValue:
-                retList = retList | self.getEqual(v)
-        return set(retList)
+        return self.get(fieldValue, 1)
 
     def allKeys(self):
-        pks = set()
-        for value in self.trees.values():
-            pks = pks | value
-        return pks
+        return set(self.rowids.to_pks(self.allRows().tolist()))
 
     def getHigherOrEq(self, fieldValue):
-        return self.getHigherThan(fieldValue) | self.getEqual(fieldValue)
+        return self.get(fieldValue, 5)
 
     def getLowerOrEq(self, fieldValue):
-        return self.getLowerThan(fieldValue) | self.getEqual(fieldValue)
+        return self.get(fieldValue, 4)
 
     def getNotEq(self, fieldValue):
-        return self.allKeys() - self.getEqual(fieldValue)
+        return self.get(fieldValue, 3)
 
-import os
+class CompositeIndex(TreeIndex):
+    """
+    Index of several numeric fields at once, in a B+tree keyed by the tuple
+    of their values. Rows are only indexed if every one of the fields is set.
+
+    Equality on the first fields, optionally followed by a range on the next
+    one, is answered by one scan of the tree. The values of the `covering`
+    fields are stored with each row (NaN when not set), so that queries
+    only needing them and the indexed fields do not have to read the rows.
+    """
+    def __init__(self, fields, covering=(), database_name='default', autosave=True, rowids=None):
+        self.fields = tuple(fields)
+        self.covering = tuple(covering)
+        super().__init__('+'.join(self.fields), database_name, autosave, rowids)
+
+    def _open_tree(self):
+        tree = BPlusTree(self.filename, key_width=len(self.fields), value_width=len(self.covering))
+        if (tree.key_width, tree.value_width) != (len(self.fields), len(self.covering)):
+            # declared with other fields, to be built again
+            tree.close()
+            os.remove(self.filename)
+            self.created = True
+            tree = BPlusTree(self.filename, key_width=len(self.fields), value_width=len(self.covering))
+        return tree
+
+    def _convertPickle(self):
+        raise ValueError("'{}' is not a composite index file".format(self.filename))
+
+    def insert(self, fieldValues, pk, covered=()):
+        self.tree.insert(fieldValues, self.rowids.id(pk), covered)
+        self._changed()
+
+    def insert_many(self, entries):
+        "insert many (fieldValues, pk, covered) entries, writing the changed pages once"
+        rows = [(tuple(float(v) for v in fieldValues), self.rowids.id(pk), covered)
+                for fieldValues, pk, covered in entries]
+        for fieldValues, row, covered in sorted(rows, key=lambda entry: entry[:2]):
+            self.tree.insert(fieldValues, row, covered)
+        self._changed()
+
+    def remove(self, fieldValues, pk):
+        row = self.rowids.get(pk)
+        if row is None or not self.tree.remove(fieldValues, row):
+            raise ValueError("CompositeIndex.remove():: entry is not in the index")
+        self._changed()
+
+    def _bounds(self, equal, operator_num, fieldValue):
+        """
+        helper function to turn a lookup into the arguments of
+        BPlusTree.scan, see lookup
+        """
+        equal = tuple(equal)
+        if operator_num is None:
+            return equal, equal, True, True
+        bound = equal + (fieldValue,)
+        if operator_num == 0:
+            return equal, bound, True, False
+        elif operator_num == 1:
+            return bound, equal, False, True
+        elif operator_num == 2:
+            return bound, bound, True, True
+        elif operator_num == 4:
+            return equal, bound, True, True
+        elif operator_num == 5:
+            return bound, equal, True, True
+        raise ValueError("CompositeIndex lookups do not support operator {}".format(operator_num))
 
-class BitmapIndex:
+    def lookup(self, equal, operator_num=None, fieldValue=None):
+        """
+        Entries of the rows whose first fields are equal to the values in
+        `equal`, and, with an operator, whose next field compares with
+        fieldValue (see OPMAP in persistentdb, != is not supported).
 
-    def __init__(self, values, fieldName='default', database_name='default'):
-        # 'values' is a list of possible fieldValues
-        self.values = [str(ii) for ii in values]
-        self.values_len = len(values)
+        Returns a list of (row id, field values, covering values) tuples in
+        index order, the values being tuples of floats.
+        """
+        entries = self.tree.scan(*self._bounds(equal, operator_num, fieldValue))
+        if not self.covering:
+            return [(row, key, ()) for key, row in entries]
+        return [(row, key, covered) for key, row, covered in entries]
 
-        # File containing the bitmap indices for this field
-        self.filename = 'files/'+database_name+'/'+fieldName+'_index.txt'
-
-        # Empty list to store the the lists of booleans for each field value.  
-        #CJ: I am storing the indices as a list of list of boolean because it
-        # is more memory-efficient to append to append to the lists than it is to keep
-        # vertically stacking numpy arrays.
-        self.bmindex_list = [[] for ii in range(self.values_len)]
-
-        # Empty dictionary to store primary keys and their indices in self.bmindex
-        self.pks_dict = {}
-        self.dict_pks = {}
-        
-        # Create desired files if they don’t exist.
-        # Load files if they do exist.
-
-        # Open the associated files for updating
-        if not os.path.exists(self.filename):
-            self.bmindex = open(self.filename, "xb+", buffering=0)
-            # Write the values to the top line of the persistent file
-            for ii in self.values:
-                self.bmindex.write(bytes(str(ii),'utf-8')+b',')
-            self.bmindex.write(b'\n')
-            
-            self.last_pk_idx = 0
+    def getRows(self, equal, operator_num=None, fieldValue=None):
+        "sorted uint32 array of the row ids of a lookup"
+        return self.tree.range(*self._bounds(equal, operator_num, fieldValue))
 
-        else:
-            # Load from file
-            
-            item_counter = 0
-            
-            self.bmindex = open(self.filename, "r+b", buffering=0)
-            
-            # Read top line and verify that the values are the same as what 
-            #   was specified.
-            line = self.bmindex.readline().decode('utf-8')
-            vals = line.split(',')[:-1]
-            assert vals == self.values, \
-            "Specified values {} do not match the values stored in the persistent db {}".format(vals, self.values)
-            
-            while True:
-                # Read in one line at a time, until the end of the file
-                line = self.bmindex.readline()
-                if len(line)==0:
+    def get(self, equal, operator_num=None, fieldValue=None):
+        "set of the primary keys of a lookup"
+        return set(self.rowids.to_pks(self.getRows(equal, operator_num, fieldValue).tolist()))
+
+    def getEqual(self, fieldValues):
+        return self.get(tuple(fieldValues))
+
+class RowIds:
+    """
+    Dense integer row ids for primary keys, handed out in order the first
+    time a pk is seen, so that the bitmaps of the indexes sharing them can
+    be combined. They are not reused; PersistentDB.vacuum numbers the live
+    pks from 0 again and builds the indexes again.
+
+    The pks are saved to an append only file, in row id order, each prefixed
+    by its length, when flush() is called; the indexes do so before they
+    write changes that use new row ids. Where each record starts is saved
+    to a second file, and the row id of each pk to a PKIndex table, so that
+    none of them is read into memory on open. Records that the other two
+    files miss, after a crash or in files written by earlier versions, are
+    added to them on open.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offsets_file = filename+'.off'
+        self.fd = open(self.filename, 'a+b', buffering=0)
+        self.offsets_fd = open(self.offsets_file, 'a+b', buffering=0)
+        self.table = PKIndex(filename=filename+'.hash')
+        self._new_ids = {} # pk: row id, for the pks not flushed yet
+        self._maps = None # (row ids mapped, records, offsets), see _mapped()
+        count, self._end = self._recover()
+        self._tail = (count, []) # row ids flushed, pks given a row id since
+
+    def _recover(self):
+        """
+        helper function to bring the offsets and the table up to date with
+        the records, dropping a torn record at the end. Returns the number
+        of records and where they end.
+        """
+        fd, offsets_fd = self.fd.fileno(), self.offsets_fd.fileno()
+        size = os.fstat(fd).st_size
+        # the last offset whose record is whole
+        count = os.fstat(offsets_fd).st_size // ROW_ID_OFFSET.size
+        end = 0
+        while count > 0:
+            start, = ROW_ID_OFFSET.unpack(os.pread(offsets_fd, ROW_ID_OFFSET.size, (count-1)*ROW_ID_OFFSET.size))
+            header = os.pread(fd, ROW_ID_RECORD.size, start)
+            if len(header) == ROW_ID_RECORD.size:
+                length, = ROW_ID_RECORD.unpack(header)
+                if start + ROW_ID_RECORD.size + length <= size:
+                    end = start + ROW_ID_RECORD.size + length
                     break
-                
-                # Try to read the primary key for this line
-                prim_key = line[self.values_len:-1]
-                if prim_key == b'':
-                    raise KeyError("Missing primary key on line {}".format(item_counter))
-                elif prim_key in self.pks_dict.keys():
-                    # Get rid of any entry that already exists in this dictionary, because
-                    #   we no longer want a reference to the old position in the file/indices.
-                    del self.dict_pks[self.pks_dict[prim_key]]
-                self.pks_dict.update({prim_key:item_counter})
-                self.dict_pks.update({item_counter:prim_key})
-                
-                line = line[:self.values_len].decode('utf-8')
-                
-                # Take in the bitmask indices
-                for ii in range(self.values_len):
-                    try:
-                        boolean = bool(int(line[ii]))
-                        self.bmindex_list[ii].append(boolean)
-                    except ValueError:
-                        # Thrown if the sentinel value of b'-' has been written
-                        del self.pks_dict[prim_key]
-                        del self.dict_pks[item_counter]
-                        break
-                
-                item_counter += 1
-            
-            self.last_pk_idx = item_counter
+            count -= 1
+        # the records after it
+        data = os.pread(fd, size - end, end)
+        offsets, pks = [], []
+        position = 0
+        while position + ROW_ID_RECORD.size <= len(data):
+            length, = ROW_ID_RECORD.unpack_from(data, position)
+            start = position + ROW_ID_RECORD.size
+            if start + length > len(data):
+                break
+            offsets.append(ROW_ID_OFFSET.pack(end + position))
+            pks.append(data[start:start+length].decode())
+            position = start + length
+        self.fd.truncate(end + position)
+        self.offsets_fd.truncate(count * ROW_ID_OFFSET.size)
+        if offsets:
+            self.offsets_fd.write(b''.join(offsets))
+        first = count
+        count += len(offsets)
+        # the table only holds pks once their record is saved, but they may
+        # be lost with it
+        if len(self.table) > first:
+            for pk, row_id in self.table._table_items():
+                if row_id >= first:
+                    self.table.remove(pk)
+        self.table.insert_many(zip(pks, range(first, count)))
+        if pks:
+            self.table.flush()
+        return count, end + position
+
+    def _mapped(self, count):
+        "helper function to return the records and their offsets, mapped for the first count row ids at least"
+        maps = self._maps
+        if maps is None or maps[0] < count:
+            records = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets = np.frombuffer(mmap.mmap(self.offsets_fd.fileno(), 0, access=mmap.ACCESS_READ),
+                                    dtype='<u8')
+            maps = self._maps = (len(offsets), records, offsets)
+        return maps[1], maps[2]
 
-    def insert(self, fieldValue, pk):
-        # Updates the booleans that indicate the field's values for the appropriate pk.
-        # Adds pk's that are not already present, and updates pk's that are already present.
+    def __len__(self):
+        count, new = self._tail
+        return count + len(new)
+
+    def __contains__(self, pk):
+        return self.get(pk) is not None
+
+    def __getitem__(self, row_id):
+        return self.to_pks([row_id])[0]
+
+    def get(self, pk, default=None):
+        row_id = self._new_ids.get(pk)
+        if row_id is not None:
+            return row_id
+        try:
+            return self.table[pk]
+        except KeyError:
+            return default
+
+    def id(self, pk):
+        "row id of pk, assigning the next one if it is new"
+        row_id = self.get(pk)
+        if row_id is None:
+            count, new = self._tail
+            row_id = count + len(new)
+            new.append(pk)
+            self._new_ids[pk] = row_id
+        return row_id
+
+    def to_pks(self, row_ids):
+        "list of the pks of an iterable of row ids"
+        count, new = self._tail
+        row_ids = list(row_ids)
+        saved = [row_id for row_id in row_ids if row_id < count]
+        if not saved:
+            return [new[row_id - count] for row_id in row_ids]
+        records, offsets = self._mapped(count)
+        starts = iter(offsets[np.array(saved, dtype=np.int64)].tolist())
+        pks = []
+        for row_id in row_ids:
+            if row_id >= count:
+                pks.append(new[row_id - count])
+                continue
+            start = next(starts)
+            length, = ROW_ID_RECORD.unpack_from(records, start)
+            start += ROW_ID_RECORD.size
+            pks.append(records[start:start+length].decode())
+        return pks
+
+    def flush(self, sync=False):
+        "write the new pks to disk"
+        count, new = self._tail
+        if new:
+            records, offsets = [], []
+            for pk in new:
+                encoded = pk.encode()
+                offsets.append(ROW_ID_OFFSET.pack(self._end))
+                records.append(ROW_ID_RECORD.pack(len(encoded)) + encoded)
+                self._end += len(records[-1])
+            self.fd.write(b''.join(records))
+            self.offsets_fd.write(b''.join(offsets))
+            # the table only gets them once their records are written
+            self.table.insert_many(zip(new, range(count, count + len(new))))
+            self._tail = (count + len(new), [])
+            self._new_ids = {}
+        if sync:
+            os.fsync(self.fd.fileno())
+            os.fsync(self.offsets_fd.fileno())
+            self.table.flush()
+
+    def close(self):
+        if not self.fd.closed:
+            self.flush()
+            self._maps = None
+            self.fd.close()
+            self.offsets_fd.close()
+            self.table.close()
+
+    def delete(self):
+        self.close()
+        for filename in (self.filename, self.offsets_file, self.table.filename):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+
+class BitmapIndex(BaseIndex):
+    """
+    Index of a field with few possible values, as one compressed bitmap of
+    row ids (see bitmap.Bitmap) per value.
+
+    Row ids come from `rowids`, a RowIds shared with the other bitmap
+    indexes of the database so their bitmaps can be intersected, or one of
+    the index's own if None. The bitmaps are saved as a snapshot followed by
+    a log of the changes since, which is folded into a new snapshot once it
+    grows as large as the index. If `autosave` is unset, changes are only
+    written by flush().
+    """
+    def __init__(self, values, fieldName='default', database_name='default', autosave=True, rowids=None):
+        # 'values' is a list of possible fieldValues
+        self.values = list(values)
+        self.values_len = len(values)
+        self.autosave = autosave
 
-        # Pk's are stored as bytes, so if the user passed ints or strings, convert to bytes.
-        if type(pk) != bytes:
-            pk_str = bytes(str(pk),'utf-8')
+        # File containing the bitmap indices for this field
+        self.filename = 'files/'+database_name+'/'+fieldName+'.bmi'
+        self._own_rowids = rowids is None
+        if rowids is None:
+            rowids = RowIds('files/'+database_name+'/'+fieldName+'.rid')
+        self.rowids = rowids
+
+        self.bitmaps = [Bitmap() for _ in range(self.values_len)]
+        self.counts = [0] * self.values_len # rows of every value
+        self.row_values = {} # row id: index of its value
+        self._log = []
+        self._n_logged = 0
+        self.created = not os.path.exists(self.filename)
+        if self.created:
+            self._save_snapshot()
         else:
-            pk_str = pk
-            
-        # Check if the fieldValue is valid.  If not, throw an error.
+            self._load()
+        self.fd = open(self.filename, 'ab', buffering=0)
+
+    def _load(self):
+        "helper function to read the snapshot and replay the changes after it"
+        with open(self.filename, 'rb') as fd:
+            data = fd.read()
+        magic, n_values, snapshot_end = BITMAP_HEADER.unpack_from(data, 0)
+        if magic != BITMAP_MAGIC:
+            raise ValueError("'{}' is not a bitmap index".format(self.filename))
+        if n_values != self.values_len:
+            raise ValueError("Specified values {} do not match the values stored in the persistent db".format(self.values))
+        offset = BITMAP_HEADER.size
+        for n in range(self.values_len):
+            self.bitmaps[n], offset = Bitmap.frombytes(data, offset)
+            for row_id in self.bitmaps[n].to_array().tolist():
+                self.row_values[row_id] = n
+            self.counts[n] = len(self.bitmaps[n])
+        offset = snapshot_end
+        while offset + BITMAP_RECORD.size <= len(data):
+            value_idx, row_id = BITMAP_RECORD.unpack_from(data, offset)
+            self._apply(value_idx, row_id)
+            offset += BITMAP_RECORD.size
+            self._n_logged += 1
+
+    def _save_snapshot(self):
+        "helper function to write all the bitmaps to a new file, and swap it in"
+        bitmaps = [bitmap.tobytes() for bitmap in self.bitmaps]
+        snapshot_end = BITMAP_HEADER.size + sum(len(b) for b in bitmaps)
+        with open(self.filename+'.tmp', 'wb', buffering=0) as fd:
+            fd.write(BITMAP_HEADER.pack(BITMAP_MAGIC, self.values_len, snapshot_end))
+            fd.write(b''.join(bitmaps))
+            if not self.autosave:
+                os.fsync(fd.fileno())
+        os.replace(self.filename+'.tmp', self.filename)
+        self._n_logged = 0
+
+    def _apply(self, value_idx, row_id):
+        "helper function to move a row to the bitmap of value_idx, or out if -1"
+        old = self.row_values.pop(row_id, None)
+        if old is not None:
+            self.bitmaps[old].discard(row_id)
+            self.counts[old] -= 1
+        if value_idx >= 0:
+            self.bitmaps[value_idx].add(row_id)
+            self.row_values[row_id] = value_idx
+            self.counts[value_idx] += 1
+
+    def _change(self, value_idx, row_id):
+        "helper function to apply a change and log it"
+        self._apply(value_idx, row_id)
+        self._log.append(BITMAP_RECORD.pack(value_idx, row_id))
+        if self.autosave:
+            self._write()
+
+    def _value_index(self, fieldValue):
         if fieldValue not in self.values:
             raise ValueError('\"{}\" not in the set of user-specified values: {}'.format(fieldValue, self.values))
-        else:
-            # Find field index from the objects values
-            field_index = self.values.index(fieldValue)
-            
-            # Add the pk to the dictionary along with its index
-            if pk_str in self.pks_dict.keys():
-                del self.dict_pks[self.pks_dict[pk_str]]
-                del self.pks_dict[pk_str]
-                
-            self.pks_dict.update({pk_str:self.last_pk_idx})
-            self.dict_pks.update({self.last_pk_idx:pk_str})
-            
-            self.last_pk_idx += 1
-
-            # Add the booleans and pk to the end of the file
-            self.bmindex.seek(0,2)
-            
-            # Update the in-memory lists and write to file
-            for ii in range(self.values_len):
-                if ii==field_index:
-                    self.bmindex_list[ii].append(True)
-                    self.bmindex.write(b'1')
-                else:
-                    self.bmindex_list[ii].append(False)
-                    self.bmindex.write(b'0')
-                    
-            self.bmindex.write(pk_str)
-            self.bmindex.write(b'\n')
-            
-
-    def remove(self, pk):
-        # Removes the entry for this field and primary key from the database
-        
-        if type(pk) != 'bytes':
-            pk_str = bytes(str(pk),'utf-8')
-
-        # Check if the pk is in the file or not.
-        if pk_str not in self.pks_dict.keys():
+        return self.values.index(fieldValue)
+
+    def insert(self, fieldValue, pk):
+        # Sets the value of pk, whether or not it was already present.
+        self._change(self._value_index(fieldValue), self.rowids.id(pk))
+
+    def insert_many(self, entries):
+        "insert many (fieldValue, pk) pairs, writing the changes once"
+        autosave, self.autosave = self.autosave, False
+        try:
+            for fieldValue, pk in entries:
+                self.insert(fieldValue, pk)
+        finally:
+            self.autosave = autosave
+        if self.autosave:
+            self._write()
+
+    def remove(self, fieldValue, pk):
+        # Removes the entry for this primary key from the index
+        row_id = self.rowids.get(pk)
+        if row_id not in self.row_values:
             raise KeyError('\"{}\" not a valid primary key'.format(pk))
-        else:
-            # Remove the primary key from the dictionaries
-            del self.dict_pks[self.pks_dict[pk_str]]
-            del self.pks_dict[pk_str]
-            
-            # Write a sentinel value to the persistent database at the end
-            #   of the file.  
-            self.bmindex.seek(0,2)
-            self.bmindex.write((self.values_len*b'-') + pk_str + b'\n')
+        self._change(-1, row_id)
+
+    def flush(self):
+        "write the logged changes to disk, and fsync"
+        self._write(sync=True)
+
+    def _write(self, sync=False):
+        "helper function to write the logged changes, folding them into a new snapshot if there are many"
+        # the row ids they use go first
+        self.rowids.flush(sync)
+        if self._log:
+            self._n_logged += len(self._log)
+            if self._n_logged > max(SNAPSHOT_MIN, len(self.row_values)):
+                self._log = []
+                self.fd.close()
+                self._save_snapshot()
+                self.fd = open(self.filename, 'ab', buffering=0)
+                return
+            self.fd.write(b''.join(self._log))
+            self._log = []
+        if sync:
+            os.fsync(self.fd.fileno())
+
+    def getBitmap(self, fieldValue, operator_num=2):
+        """
+        Bitmap of the row ids matching fieldValue with the operator (see
+        OPMAP in persistentdb), combined from the bitmaps of every value
+        """
+        if operator_num in (2, 3):
+            n = self._value_index(fieldValue)
+            if operator_num == 2:
+                return self.bitmaps[n].copy()
+            return self.allRows() - self.bitmaps[n]
+        compare = BITMAP_OPERATORS[operator_num]
+        matches = Bitmap()
+        for value, bitmap in zip(self.values, self.bitmaps):
+            if compare(value, fieldValue):
+                matches = matches | bitmap
+        return matches
+
+    def estimate(self, fieldValue, operator_num=2):
+        "number of rows matching fieldValue with the operator, from the count of every value"
+        if operator_num in (2, 3) and fieldValue not in self.values:
+            return 0 if operator_num == 2 else len(self.row_values)
+        compare = BITMAP_OPERATORS[operator_num]
+        return sum(count for value, count in zip(self.values, self.counts) if compare(value, fieldValue))
+
+    def allRows(self):
+        "Bitmap of every row id in the index"
+        return reduce(lambda a, b: a | b, self.bitmaps, Bitmap())
 
+    def get(self, fieldValue, operator_num=2):
+        "set of the primary keys matching fieldValue with the operator"
+        return set(self.rowids.to_pks(self.getBitmap(fieldValue, operator_num)))
 
     def getEqual(self, fieldValue):
         # Returns the set of primary keys that match this fieldValue
+        return self.get(fieldValue, 2)
 
-        # Find the index of this fieldValue in the list of valid values
-        if fieldValue not in self.values:
-            raise ValueError('\"{}\" not in the set of user-specified values: {}'.format(fieldValue, self.values))
-        else:
-            fieldValue_index = self.values.index(fieldValue)
-
-            matching_keys = []
+    def getNotEq(self, fieldValue):
+        return self.get(fieldValue, 3)
 
-            for ii in self.dict_pks.keys():
-                if self.bmindex_list[fieldValue_index][ii] == True:
-                    matching_keys.append(self.dict_pks[ii])
+    def getValue(self, pk):
+        "value of pk in the index"
+        return self.values[self.row_values[self.rowids.get(pk)]]
 
-            return set(matching_keys)
-    
-    def getNotEq(self, fieldValue):
-        if fieldValue not in self.values:
-            raise ValueError('\"{}\" not in the set of user-specified values: {}'.format(fieldValue, self.values))
-        else:
-            fieldValue_index = self.values.index(fieldValue)
-            
-            matching_keys = []
-            
-            for ii in self.dict_pks.keys():
-                if self.bmindex_list[fieldValue_index][ii] == False:
-                    matching_keys.append(self.dict_pks[ii])
-            
-            return set(matching_keys)
-        
     def allKeys(self):
-        return set(self.pks_dict.keys())
-    
+        return set(self.rowids.to_pks(self.row_values))
+
+    def close(self):
+        if not self.fd.closed:
+            self._write()
+            self.fd.close()
+        if self._own_rowids:
+            self.rowids.close()
+
     def deleteIndex(self):
+        self.close()
         if os.path.isfile(self.filename):
             os.remove(self.filename)
-            
-    def get(self,pk):
-        index = self.pks_dict[bytes(pk, 'utf-8')]
-        for ii in range(self.values_len):
-            value_index = self.bmindex_list[ii][index]
-            if value_index == True:
-                return self.values[ii]
-            
+        if self._own_rowids:
+            self.rowids.delete()
+
     def __del__(self):
-        self.bmindex.close()
+        # the row ids go first, so nothing can be saved once they are closed
+        if hasattr(self, 'fd') and not self.rowids.fd.closed:
+            self.close()
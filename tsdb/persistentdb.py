@@ -2,15 +2,23 @@
 """
 
 from collections import defaultdict
-from operator import and_
-from functools import reduce
+from functools import wraps
+import heapq
 import operator
 import os
+import threading
+import time
 import numbers
 import json
 import timeseries
-from .indices import BaseIndex, PKIndex, TreeIndex
-from .heap import MetaHeapFile, TSHeapFile
+from .indices import BaseIndex, PKIndex, TreeIndex, BitmapIndex, CompositeIndex, RowIds
+from .bitmap import Bitmap
+from .aggregates import parse_aggregate, aggregate_rows, aggregate_groups
+from .btree import BPlusTree
+from .heap import MetaHeapFile, ColumnarMetaHeapFile, TSHeapFile
+from .wal import WriteAheadLog
+from .bufferpool import BufferPool, DEFAULT_CACHE_SIZE
+import numpy as np
 from .baseclasses import BaseDB
 import pickle
 import shutil
@@ -24,15 +32,30 @@ OPMAP = {
     '<=': 4,
     '>=': 5
 }
+# the same operators in python, to check rows that are not in the indexes
+OPFUNCS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '>=': operator.ge
+}
+
+# the names of the operators, by number
+OPERATOR_NAMES = {num: op for op, num in OPMAP.items()}
+# how many index entries a select would rather read than one metaheap row
+FILTER_COST = 4
 
 # DNY: Potentially useful for different types of indices
 INDEXES = {
-    1: None,#Binary Tree type here,
-    2: None#bitmask type here
+    1: TreeIndex,
+    2: BitmapIndex # if the field has at most MAX_CARD values, else TreeIndex
 }
 
 FILES_DIR = 'files'
 MAX_CARD = 8
+BATCH_SIZE = 1000 # rows per contiguous heap write in insert_many
 
 # if changed, need to modify in heap.py as well
 TYPES = {
@@ -49,7 +72,7 @@ TYPE_DEFAULT = {
 
 def dict_eq(dict1, dict2):
     "helper function to test equality of dictionaries of dictionaries"
-    if not sorted(list(dict1.keys()))==sorted(list(dict2.keys())):
+    if not set(dict1.keys())==set(dict2.keys()):
         return False
     eq = True
     for key in dict1.keys():
@@ -61,26 +84,165 @@ def dict_eq(dict1, dict2):
             break
     return eq
 
+def top_k(values, k, reverse=False):
+    """
+    helper function to return the positions of the first k values in the
+    order of a stable argsort (reversed if reverse), selecting them with a
+    partition instead of sorting all of them
+    """
+    n = len(values)
+    if k >= n:
+        order = np.argsort(values, kind='stable')
+        return order[::-1] if reverse else order
+    pivot = np.partition(values, n - k if reverse else k - 1)[n - k if reverse else k - 1]
+    # take the values equal to the pivot that a full sort would put first
+    if reverse:
+        beyond = np.flatnonzero(values > pivot)
+        ties = np.flatnonzero(values == pivot)
+        ties = ties[len(ties) - (k - len(beyond)):]
+    else:
+        beyond = np.flatnonzero(values < pivot)
+        ties = np.flatnonzero(values == pivot)[:k - len(beyond)]
+    chosen = np.sort(np.concatenate([beyond, ties]))
+    order = chosen[np.argsort(values[chosen], kind='stable')]
+    return order[::-1] if reverse else order
+
+def page_bounds(additional):
+    "helper function to return the 'offset' of a select and where its 'limit' ends (None if unlimited)"
+    offset = int(additional['offset']) if additional and 'offset' in additional else 0
+    if additional and 'limit' in additional:
+        return offset, offset + int(additional['limit'])
+    return offset, None
+
+class LazyRow(dict):
+    """
+    Dictionary of the metadata of a row, whose 'ts' is only read from the
+    tsheap the first time it is looked up. Until then it holds a pin of the
+    tsheap, so that its slot is not reused in the meantime.
+    """
+    def __init__(self, load_ts, pin=None):
+        super().__init__()
+        self._load_ts = load_ts
+        self._pin = pin
+
+    def __missing__(self, key):
+        if key == 'ts' and self._load_ts is not None:
+            self['ts'] = self._load_ts()
+            self._load_ts = None
+            self._pin = None
+            return self['ts']
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key == 'ts' and self._load_ts is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+class LazyIndexes(dict):
+    """
+    Secondary indexes of a database by field, each opened the first time
+    it is looked up. Only the open indexes are iterated over, but `in` and
+    get() cover every indexed field.
+    """
+    def __init__(self, fields, open_index, lock, load_times):
+        super().__init__()
+        self.fields = set(fields)
+        self._open_index = open_index
+        self._lock = lock
+        # field: seconds taken to open its index
+        self.load_times = load_times
+
+    def __missing__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        with self._lock:
+            # another thread may have opened it while this one waited
+            if not dict.__contains__(self, field):
+                start = time.perf_counter()
+                index = self._open_index(field)
+                self.load_times[field] = time.perf_counter() - start
+                self[field] = index
+        return dict.__getitem__(self, field)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def get(self, field, default=None):
+        return self[field] if field in self else default
+
+    def is_loaded(self, field):
+        return dict.__contains__(self, field)
+
+def locked(method):
+    "decorator to run a database method while holding the database lock"
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class PersistentDB(BaseDB):
     """
     Database implementation to allow for persistent storage. It's implemented
     using Binary Trees and BitMasks.
     """
-    def __init__(self, schema=None, pk_field='pk', db_name='default', ts_length=1024, testing=False):
+    def __init__(self, schema=None, pk_field='pk', db_name='default', ts_length=1024, testing=False, columnar=None,
+                 wal=False, wal_sync_every=64, wal_sync_ms=10, checkpoint_interval=30,
+                 cache_size=DEFAULT_CACHE_SIZE, ts_codec=None, lazy_indexes=True, warm_up=False):
         """
         Initializes database with index and schema.
 
         Parameters
         ----------
         schema : dict
-            informs data columns to store in database
+            informs data columns to store in database. A composite index is
+            declared under the tuple of the numeric fields it indexes, eg
+            ('blarg', 'order'): {'covering': ['mean']}, where 'covering'
+            lists numeric fields whose values are stored in the index too
         pk_field : dict
             new metadata dictionary to be inserted
+        ts_length : int
+            length every timeseries must have, or None to accept any length.
+            Variable length series are stored as length-prefixed records,
+            with their offset and size in the metaheap.
+        columnar : bool
+            store the metadata one file per column rather than one packed
+            record per row. Defaults to the stored layout, or rows if new.
+        wal : bool
+            log every change to a write ahead log before applying it. The
+            indexes and the free-list are then only saved by checkpoint(),
+            which runs every `checkpoint_interval` seconds in the background
+            and on close. A log left by a crash is replayed on open.
+        wal_sync_every, wal_sync_ms : int
+            group commit: the log is fsync'd once this many changes are
+            pending, or this many milliseconds after the oldest one
+        cache_size : int
+            memory budget in bytes of the page cache the metaheap is read
+            through, 0 for none; the timeseries are read from a memory map
+            of the tsheap instead. Its counters are in self.pool.stats().
+            With a write ahead log, dirty pages are only written back on
+            eviction, checkpoint or close, once the log records they depend
+            on are fsync'd; otherwise writes go straight to disk. Without a
+            cache, a write ahead log is fsync'd before every change to the
+            metaheap, and before a freed tsheap slot is reused.
+        ts_codec : string
+            encoding of the timeseries written to the tsheap: 'raw',
+            'float32' (lossy), 'xor' or 'zlib', with the times stored once if
+            they are the same for every series. Defaults to the stored
+            codec, or to fixed length records of raw times and values if new.
+        lazy_indexes : bool
+            open each secondary index the first time it is used, rather than
+            all of them on open. Indexes that have to be built are opened
+            right away regardless. See startup_report() for the time each
+            took to load.
+        warm_up : bool
+            with lazy_indexes, open the indexes in a background thread after
+            the database is opened, see warm_up()
         """
         # TODO DNY: set up bitmask indexes
 
-        # COULD DO DNY: create function that eliminates deleted values in the heaps
         # COULD DO DNY: support non-string primary keys
         # COULD DO: add in a field_to_index method to the MetaHeap class,
         # eliminating the need to use the .index() function in the database
@@ -119,36 +281,197 @@ class PersistentDB(BaseDB):
         else:
             self.tsLength = ts_length
             self.pkfield = pk_field
+            self._check_composites(schema)
             self.schema = dict(schema)
             self.vps = dict()
             with open(self.data_dir+"/db_metadata.met",'xb',buffering=0) as fd:
                 pickle.dump((self.tsLength, self.pkfield, self.schema), fd)
             # add metavalues to a copy of schema here
-            schema = dict(schema)
+            schema = {field: value for field, value in schema.items()
+                      if not isinstance(field, tuple)}
             schema['deleted'] = {'type': 'bool', 'index': None}
             schema['ts_offset'] = {'type': 'int', 'index': None}
+            if ts_length is None:
+                # size in bytes of the variable length tsheap records
+                schema['ts_size'] = {'type': 'int', 'index': None}
+
+        # composite indexes are kept apart from the fields
+        self.composites = {fields: value for fields, value in self.schema.items()
+                                         if isinstance(fields, tuple)}
+        self.schema = {field: value for field, value in self.schema.items()
+                                    if not isinstance(field, tuple)}
+
+        # finish swapping in the files of an interrupted vacuum
+        self._finish_vacuum()
 
         # open heap files
-        self.metaheap = MetaHeapFile(FILES_DIR+"/"+self.dbname+"/"+'metaheap', schema)
-        self.tsheap = TSHeapFile(FILES_DIR+"/"+self.dbname+"/"+'tsheap', self.tsLength)
+        metaheap_name = FILES_DIR+"/"+self.dbname+"/"+'metaheap'
+        stored_columnar = os.path.exists(metaheap_name+'_columns.met')
+        if columnar is None:
+            columnar = stored_columnar
+        elif (stored_columnar or os.path.exists(metaheap_name+'_metadata.met')) \
+             and columnar != stored_columnar:
+            raise ValueError("columnar does not match the stored metaheap layout. pass in columnar=None")
+        self.pool = BufferPool(cache_size, write_back=wal) if cache_size else None
+        if columnar:
+            self.metaheap = ColumnarMetaHeapFile(metaheap_name, schema, self.pool)
+        else:
+            self.metaheap = MetaHeapFile(metaheap_name, schema, self.pool)
+        # with a write ahead log, saving the free-list and indexes is deferred
+        # to checkpoints
+        self._autosave = not wal
+        # the timeseries are read zero-copy from a memory map of the tsheap,
+        # which the OS caches, rather than through the page cache
+        self.tsheap = TSHeapFile(FILES_DIR+"/"+self.dbname+"/"+'tsheap', self.tsLength,
+                                 autosave=self._autosave, codec=ts_codec)
+
+        # how long the indexes took to open, in seconds, see startup_report()
+        self.load_times = {}
+        self._open_lock = threading.RLock()
 
         # open / load primary key index
-        self.pks = PKIndex(self.dbname)
+        start = time.perf_counter()
+        self.pks = PKIndex(self.dbname, autosave=self._autosave)
+        self.load_times['pks'] = time.perf_counter() - start
 
         # DNY: to store fields that will have associated indexes
         self.indexFields = [field for field, value in self.schema.items()
                                   if value['index'] is not None]
-        self.indexes = {}
-        for field in self.indexFields:
-            if (self.schema[field]['index']==2) and (len(self.schema[field]['values']) <= MAX_CARD):
-                # TODO self.indexes[field] = BitMaskIndex()
-                self.indexes[field] = TreeIndex(field, self.dbname)
-            else:
-                self.indexes[field] = TreeIndex(field, self.dbname)
+        # every index, by field or tuple of fields, and the fields they need
+        self._index_keys = self.indexFields + list(self.composites)
+        self._index_columns = list(self.indexFields)
+        for fields, value in self.composites.items():
+            for field in fields + tuple(value.get('covering', [])):
+                if field not in self._index_columns:
+                    self._index_columns.append(field)
+        # the secondary indexes share their row ids, so that their matches
+        # can be combined as integer arrays and bitmaps. Read on first use
+        self._rowids = None
+        self.indexes = LazyIndexes(self._index_keys, self._open_index, self._open_lock, self.load_times)
+        # build the indexes that are not on disk yet, eg a field that is
+        # bitmap indexed since this database was created
+        new_fields = [field for field in self._index_keys
+                      if not lazy_indexes or not self._index_is_current(field)]
+        new_fields = [field for field in new_fields if self.indexes[field].created]
+        if new_fields and len(self.pks):
+            self._rebuild_indices(new_fields)
 
         # load vantage points
         self.load_vps()
 
+        # replay the write ahead log of a previous run, if it was not closed
+        self._lock = threading.RLock()
+        self._replaying = False
+        # multi-version reads, see snapshot()
+        self._epoch = 0 # bumped by every change
+        self._snapshots = []
+        self._versions = defaultdict(list) # pk: [(epoch of a change, row before it)]
+        self._deferred_frees = [] # (epoch, ts_offset) a snapshot may still read
+        wal_file = self.data_dir+"/wal.log"
+        self.wal = None
+        if wal or os.path.exists(wal_file):
+            self.wal = WriteAheadLog(wal_file, wal_sync_every, wal_sync_ms)
+            self._recover()
+        if not wal and self.wal is not None:
+            self.wal.close()
+            self.wal = None
+            os.remove(wal_file)
+        self._attach_wal()
+
+        # checkpoint in the background
+        self.checkpoint_interval = checkpoint_interval
+        self._closing = threading.Event()
+        self._checkpointer = None
+        if self.wal is not None:
+            self._checkpointer = threading.Thread(target=self._checkpoint_loop, daemon=True)
+            self._checkpointer.start()
+
+        self._warmer = None
+        if warm_up:
+            self.warm_up(background=True)
+
+    @property
+    def rowids(self):
+        "the RowIds of the secondary indexes, read from disk on first use"
+        if self._rowids is None:
+            with self._open_lock:
+                if self._rowids is None:
+                    start = time.perf_counter()
+                    rowids = RowIds(self.data_dir+"/rowids.rid")
+                    self.load_times['rowids'] = time.perf_counter() - start
+                    self._rowids = rowids
+        return self._rowids
+
+    def warm_up(self, background=False):
+        """
+        Open every secondary index that is not open yet, in a daemon thread
+        if background, which is returned. A query meanwhile opens the index
+        it needs itself, or waits for the thread to finish opening it.
+        """
+        if not background:
+            for field in self._index_keys:
+                self.indexes[field]
+            return None
+        self._warmer = threading.Thread(target=self.warm_up, daemon=True)
+        self._warmer.start()
+        return self._warmer
+
+    def startup_report(self):
+        """
+        Time each index took to open, as a printable table. The secondary
+        indexes not used yet are listed as not loaded.
+        """
+        lines = ["{:<24} {:>10}".format('index', 'seconds')]
+        for name in ['pks', 'rowids'] + self._index_keys:
+            label = '+'.join(name) if isinstance(name, tuple) else name
+            if name in self.load_times:
+                lines.append("{:<24} {:>10.4f}".format(label, self.load_times[name]))
+            else:
+                lines.append("{:<24} {:>10}".format(label, 'not loaded'))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _check_composites(schema):
+        "helper function to check the composite indexes declared in a schema"
+        for fields, value in schema.items():
+            if not isinstance(fields, tuple):
+                continue
+            for field in fields + tuple(value.get('covering', [])):
+                if field not in schema or schema[field]['type'] not in ('int', 'float', 'bool'):
+                    raise ValueError("Composite index {} on '{}', which is not a numeric field".format(fields, field))
+
+    def _is_bitmap_field(self, field):
+        "helper function to tell whether a field gets a BitmapIndex"
+        if isinstance(field, tuple):
+            return False
+        return (self.schema[field]['index']==2) and (len(self.schema[field]['values']) <= MAX_CARD)
+
+    def _index_is_current(self, field):
+        """
+        helper function to tell, without opening it, whether the index of a
+        field is on disk in the current format
+        """
+        if self._is_bitmap_field(field):
+            filename = FILES_DIR+"/"+self.dbname+"/"+field+".bmi"
+        elif isinstance(field, tuple):
+            filename = FILES_DIR+"/"+self.dbname+"/"+'+'.join(field)+".idx"
+        else:
+            filename = FILES_DIR+"/"+self.dbname+"/"+field+".idx"
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            return False
+        return self._is_bitmap_field(field) or BPlusTree.is_btree(filename)
+
+    def _open_index(self, field):
+        "helper function to open the index of a field, or a tuple of fields"
+        if isinstance(field, tuple):
+            return CompositeIndex(field, self.composites[field].get('covering', []), self.dbname,
+                                  autosave=self._autosave, rowids=self.rowids)
+        if self._is_bitmap_field(field):
+            return BitmapIndex(self.schema[field]['values'], field, self.dbname,
+                               autosave=self._autosave, rowids=self.rowids)
+        else:
+            return TreeIndex(field, self.dbname, autosave=self._autosave, rowids=self.rowids)
+
     def load_vps(self):
         " method to load vantage point labels from disk "
         if os.path.exists(self.data_dir+"/db_vps.met"):
@@ -198,9 +521,145 @@ class PersistentDB(BaseDB):
 
     def close(self):
         "helper function to close the database"
+        if self._warmer is not None:
+            self._warmer.join()
+        if self.wal is not None:
+            self._closing.set()
+            self._checkpointer.join()
+            self.checkpoint()
+            self.wal.close()
+            self.wal = None
         self.metaheap.close()
         self.tsheap.close()
         self.pks.close()
+        for index in list(self.indexes.values()):
+            index.close()
+        if self._rowids is not None:
+            self._rowids.close()
+
+    def _attach_wal(self):
+        "helper function to have the heaps, and the page cache, write no change before its log record"
+        if self.wal is None:
+            return
+        if self.pool is not None:
+            self.pool.attach_wal(self.wal)
+        self.tsheap.attach_wal(self.wal)
+        self.metaheap.attach_wal(self.wal)
+
+    def _log(self, op, *args):
+        "helper function to write a change to the write ahead log, if used"
+        if self.wal is not None and not self._replaying:
+            self.wal.append(op, *args)
+
+    @locked
+    def checkpoint(self):
+        """
+        Force the heaps, the free-list and every index to disk, and empty
+        the write ahead log, which they now cover. Does nothing without one.
+        """
+        if self.wal is None:
+            return
+        self.wal.sync()
+        self.tsheap.sync()
+        self.metaheap.sync()
+        self.pks.flush()
+        for index in list(self.indexes.values()):
+            index.flush()
+        self.wal.truncate()
+
+    def _checkpoint_loop(self):
+        while not self._closing.wait(self.checkpoint_interval):
+            if len(self.wal):
+                self.checkpoint()
+
+    def _recover(self):
+        """
+        helper function to replay the write ahead log over the last
+        checkpoint. Changes may have reached the heaps before the crash, so
+        every operation is checked against the current state, and the
+        secondary indexes are rebuilt from the metaheap afterwards.
+        """
+        records = self.wal.replay()
+        if not records:
+            return
+        self._replaying = True
+        try:
+            for lsn, op, args in records:
+                self._replay(op, args)
+        finally:
+            self._replaying = False
+        self._rebuild_indices()
+        self.checkpoint()
+
+    def _replay(self, op, args):
+        "helper function to apply a change read back from the write ahead log"
+        deleted_idx = self.metaheap.fields.index('deleted')
+        ts_idx = self.metaheap.fields.index('ts_offset')
+        if op == 'insert_ts':
+            pk, times, values = args
+            if pk not in self.pks:
+                self.insert_ts(pk, timeseries.TimeSeries(times, values))
+        elif op == 'insert_many':
+            rows = [(pk, timeseries.TimeSeries(times, values), meta)
+                    for pk, times, values, meta in args[0] if pk not in self.pks]
+            self.insert_many(rows)
+        elif op == 'upsert_meta':
+            pk, new_meta = args
+            if pk in self.pks:
+                meta = self.metaheap.read_and_return_meta(self.pks[pk])
+                # a tombstone means a logged delete of this pk follows
+                if not meta[deleted_idx]:
+                    self._merge_meta(meta, new_meta)
+                    self.metaheap.encode_and_write_meta(meta, self.pks[pk])
+        elif op == 'delete_ts':
+            pk, = args
+            if pk in self.pks:
+                ts_offset = self.metaheap.read_and_return_meta(self.pks[pk])[ts_idx]
+                self._write_tombstone(pk, ts_offset)
+                self.pks.remove(pk)
+                self.tsheap.free(ts_offset)
+        else:
+            raise ValueError("Unknown operation '{}' in the write ahead log".format(op))
+
+    def _rebuild_indices(self, fields=None):
+        "helper function to build the secondary indexes again from the metaheap, all by default"
+        if fields is None:
+            fields = self._index_keys
+        pks = list(self.pks.keys())
+        columns = self._read_columns(pks, self._index_columns)
+        for field in fields:
+            self.indexes[field].deleteIndex()
+            self.indexes[field] = self._open_index(field)
+            if isinstance(field, tuple):
+                rows = [{f: columns[f][0][n] for f in self._index_columns if columns[f][1][n]}
+                        for n in range(len(pks))]
+                self.indexes[field].insert_many(self._composite_entries(field, rows, pks))
+                continue
+            values, is_set = columns[field]
+            self.indexes[field].insert_many([(value, pk) for value, was_set, pk
+                                             in zip(values, is_set, pks) if was_set])
+
+    def _composite_entries(self, fields, rows, pks):
+        """
+        helper function to return the entries of the composite index on
+        fields for rows, dictionaries of their set values
+        """
+        covering = self.composites[fields].get('covering', [])
+        entries = []
+        for row, pk in zip(rows, pks):
+            if all(field in row for field in fields):
+                entries.append((tuple(row[field] for field in fields), pk,
+                                tuple(row.get(field, np.nan) for field in covering)))
+        return entries
+
+    def _meta_list_to_row(self, meta, fields):
+        "helper function to return the set values of fields in a metaheap list as a dictionary"
+        row = {}
+        for field in fields:
+            field_idx = self.metaheap.fields.index(field)
+            if self.schema[field]['type'] == "bool" or meta[field_idx+1]:
+                row[field] = meta[field_idx]
+        return row
 
     def _check_pk(self,pk):
         "helper function to check that 'pk' is a string"
@@ -209,6 +668,17 @@ class PersistentDB(BaseDB):
         except:
             raise ValueError('pk must be a string object')
 
+    def _check_ts(self, pk, ts):
+        "helper function to check a pk and timeseries before they are inserted"
+        self._check_pk(pk)
+        if not isinstance(ts, timeseries.TimeSeries):
+            raise ValueError('ts must be a timeseries.Timeseries object')
+        if pk in self.pks:
+            raise ValueError('Duplicate primary key found during insert')
+        if self.tsLength is not None and len(ts) != self.tsLength:
+            raise ValueError('TimeSeries must have length {}. Current length: {}'.format(self.tsLength, len(ts)))
+
+    @locked
     def insert_ts(self, pk, ts):
         """
         Given a pk and a timeseries, insert them"
@@ -220,25 +690,21 @@ class PersistentDB(BaseDB):
         new_meta : dict
             new metadata dictionary to be inserted
         """
-        self._check_pk(pk)
-        if not isinstance(ts, timeseries.TimeSeries):
-            raise ValueError('ts must be a timeseries.Timeseries object')
-        if pk in self.pks:
-            raise ValueError('Duplicate primary key found during insert')
-        if len(ts) != self.tsLength:
-            raise ValueError('TimeSeries must have length {}. Current length: {}'.format(self.tsLength, len(ts)))
+        self._check_ts(pk, ts)
+        self._log('insert_ts', pk, ts._times, ts._values)
+        self._save_version(pk)
 
-        ts_offset = self.tsheap.encode_and_write_ts(ts) # write ts to tsheap file
+        ts_offset, ts_size = self.tsheap.write_extent(ts) # write ts to tsheap file
 
         # DNY: write default meta values to disk
         meta = list(self.metaheap.fieldsDefaultValues)
-        meta[self.metaheap.fields.index('ts_offset')] = ts_offset
-        meta[self.metaheap.fields.index('ts_offset_set')] = True
+        self._set_extent(meta, ts_offset, ts_size)
         pk_offset = self.metaheap.encode_and_write_meta(meta)
 
         self.pks[pk] = pk_offset
         self.update_indices(pk)
 
+    @locked
     def delete_ts(self,pk):
         """
         Given a pk, remove that timeseries from the database.
@@ -250,25 +716,220 @@ class PersistentDB(BaseDB):
             primary key
         """
         self._check_pk(pk)
-        old_meta_dict = self._get_meta_dict(pk,deleting=True)
+        old_meta_dict = self._get_meta_dict(pk,deleting=True,fields=self._index_columns)
+        self._log('delete_ts', pk)
+        self._save_version(pk)
 
-        # write tombstone marker to the metaheap [[[
-        # COULD DO DNY: add list of timeseries to be deleted, for later maintenance
-        # currently, left as a ts_offset and deleted=True within the metaheap file
-        delete_meta = list(self.metaheap.fieldsDefaultValues)
-        delete_meta[self.metaheap.fields.index('ts_offset')] = old_meta_dict['ts_offset']
-        delete_meta[self.metaheap.fields.index('ts_offset_set')] = True
-        delete_meta[self.metaheap.fields.index('deleted')] = True
-        pk_offset = self.pks[pk]
-        # write deleted values to metaheap
-        self.metaheap.encode_and_write_meta(delete_meta, pk_offset)
-        # ]]]
+        self._write_tombstone(pk, old_meta_dict['ts_offset'])
 
         # remove from auxilary indices
         self.remove_indices(pk, old_meta_dict)
 
         # remove from primary index
         self.pks.remove(pk)
+        self._free_ts(old_meta_dict['ts_offset'])
+
+    def _save_version(self, pk):
+        """
+        helper function to call before pk is changed. Starts a new epoch, and
+        keeps the row as it was for the snapshots taken before it.
+        """
+        versions = self._versions.get(pk)
+        last = versions[-1][0] if versions else 0
+        self._epoch += 1
+        # a snapshot reads the first version after it, so a row keeps one
+        # version per snapshot taken since its last change, at most
+        if any(snap.epoch >= last for snap in self._snapshots):
+            row = self._read_fields(pk, self._meta_fields()[1]) if pk in self.pks else None
+            self._versions[pk].append((self._epoch, row))
+
+    def _free_ts(self, ts_offset):
+        "helper function to free a tsheap slot, once no open snapshot can read it"
+        if self._snapshots:
+            self._deferred_frees.append((self._epoch, ts_offset))
+        else:
+            self.tsheap.free(ts_offset)
+
+    def snapshot(self):
+        """
+        Consistent read-only view of the database as it is now, which later
+        changes do not show up in. Close it when done, or use it as a context
+        manager: until then the rows it can see are kept around.
+
+        The old versions of the rows are only kept in memory, one metaheap
+        row per changed row and open snapshot at most, and the database
+        cannot be vacuumed while a snapshot is open. Snapshots are meant for
+        reads that take a while, not to be kept open for good.
+
+        Returns
+        -------
+        Snapshot
+        """
+        return Snapshot(self)
+
+    @locked
+    def _release_snapshot(self, snapshot):
+        "helper function to drop the versions that no open snapshot needs any more"
+        self._snapshots.remove(snapshot)
+        if not self._snapshots:
+            oldest = self._epoch
+        else:
+            oldest = min(snap.epoch for snap in self._snapshots)
+        # a snapshot reads the first version changed after it was taken
+        for pk in list(self._versions):
+            versions = [v for v in self._versions[pk] if v[0] > oldest]
+            if versions:
+                self._versions[pk] = versions
+            else:
+                del self._versions[pk]
+        still_read = []
+        for epoch, ts_offset in self._deferred_frees:
+            if epoch > oldest:
+                still_read.append((epoch, ts_offset))
+            else:
+                self.tsheap.free(ts_offset)
+        self._deferred_frees = still_read
+
+    def _set_extent(self, meta, ts_offset, ts_size):
+        "helper function to point a meta list at a tsheap record"
+        meta[self.metaheap.fields.index('ts_offset')] = ts_offset
+        meta[self.metaheap.fields.index('ts_offset_set')] = True
+        if 'ts_size' in self.metaheap.fields:
+            meta[self.metaheap.fields.index('ts_size')] = ts_size
+            meta[self.metaheap.fields.index('ts_size_set')] = True
+
+    def _write_tombstone(self, pk, ts_offset):
+        """
+        helper function to write the tombstone marker of pk to the metaheap.
+        It is left as a ts_offset and deleted=True within the metaheap file,
+        until the next vacuum. The tsheap slot is reused once nothing reads it.
+        """
+        delete_meta = list(self.metaheap.fieldsDefaultValues)
+        delete_meta[self.metaheap.fields.index('ts_offset')] = ts_offset
+        delete_meta[self.metaheap.fields.index('ts_offset_set')] = True
+        delete_meta[self.metaheap.fields.index('deleted')] = True
+        self.metaheap.encode_and_write_meta(delete_meta, self.pks[pk])
+
+    @locked
+    def vacuum(self):
+        """
+        Reclaim the space of deleted timeseries.
+
+        The live records are rewritten into new heap files, with the offsets
+        in the primary key index and the ts_offset column remapped. The new
+        files are swapped in atomically: a commit file listing the renames is
+        written first, and an interrupted swap is finished on the next open.
+        The row ids of the secondary indexes are then handed out again, to
+        the live pks only, and the indexes built again with them.
+
+        Returns
+        -------
+        int
+            number of bytes reclaimed from the heaps
+        """
+        if self._snapshots:
+            raise RuntimeError("cannot vacuum while snapshots are open")
+        # the new files are written from the checkpointed state
+        self.checkpoint()
+        self.pks.flush()
+        pks = list(self.pks.keys())
+        ts_idx = self.metaheap.fields.index('ts_offset')
+        metas = [self.metaheap.read_and_return_meta(self.pks[pk]) for pk in pks]
+        size_before = self._heap_size()
+
+        # write the live records to new heaps, next to the old ones
+        new_tsheap = self._vacuum_heap(self.tsheap)
+        new_metaheap = self._vacuum_heap(self.metaheap)
+        new_offsets = []
+        for start in range(0, len(pks), BATCH_SIZE):
+            batch_metas = metas[start:start+BATCH_SIZE]
+            ts_list = [self.tsheap.read_and_decode_ts(meta[ts_idx]) for meta in batch_metas]
+            for meta, extent in zip(batch_metas, new_tsheap.write_extents(ts_list)):
+                self._set_extent(meta, *extent)
+            new_offsets += new_metaheap.encode_and_write_many(batch_metas)
+        new_pks = dict(zip(pks, new_offsets))
+
+        renames = []
+        for new_heap, heap in ((new_tsheap, self.tsheap), (new_metaheap, self.metaheap)):
+            for new, old in zip(new_heap.data_files(), heap.data_files()):
+                with open(new, 'rb') as fd:
+                    os.fsync(fd.fileno())
+                renames.append((new, old))
+            new_heap.close()
+        # the free-list and the primary key index start over as well
+        with open(self.tsheap.free_file+'.vacuum', 'wb', buffering=0) as fd:
+            pickle.dump([], fd)
+            os.fsync(fd.fileno())
+        renames.append((self.tsheap.free_file+'.vacuum', self.tsheap.free_file))
+        PKIndex.write_file(self.pks.filename+'.vacuum', new_pks.items())
+        renames.append((self.pks.filename+'.vacuum', self.pks.filename))
+
+        # swap the new files in
+        self.tsheap.close()
+        self.metaheap.close()
+        with open(self.data_dir+"/vacuum.met", 'wb', buffering=0) as fd:
+            pickle.dump(renames, fd)
+            os.fsync(fd.fileno())
+        self._finish_vacuum()
+
+        self.tsheap = TSHeapFile(self.tsheap.filename, self.tsLength, self.tsheap.use_mmap,
+                                 self._autosave)
+        self.metaheap = type(self.metaheap)(self.metaheap.filename, None, self.pool)
+        self._attach_wal()
+        self.pks.reopen()
+        self._compact_rowids()
+        return size_before - self._heap_size()
+
+    def _compact_rowids(self):
+        """
+        helper function to give the live pks the row ids from 0 again, those
+        of deleted pks being dropped, and build the indexes with them
+        """
+        for field in self._index_keys:
+            self.indexes[field].deleteIndex()
+        dict.clear(self.indexes)
+        self.rowids.delete()
+        self._rowids = None
+        self._rebuild_indices()
+        # the indexes are only saved by a checkpoint under the log
+        self.checkpoint()
+
+    def _heap_size(self):
+        "helper function to return the total size of the heap files in bytes"
+        return sum(os.path.getsize(f) for f in self.tsheap.data_files() + self.metaheap.data_files())
+
+    def _vacuum_heap(self, heap):
+        "helper function to create an empty copy of a heap, to vacuum into"
+        name = heap.filename+'.vacuum'
+        # the new heap shares the metadata of the old one
+        suffixes = [suffix for suffix in ('_metadata.met', '_columns.met')
+                           if os.path.exists(heap.filename+suffix)]
+        for suffix in suffixes:
+            shutil.copyfile(heap.filename+suffix, name+suffix)
+        if isinstance(heap, TSHeapFile):
+            new_heap = TSHeapFile(name, self.tsheap.ts_length, use_mmap=False)
+        else:
+            new_heap = type(heap)(name, None)
+        for suffix in suffixes:
+            os.remove(name+suffix)
+        return new_heap
+
+    def _finish_vacuum(self):
+        """
+        helper function to swap in the files written by a vacuum, if its
+        commit file exists. Otherwise any leftover files are removed.
+        """
+        commit_file = self.data_dir+"/vacuum.met"
+        if os.path.exists(commit_file):
+            with open(commit_file, 'rb', buffering=0) as fd:
+                renames = pickle.load(fd)
+            for new, old in renames:
+                if os.path.exists(new):
+                    os.replace(new, old)
+            os.remove(commit_file)
+        for f in os.listdir(self.data_dir):
+            if '.vacuum' in f:
+                os.remove(self.data_dir+"/"+f)
 
     def _get_meta_list(self,pk):
         "helper function to return associated metadata in a list"
@@ -280,25 +941,70 @@ class PersistentDB(BaseDB):
         else:# ought not to be called very often, if at all
             raise KeyError("Primary key '{}' was deleted and has not been reassigned".format(pk))
 
-    def _get_meta_dict(self,pk,deleting=False):
-        "helper function to return associated metadata in a dictionary"
-        metaList = self._get_meta_list(pk)
-        meta = {}
-        for n, field in enumerate(self.metaheap.fields):
-            if field in self.schema.keys():
-                if self.schema[field]['type'] == "bool" or metaList[n+1]:
-                    meta[field] = metaList[n]
-            elif deleting and field == 'ts_offset':
-                meta[field] = metaList[n]
+    def _read_fields(self, pk, fields):
+        """
+        helper function to read only the given metaheap fields of pk, along
+        with where its timeseries is stored
+        """
+        self._check_pk(pk)
+        heap_fields = ['deleted', 'ts_offset'] + list(fields)
+        if 'ts_size' in self.metaheap.fields:
+            heap_fields.append('ts_size')
+        raw = self.metaheap.read_fields(self.pks[pk], heap_fields)
+        if raw['deleted']:# ought not to be called very often, if at all
+            raise KeyError("Primary key '{}' was deleted and has not been reassigned".format(pk))
+        return raw
+
+    def _get_meta_dict(self,pk,deleting=False,fields=None):
+        """
+        helper function to return associated metadata in a dictionary.
+        Only the metadata fields given are read, all of them by default. The
+        'ts' is read when it is first looked up (see LazyRow), so by then
+        it may have been changed.
+        """
+        fields, heap_fields = self._meta_fields(fields)
+        raw = self._read_fields(pk, heap_fields)
+        # the slot of a row being deleted is freed while its meta is around
+        meta = self._raw_to_row(raw, fields, pin=not deleting)
+        if deleting:
+            meta['ts_offset'] = raw['ts_offset']
+        return meta
+
+    def _meta_fields(self, fields=None):
+        """
+        helper function to return the schema fields in the metaheap out of
+        fields (all of them by default), and the metaheap fields storing them
+        """
+        if fields is None:
+            fields = [f for f in self.metaheap.fields if f in self.schema]
+        else:
+            fields = [f for f in fields if f in self.metaheap.fields and f in self.schema]
+        heap_fields = []
+        for field in fields:
+            heap_fields.append(field)
+            if self.schema[field]['type'] != "bool":
+                heap_fields.append(field+"_set")
+        return fields, heap_fields
+
+    def _raw_to_row(self, raw, fields, pin=True):
+        "helper function to turn a _read_fields dictionary into a row dictionary"
         # ASK: this needs to contain the ts as well
-        meta['ts'] = self._return_ts(pk)
+        meta = LazyRow(lambda: self._read_ts(raw), self.tsheap.pin() if pin else None)
+        for field in fields:
+            if self.schema[field]['type'] == "bool" or raw[field+"_set"]:
+                meta[field] = raw[field]
         return meta
 
+    def _read_ts(self, raw):
+        "helper function to read the timeseries that a _read_fields dictionary points to"
+        # with a size, the whole record is read at once
+        return self.tsheap.read_and_decode_ts(raw['ts_offset'], raw.get('ts_size'))
+
     def _return_ts(self,pk):
         "helper function to return an associated timeseries"
-        ts_offset = self._get_meta_list(pk)[self.metaheap.fields.index('ts_offset')]
-        return self.tsheap.read_and_decode_ts(ts_offset)
+        return self._read_ts(self._read_fields(pk, []))
 
+    @locked
     def upsert_meta(self, pk, new_meta):
         """
         Upsert metadata into the timeseries in the database.
@@ -318,8 +1024,18 @@ class PersistentDB(BaseDB):
 
         pk_offset = self.pks[pk]
         meta = self.metaheap.read_and_return_meta(pk_offset)
-        old_meta_dict = self._get_meta_dict(pk)
+        # only the indexed values are needed, to remove them from the indexes
+        old_meta_dict = self._get_meta_dict(pk, fields=self._index_columns)
+
+        self._merge_meta(meta, new_meta)
+        self._log('upsert_meta', pk, {field: value for field, value in new_meta.items()
+                                      if field in self.metaheap.fields and field in self.schema})
+        self._save_version(pk)
+        self.metaheap.encode_and_write_meta(meta, pk_offset)
+        self.update_indices(pk, old_meta_dict) # pass in old meta for deletion
 
+    def _merge_meta(self, meta, new_meta):
+        "helper function to type check new_meta and write it into a meta list"
         for n, field in enumerate(self.metaheap.fields):
             # will skip all the *_set entries
             if (field in new_meta.keys()) and (field in self.schema.keys()) \
@@ -340,8 +1056,79 @@ class PersistentDB(BaseDB):
             # do not raise an exception if a bad field was passed in, an
             # intentional design choice
 
-        self.metaheap.encode_and_write_meta(meta, pk_offset)
-        self.update_indices(pk, old_meta_dict) # pass in old meta for deletion
+    @locked
+    def insert_many(self, rows, progress=None):
+        """
+        Insert many timeseries, and optionally their metadata, at once.
+
+        Rows are checked up front, then the series and metadata are appended
+        to the heaps BATCH_SIZE rows at a time with one contiguous write per
+        heap, the primary keys are logged with one write per batch, and every
+        secondary index is updated once at the end.
+
+        Parameters
+        ----------
+        rows : iterable
+            (pk, ts) or (pk, ts, meta) tuples
+        progress : function
+            if given, called as progress(n_done, n_total) after every batch
+
+        Returns
+        -------
+        list
+            the primary keys inserted, in order
+        """
+        rows = [tuple(row) for row in rows]
+        new_pks = set()
+        metas = []
+        for row in rows:
+            pk, ts = row[0], row[1]
+            self._check_ts(pk, ts)
+            if pk in new_pks:
+                raise ValueError('Duplicate primary key found during insert')
+            new_pks.add(pk)
+            meta = list(self.metaheap.fieldsDefaultValues)
+            if len(row) > 2 and row[2] is not None:
+                self._merge_meta(meta, row[2])
+            metas.append(meta)
+
+        index_entries = defaultdict(list)
+        n_rows = len(rows)
+        for start in range(0, n_rows, BATCH_SIZE):
+            batch = rows[start:start+BATCH_SIZE]
+            batch_metas = metas[start:start+BATCH_SIZE]
+            self._log('insert_many', [(row[0], row[1]._times, row[1]._values,
+                                       row[2] if len(row) > 2 else None) for row in batch])
+            for row in batch:
+                self._save_version(row[0])
+
+            extents = self.tsheap.write_extents([row[1] for row in batch])
+            for meta, extent in zip(batch_metas, extents):
+                self._set_extent(meta, *extent)
+            pk_offsets = self.metaheap.encode_and_write_many(batch_metas)
+            self.pks.insert_many([(row[0], pk_offset) for row, pk_offset in zip(batch, pk_offsets)])
+
+            # defer the index updates to the end
+            for row, meta in zip(batch, batch_metas):
+                for field in self.indexFields:
+                    field_idx = self.metaheap.fields.index(field)
+                    if self.schema[field]['type'] != "bool" and not meta[field_idx+1]:
+                        continue
+                    index_entries[field].append((meta[field_idx], row[0]))
+                if self.composites:
+                    values = self._meta_list_to_row(meta, self._index_columns)
+                    for fields in self.composites:
+                        index_entries[fields] += self._composite_entries(fields, [values], [row[0]])
+            if progress is not None:
+                progress(start + len(batch), n_rows)
+
+        if not self._replaying:
+            for field, entries in index_entries.items():
+                self.indexes[field].insert_many(entries)
+        if self._autosave:
+            # otherwise left to the next checkpoint
+            self.pks.flush()
+        return [row[0] for row in rows]
 
     def index_bulk(self, pks=[]):
         """
@@ -368,12 +1155,19 @@ class PersistentDB(BaseDB):
         old_meta_dict : dict
             old metadata dictionary
         """
-        for field in self.indexes.keys():
+        if self._replaying:
+            return
+        for field in self.indexFields:
             if field in old_meta_dict.keys():
                 self.indexes[field].remove(old_meta_dict[field], pk)
+        for fields in self.composites:
+            for values, _, _ in self._composite_entries(fields, [old_meta_dict], [pk]):
+                self.indexes[fields].remove(values, pk)
 
     def update_indices(self, pk, old_meta_dict=None):
         "Update indices after a change has occurred. Eg. Called after insertion"
+        if self._replaying:
+            return
         if old_meta_dict is not None:
             self.remove_indices(pk, old_meta_dict)
 
@@ -385,6 +1179,38 @@ class PersistentDB(BaseDB):
                 if not meta[field_idx+1]:
                     continue
             self.indexes[field].insert(meta[field_idx],pk)
+        if self.composites:
+            row = self._meta_list_to_row(meta, self._index_columns)
+            for fields in self.composites:
+                for values, _, covered in self._composite_entries(fields, [row], [pk]):
+                    self.indexes[fields].insert(values, pk, covered)
+
+    def _read_columns(self, pks, fields):
+        """
+        helper function to read whole metadata columns for a list of pks
+
+        Returns a dictionary of field: (values, is_set), both python lists in
+        the order of pks
+        """
+        return {field: (values.tolist(), is_set.tolist())
+                for field, (values, is_set) in self._column_arrays(pks, fields).items()}
+
+    def _column_arrays(self, pks, fields):
+        "helper function to read whole metadata columns for a list of pks, as _read_columns but into numpy arrays"
+        offsets = [self.pks[p] for p in pks]
+        heap_fields = []
+        for field in fields:
+            heap_fields.append(field)
+            if self.schema[field]['type'] != "bool":
+                heap_fields.append(field+"_set")
+        raw = self.metaheap.read_columns(heap_fields, offsets)
+        columns = {}
+        for field in fields:
+            if self.schema[field]['type'] != "bool":
+                columns[field] = (raw[field], raw[field+"_set"].astype(bool))
+            else:
+                columns[field] = (raw[field], np.ones(len(offsets), dtype=bool))
+        return columns
 
     def _getDataForRows(self,pks_out,fields_to_ret):
         "helper function to return appropriate data to user"
@@ -394,21 +1220,29 @@ class PersistentDB(BaseDB):
         if fields_to_ret is None:
             data_list_out = [{} for _ in range(len(pks_out))]
 
-        # return all fields except for the 'ts' field
-        elif fields_to_ret == []:
-            for p in pks_out:
-                values_dict = self._get_meta_dict(p)
-                d = {field:value for field, value in values_dict.items() if field != 'ts'}
-                d[self.pkfield] = p
-                data_list_out.append(d)
-
-        # return all fields that the user has specified
+        # return all fields that the user has specified, or all fields except
+        # for the 'ts' field if the list is empty
         elif isinstance(fields_to_ret,list):
-            for p in pks_out:
-                values_dict = self._get_meta_dict(p)
-                d = {field:values_dict[field] if field in values_dict else 'NA' for field in fields_to_ret}
-                # d = {field:value for field, value in values_dict.items() if field in fields_to_ret}
-                if self.pkfield in fields_to_ret:
+            if fields_to_ret == []:
+                fields = [f for f in self.metaheap.fields if f in self.schema]
+            else:
+                fields = [f for f in fields_to_ret if f in self.metaheap.fields
+                                                   and f in self.schema]
+            # read each requested column once, for all rows
+            columns = self._read_columns(pks_out, fields)
+            for n, p in enumerate(pks_out):
+                values_dict = {}
+                for field in fields:
+                    values, is_set = columns[field]
+                    if is_set[n]:
+                        values_dict[field] = values[n]
+                if fields_to_ret == []:
+                    d = values_dict
+                else:
+                    if 'ts' in fields_to_ret:
+                        values_dict['ts'] = self._return_ts(p)
+                    d = {field:values_dict[field] if field in values_dict else 'NA' for field in fields_to_ret}
+                if fields_to_ret == [] or self.pkfield in fields_to_ret:
                     d[self.pkfield] = p
                 data_list_out.append(d)
 
@@ -418,6 +1252,29 @@ class PersistentDB(BaseDB):
 
         return pks_out, data_list_out
 
+    def _sort_pks(self, pks, sortfield, reverse=False, limit=None):
+        """
+        helper function to sort pks on a metadata column, read as one array.
+        Rows where the column is not set go last. If limit is not None, only
+        the first limit are sure to be in order.
+        """
+        offsets = [self.pks[p] for p in pks]
+        if self.schema[sortfield]['type'] != "bool":
+            raw = self.metaheap.read_columns([sortfield, sortfield+"_set"], offsets)
+            is_set = raw[sortfield+"_set"]
+        else:
+            raw = self.metaheap.read_columns([sortfield], offsets)
+            is_set = np.ones(len(offsets), dtype=bool)
+        set_idx = np.flatnonzero(is_set)
+        if limit is not None:
+            order = set_idx[top_k(raw[sortfield][set_idx], limit, reverse)]
+        else:
+            order = set_idx[np.argsort(raw[sortfield][set_idx], kind='stable')]
+            if reverse:
+                order = order[::-1]
+        order = np.concatenate([order, np.flatnonzero(~is_set)])
+        return [pks[i] for i in order]
+
     def select(self, meta, fields_to_ret=[], additional=None):
         """
         Select timeseries elements in the database that match the criteria set
@@ -432,55 +1289,594 @@ class PersistentDB(BaseDB):
             Otherwise, the timeseries are returned.
         additional: a dictionary object
             additional computation to perform on the query matches before they're
-            returned. You can sort or limit the number of results that you receive.
+            returned. You can sort ('sort_by'), limit ('limit') and page through
+            ('offset') the results that you receive.
         """
-        # Find matching keys
-        pks_out = set(self.pks.keys())
-        for field,criteria in meta.items():
-            if field == self.pkfield:
-                if criteria in self.pks:
-                    pks_out = set([criteria])
+        return self._select(meta, fields_to_ret, additional)
+
+    def aggregate(self, meta, aggregates, group_by=None, bins=10):
+        """
+        Compute aggregates of the rows matching the criteria of a select in
+        the database, rather than from every row returned by select.
+
+        Parameters
+        ----------
+        meta : a dictionary object
+            the selection criteria (filters), as in select
+        aggregates : a list object
+            the aggregates to compute, such as 'count', 'count(blarg)',
+            'sum(order)', 'min(mean)', 'max(mean)', 'mean(std)' or
+            'histogram(mean)'. Rows where the field is not set are left out.
+        group_by : a string
+            If not `None`, the aggregates are computed for every value of
+            this field.
+        bins : an int
+            number of equal width buckets of the histograms
+
+        Returns a dictionary of aggregate: value, or a list of them, one per
+        value of group_by, which they also hold (see aggregates.py). With no
+        criteria and no group_by, counts and the min and max of indexed
+        fields are read from the indexes; otherwise only the columns of the
+        aggregated fields are read, for the matching rows.
+        """
+        specs = []
+        for name in aggregates:
+            func, field = parse_aggregate(name)
+            if field is not None and (field not in self.schema or field not in self.metaheap.fields):
+                raise ValueError("Cannot aggregate column '{}'".format(field))
+            specs.append((name, func, field))
+        if group_by is not None and (group_by not in self.schema or group_by not in self.metaheap.fields):
+            raise ValueError("Cannot group by column '{}'".format(group_by))
+
+        answered = {}
+        if not meta and group_by is None:
+            for name, func, field in specs:
+                found = self._indexed_aggregate(func, field)
+                if found is not None:
+                    answered[name] = found[0]
+            specs = [spec for spec in specs if spec[0] not in answered]
+            if not specs:
+                return {name: answered[name] for name in aggregates}
+
+        pks = self._select(meta, None, None)[0]
+        fields = set(field for _, _, field in specs if field is not None)
+        if group_by is not None:
+            fields.add(group_by)
+        columns = self._column_arrays(pks, sorted(fields))
+        if group_by is not None:
+            return aggregate_groups(specs, len(pks), columns, group_by, bins)
+        answered.update(aggregate_rows(specs, len(pks), columns, bins))
+        return {name: answered[name] for name in aggregates}
+
+    def _indexed_aggregate(self, func, field):
+        """
+        helper function to return a tuple of the value of an aggregate over
+        every row, read from an index, or None if it cannot be
+        """
+        if field is None:
+            return (len(self.pks),)
+        if func not in ('count', 'min', 'max') or field not in self.indexFields:
+            return None
+        index = self.indexes[field]
+        if isinstance(index, BitmapIndex):
+            if func == 'count':
+                return (sum(index.counts),)
+            present = [value for value, count in zip(index.values, index.counts) if count]
+            if not present:
+                return (None,)
+            return (self._from_index(field, min(present) if func == 'min' else max(present)),)
+        if func == 'count':
+            return (len(index.tree),)
+        for entry in (index.tree.items() if func == 'min' else index.tree.reversed_items()):
+            return (self._from_index(field, entry[0]),)
+        return (None,)
+
+    def explain(self, meta, fields_to_ret=[], additional=None):
+        """
+        Run a select, and return how it was planned rather than its results.
+
+        Returns a dictionary with the 'steps' taken to match the criteria, in
+        order, each with the field, operator and value of its criterion, its
+        'access' (the index used, 'filter' to check the rows matched so far,
+        or 'scan' to read a column of every row), the 'estimate' of the rows
+        it would match and the number of 'rows' left after it, and its
+        duration in 'ms'. 'rows' is the number of rows returned, and 'ms'
+        the duration of matching, of sorting and limiting, of reading the
+        fields to return, and in total.
+        """
+        plan = {'steps': []}
+        start = time.perf_counter()
+        pks_out = self._select(meta, fields_to_ret, additional, plan)[0]
+        plan['rows'] = len(pks_out)
+        plan['ms']['total'] = (time.perf_counter() - start) * 1000
+        return plan
+
+    def _select(self, meta, fields_to_ret, additional, plan=None):
+        """
+        helper function to run a select, recording its steps and timings in
+        plan if it is a dictionary, see explain()
+        """
+        timer = time.perf_counter()
+        if plan is not None:
+            plan['ms'] = {}
+        def lap(name):
+            nonlocal timer
+            if plan is not None:
+                now = time.perf_counter()
+                plan['ms'][name] = (now - timer) * 1000
+                timer = now
+
+        # a composite index answers the criteria on its fields in one lookup
+        composite = self._composite_plan(meta)
+        if composite is not None:
+            fields, equal, operator_num, value = composite
+            covered = len(meta) == len(fields) and self._covers(fields, fields_to_ret)
+            if plan is not None:
+                step = {'field': list(fields), 'op': '==', 'value': list(equal),
+                        'access': 'covering' if covered else 'composite'}
+                if operator_num is not None:
+                    step.update(op=OPERATOR_NAMES[operator_num], value=list(equal) + [value])
+                plan['steps'].append(step)
+            if covered:
+                result = self._select_covered(fields, equal, operator_num, value, fields_to_ret, additional)
+                lap('match')
+                return result
+            meta = {field: criteria for field, criteria in meta.items() if field not in fields}
+
+        # Find matching rows, as sorted arrays of row ids, starting from the
+        # criterion expected to match the fewest. Once few rows are left,
+        # criteria expected to match many more are checked against them
+        # rather than looked up, and an empty result ends the search. Only
+        # the rows left are turned into pks
+        criteria = self._plan_criteria(meta)
+        if criteria is None:
+            lap('match')
+            return ([],[])
+        rows = None
+        if composite is not None:
+            step_start = time.perf_counter()
+            rows = self.indexes[fields].getRows(equal, operator_num, value)
+            if plan is not None:
+                plan['steps'][0].update(estimate=None, rows=len(rows),
+                                        ms=(time.perf_counter() - step_start) * 1000)
+        for estimate, access, field, op, val in criteria:
+            if rows is not None and len(rows) == 0:
+                break
+            step_start = time.perf_counter()
+            if rows is not None and (access == 'scan' or len(rows) * FILTER_COST < estimate):
+                access = 'filter'
+                rows = self._filter_rows(rows, field, op, val)
+            else:
+                if access == 'pk':
+                    matches = np.array([self.rowids.id(val)], dtype=np.uint32)
+                elif access == 'bitmap':
+                    matches = self._bitmap_matches(self.indexes[field], val, OPMAP[op]).to_array()
+                elif access == 'tree':
+                    matches = self.indexes[field].getRows(val, OPMAP[op])
                 else:
-                    return ([],[])
+                    matches = self._scan_matches(field, op, val)
+                rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+            if plan is not None:
+                plan['steps'].append({'field': field, 'op': op, 'value': val, 'access': access,
+                                      'estimate': estimate, 'rows': len(rows),
+                                      'ms': (time.perf_counter() - step_start) * 1000})
+        lap('match')
+
+        # Sort and Limit
+        pks_out = self._ordered_from_index(rows, additional)
+        if pks_out is not None:
+            if plan is not None:
+                plan['order'] = 'index'
+        else:
+            if rows is None:
+                pks_out = list(self.pks.keys())
+            else:
+                pks_out = self.rowids.to_pks(rows.tolist())
+            pks_out = self._sort_and_limit(pks_out, additional)
+        lap('sort')
+        result = self._getDataForRows(pks_out,fields_to_ret)
+        lap('fetch')
+        return result
+
+    def _plan_criteria(self, meta):
+        """
+        helper function to return the criteria of a select in the order to
+        check them, as (estimated matches, access, field, operator, value)
+        tuples. The access is 'pk', 'bitmap' or 'tree' for an index lookup,
+        or 'scan' for a field with no index, which go last. Returns None if
+        the criteria cannot match anything.
+        """
+        criteria = []
+        n_rows = len(self.pks)
+        for field, criterion in meta.items():
+            if isinstance(criterion,dict):
+                op,val = list(criterion.items())[0]
+            else:
+                op,val = '==',criterion
+            if field == self.pkfield:
+                if criterion not in self.pks:
+                    return None
+                criteria.append((1, 'pk', field, op, val))
+            elif isinstance(self.indexes.get(field), BitmapIndex):
+                criteria.append((self.indexes[field].estimate(val, OPMAP[op]), 'bitmap', field, op, val))
+            elif field in self.indexes:
+                criteria.append((self.indexes[field].estimate(val, OPMAP[op]), 'tree', field, op, val))
             elif field in self.schema:
-                # Range Query
-                #DNY: TODO change BitmapIndex to contain 'get'
-                if isinstance(criteria,dict):
-                    op,val = list(criteria.items())[0]
-                    matches = self.indexes[field].get(val,OPMAP[op])
-                    pks_out = pks_out & set(matches)
-                # Exact Query
+                # Index does not exist (shouldn't be called often)
+                criteria.append((n_rows, 'scan', field, op, val))
+        criteria.sort(key=lambda criterion: (criterion[1] == 'scan', criterion[0]))
+        return criteria
+
+    def _filter_rows(self, rows, field, op, val):
+        "helper function to keep the row ids whose field matches a criterion, read from the metaheap"
+        pks = self.rowids.to_pks(rows.tolist())
+        values, is_set = self._read_columns(pks, [field])[field]
+        func = OPFUNCS[op]
+        keep = [was_set and func(value, val) for value, was_set in zip(values, is_set)]
+        return rows[np.array(keep, dtype=bool)]
+
+    def index_stats(self):
+        """
+        Statistics of every secondary index, by field: its number of 'rows',
+        of 'distinct' values, and its 'min' and 'max' value. Bitmap indexes
+        also give the 'counts' of rows of each of their values.
+        """
+        stats = {}
+        for field in self.indexFields:
+            index = self.indexes[field]
+            if isinstance(index, BitmapIndex):
+                present = [value for value, count in zip(index.values, index.counts) if count]
+                stats[field] = {'rows': len(index.row_values), 'distinct': len(present),
+                                'min': min(present) if present else None,
+                                'max': max(present) if present else None,
+                                'counts': dict(zip(index.values, index.counts))}
+            else:
+                index_stats = index.stats()
+                stats[field] = {'rows': index_stats.rows, 'distinct': index_stats.distinct,
+                                'min': index_stats.min, 'max': index_stats.max}
+        return stats
+
+    def _composite_plan(self, meta):
+        """
+        helper function to pick a composite index for the criteria of a
+        select: one whose fields all have criteria, equality on all but the
+        last one, which may be a range. Returns the fields of the index with
+        the most fields, the values of the equalities, and the operator
+        number and value of the last criterion (None if an equality), or
+        None if there is no such index.
+        """
+        best = None
+        for fields in self.composites:
+            if best is not None and len(fields) <= len(best[0]):
+                continue
+            criteria = []
+            for field in fields:
+                if field not in meta:
+                    break
+                if isinstance(meta[field], dict):
+                    op, val = list(meta[field].items())[0]
                 else:
-                    # Index exists
-                    if field in self.indexes:
-                        matches = self.indexes[field].get(criteria)
-                    # Index does not exist (shouldn't be called often)
+                    op, val = '==', meta[field]
+                criteria.append((op, val))
+            else:
+                *head, (op, val) = criteria
+                if all(head_op == '==' for head_op, _ in head) and op != '!=':
+                    equal = tuple(head_val for _, head_val in head)
+                    if op == '==':
+                        best = (fields, equal + (val,), None, None)
                     else:
-                        matches = []
-                        for pk in self.pks:
-                            test_meta = self._get_meta_dict[p]
-                            if field in test_meta.keys() and test_meta[field] == criteria:
-                                matches.append(pk)
-                    pks_out = pks_out & set(matches)
+                        best = (fields, equal, OPMAP[op], val)
+        return best
 
-        # Sort and Limit
-        pks_out = list(pks_out)
+    def _covers(self, fields, fields_to_ret):
+        "helper function to tell whether a composite index stores every field to return"
+        if not fields_to_ret:
+            return False
+        stored = set(fields) | set(self.composites[fields].get('covering', [])) | {self.pkfield}
+        return all(field in stored for field in fields_to_ret)
+
+    def _select_covered(self, fields, equal, operator_num, value, fields_to_ret, additional):
+        """
+        helper function to run a select entirely from a composite index,
+        whose entries store every field to return
+        """
+        index = self.indexes[fields]
+        covering = self.composites[fields].get('covering', [])
+        # in row id order, as the other selects
+        entries = sorted(index.lookup(equal, operator_num, value), key=lambda entry: entry[0])
+        pks = self.rowids.to_pks([row for row, _, _ in entries])
+        rows = {}
+        for pk, (_, key, covered) in zip(pks, entries):
+            row = {field: self._from_index(field, v) for field, v in zip(fields, key)}
+            for field, v in zip(covering, covered):
+                if not np.isnan(v):
+                    row[field] = self._from_index(field, v)
+            rows[pk] = row
+
+        def sort_pks(pks, sortfield, reverse, limit):
+            if sortfield not in self.composites[fields].get('covering', []) and sortfield not in fields:
+                return self._sort_pks(pks, sortfield, reverse, limit)
+            have = [pk for pk in pks if sortfield in rows[pk]]
+            key = lambda pk: rows[pk][sortfield]
+            if limit is not None:
+                have = (heapq.nlargest if reverse else heapq.nsmallest)(limit, have, key=key)
+            else:
+                have = sorted(have, key=key, reverse=reverse)
+            return have + [pk for pk in pks if sortfield not in rows[pk]]
+
+        pks_out = self._sort_and_limit(pks, additional, sort_pks)
+        data_list_out = []
+        for pk in pks_out:
+            d = {field: rows[pk].get(field, 'NA') for field in fields_to_ret}
+            if self.pkfield in fields_to_ret:
+                d[self.pkfield] = pk
+            data_list_out.append(d)
+        return pks_out, data_list_out
+
+    def _from_index(self, field, value):
+        "helper function to turn a value stored as a float in an index back to the type of its field"
+        if self.schema[field]['type'] == 'int':
+            return int(value)
+        elif self.schema[field]['type'] == 'bool':
+            return bool(value)
+        return value
+
+    def _scan_matches(self, field, op, val):
+        "helper function to return the sorted row ids of a field with no index matching a criterion"
+        pks = list(self.pks.keys())
+        values, is_set = self._read_columns(pks, [field])[field]
+        func = OPFUNCS[op]
+        matches = [self.rowids.id(pk) for pk, value, was_set in zip(pks, values, is_set)
+                   if was_set and func(value, val)]
+        return np.unique(np.array(matches, dtype=np.uint32))
+
+    def _bitmap_matches(self, index, value, operator_num):
+        "helper function to return the Bitmap of rows of a bitmap index matching a criterion"
+        if operator_num in (OPMAP['=='], OPMAP['!=']) and value not in index.values:
+            # a value the field cannot take
+            return Bitmap() if operator_num == OPMAP['=='] else index.allRows()
+        return index.getBitmap(value, operator_num)
+
+    def _ordered_from_index(self, rows, additional):
+        """
+        helper function to return the matches of a select up to its 'offset'
+        and 'limit' by walking the tree index of its 'sort_by' field in
+        order, when that is expected to read fewer entries than there are
+        matches to sort. rows are the matched row ids, None for all of them.
+        Returns None when the index is not used.
+        """
+        if not additional or 'sort_by' not in additional:
+            return None
+        offset, end = page_bounds(additional)
+        sortfield, sortdir = additional['sort_by'][1:], additional['sort_by'][0]
+        if end is None or sortdir not in ('+', '-') or sortfield not in self.indexFields:
+            return None
+        index = self.indexes[sortfield]
+        if not isinstance(index, TreeIndex):
+            return None
+        n_matches = len(self.pks) if rows is None else len(rows)
+        # matches are assumed to be spread evenly through the index
+        if n_matches == 0 or end * len(index.tree) >= n_matches * n_matches:
+            return None
+        wanted = None if rows is None else set(rows.tolist())
+        ordered = []
+        if end > 0:
+            for row in index.ordered(sortdir == '-'):
+                if wanted is None or row in wanted:
+                    ordered.append(row)
+                    if len(ordered) == end:
+                        break
+        if len(ordered) < end:
+            # rows where the field is not set go last
+            seen = set(ordered)
+            rest = [self.rowids.id(pk) for pk in self.pks.keys()] if rows is None else rows.tolist()
+            ordered += [row for row in rest if row not in seen][:end - len(ordered)]
+        return self.rowids.to_pks(ordered[offset:end])
+
+    def _sort_and_limit(self, pks_out, additional, sort_pks=None):
+        """
+        helper function to apply the 'sort_by', 'offset' and 'limit' of a
+        select to its matches. sort_pks(pks, sortfield, reverse, limit) sorts
+        on a metaheap column, at least the first limit pks if limit is not
+        None, self._sort_pks by default.
+        """
+        if sort_pks is None:
+            sort_pks = self._sort_pks
+        offset, end = page_bounds(additional)
         if additional and 'sort_by' in additional:
             sortfield = additional['sort_by'][1:]
             sortdir = additional['sort_by'][0]
 
             if sortfield not in self.schema:
                 raise ValueError("Sort Column not in schema")
+            if sortdir not in ('+', '-'):
+                raise ValueError("Ill-defined sort order. Must be '+' or '-'")
 
-            if sortdir == '+':
-                pks_out = sorted(pks_out,key=lambda p: self._get_meta_dict(p)[sortfield])
-            elif sortdir == '-':
-                pks_out = sorted(pks_out,key=lambda p: self._get_meta_dict(p)[sortfield],reverse=True)
+            if sortfield == self.pkfield:
+                if end is not None:
+                    pick = heapq.nlargest if sortdir == '-' else heapq.nsmallest
+                    pks_out = pick(end, pks_out)
+                else:
+                    pks_out = sorted(pks_out, reverse=(sortdir == '-'))
+            elif sortfield not in self.metaheap.fields:
+                raise ValueError("Cannot sort on column '{}'".format(sortfield))
             else:
-                raise ValueError("Ill-defined sort order. Must be '+' or '-'")
-        if additional and 'limit' in additional:
-            amt = int(additional['limit'])
-            if amt < len(pks_out):
-                pks_out = pks_out[:amt]
+                pks_out = sort_pks(pks_out, sortfield, sortdir == '-', end)
+        return pks_out[offset:end]
+
+
+class Snapshot:
+    """
+    Read-only view of a PersistentDB as of the epoch it was taken at, see
+    PersistentDB.snapshot().
+
+    Writers do not wait for snapshots. Every change made while one is open
+    keeps the row as it was before, and the tsheap slots freed meanwhile are
+    only reused once no open snapshot can read them. Reads only hold the
+    database lock to find the rows changed since the snapshot and where the
+    others are in the metaheap; they are scanned outside of it, and the rows
+    changed during the scan are then read from their old version.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+        with db._lock:
+            self.epoch = db._epoch
+            db._snapshots.append(self)
+
+    def close(self):
+        "let the versions and tsheap slots kept for this snapshot go"
+        if not self.closed:
+            self.closed = True
+            self.db._release_snapshot(self)
+
+    def __enter__(self):
+        return self
 
-        return self._getDataForRows(pks_out,fields_to_ret)
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("snapshot is closed")
+
+    def _changed(self):
+        "helper function to return the pks changed since the snapshot was taken"
+        return {pk for pk, versions in self.db._versions.items()
+                   if versions[-1][0] > self.epoch}
+
+    def _raw(self, pk, heap_fields):
+        """
+        helper function to read the metaheap fields of pk as they were at
+        the snapshot, or None if it did not exist then
+        """
+        # the first version kept after the snapshot is the row it saw
+        for epoch, row in self.db._versions.get(pk, ()):
+            if epoch > self.epoch:
+                return row
+        if pk not in self.db.pks:
+            return None
+        return self.db._read_fields(pk, heap_fields)
+
+    def _raws(self, pks, offsets, rows, heap_fields):
+        """
+        helper function to return the metaheap fields of pks as they were at
+        the snapshot: the old versions in rows, or read at offsets
+        """
+        unchanged = [pk for pk in pks if pk not in rows]
+        columns = self.db.metaheap.read_columns(heap_fields, [offsets[pk] for pk in unchanged])
+        columns = [columns[field].tolist() for field in heap_fields]
+        raws = {pk: dict(zip(heap_fields, values)) for pk, values in zip(unchanged, zip(*columns))}
+        raws.update((pk, rows[pk]) for pk in pks if pk in rows)
+        return raws
+
+    def __len__(self):
+        with self.db._lock:
+            changed = self._changed()
+            n_now = len(self.db.pks) - len([pk for pk in changed if pk in self.db.pks])
+        # the versions of the changed rows stay while the snapshot is open
+        return n_now + len([pk for pk in changed if self._raw(pk, []) is not None])
+
+    def __getitem__(self, pk):
+        "all columns of pk as of the snapshot"
+        self._check_open()
+        self.db._check_pk(pk)
+        fields, heap_fields = self.db._meta_fields()
+        with self.db._lock:
+            raw = self._raw(pk, heap_fields)
+        if raw is None:
+            raise KeyError("Primary key '{}' not found in snapshot".format(pk))
+        return self.db._raw_to_row(raw, fields)
+
+    def select(self, meta, fields_to_ret=[], additional=None):
+        """
+        Select the rows of the snapshot that match the criteria set in meta.
+        Same parameters and return value as PersistentDB.select.
+        """
+        self._check_open()
+        db = self.db
+        heap_fields = db._meta_fields()[1]
+        # the indexes hold the rows that did not change since the
+        # snapshot; the others are checked against their old version
+        matches = db.select(meta, None)[0]
+        with db._lock:
+            changed = self._changed()
+            offsets = {pk: db.pks[pk] for pk in matches if pk not in changed}
+        rows = {}
+        late = changed
+        while True:
+            for pk in late:
+                raw = self._raw(pk, heap_fields)
+                if raw is not None and self._matches(pk, raw, meta):
+                    rows[pk] = raw
+            pks_out = [pk for pk in offsets if pk not in changed] + list(rows)
+            sort_pks = lambda pks, sortfield, reverse, limit: self._sort_pks(pks, offsets, rows, sortfield, reverse)
+            pks_out = db._sort_and_limit(pks_out, additional, sort_pks)
+            result = self._getDataForRows(pks_out, offsets, rows, fields_to_ret)
+            # what was read of the rows changed meanwhile may be newer
+            with db._lock:
+                late = {pk for pk in self._changed() - changed if pk in offsets}
+            if not late:
+                return result
+            changed |= late
+
+    def _matches(self, pk, raw, meta):
+        "helper function to check an old version of a row against select criteria"
+        db = self.db
+        for field, criteria in meta.items():
+            if field == db.pkfield:
+                if pk != criteria:
+                    return False
+                continue
+            if field not in db.schema or field not in raw:
+                continue
+            if db.schema[field]['type'] != "bool" and not raw[field+"_set"]:
+                return False
+            if isinstance(criteria, dict):
+                op, val = list(criteria.items())[0]
+                if not OPFUNCS[op](raw[field], val):
+                    return False
+            elif raw[field] != criteria:
+                return False
+        return True
+
+    def _sort_pks(self, pks, offsets, rows, sortfield, reverse=False):
+        """
+        helper function to sort pks on a metadata column as of the snapshot,
+        with the old versions in rows. Rows where it is not set go last.
+        """
+        db = self.db
+        raws = self._raws(pks, offsets, rows, db._meta_fields([sortfield])[1])
+        keys = {pk: (raw[sortfield], db.schema[sortfield]['type'] == "bool"
+                                     or raw[sortfield+"_set"])
+                for pk, raw in raws.items()}
+        set_pks = sorted([pk for pk in pks if keys[pk][1]], key=lambda pk: keys[pk][0])
+        if reverse:
+            set_pks.reverse()
+        return set_pks + [pk for pk in pks if not keys[pk][1]]
+
+    def _getDataForRows(self, pks_out, offsets, rows, fields_to_ret):
+        "helper function to return the data of a select, as PersistentDB._getDataForRows"
+        db = self.db
+        if fields_to_ret is None:
+            return pks_out, [{} for _ in pks_out]
+        if not isinstance(fields_to_ret, list):
+            raise TypeError("Fields requested must be a list or None")
+        fields, heap_fields = db._meta_fields(fields_to_ret or None)
+        heap_fields = ['ts_offset'] + heap_fields
+        if 'ts_size' in db.metaheap.fields:
+            heap_fields.append('ts_size')
+        raws = self._raws(pks_out, offsets, rows, heap_fields)
+        data = []
+        for pk in pks_out:
+            row = db._raw_to_row(raws[pk], fields, pin=False)
+            if fields_to_ret == []:
+                d = dict(row)
+            else:
+                d = {field: row[field] if field in row else 'NA' for field in fields_to_ret}
+                if 'ts' in fields_to_ret:
+                    d['ts'] = row['ts']
+            if fields_to_ret == [] or db.pkfield in fields_to_ret:
+                d[db.pkfield] = pk
+            data.append(d)
+        return pks_out, data
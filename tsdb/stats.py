@@ -0,0 +1,115 @@
+"""Statistics of the values of an index, used by the select planners
+"""
+
+import numpy as np
+
+BUCKETS = 64 # of the histograms
+REBUILD_FRACTION = 0.2 # of the rows changed since the last build, after which stats are stale
+REBUILD_MIN = 1000 # changes after which stats may be stale
+
+class IndexStats:
+    """
+    Number of rows, number of distinct values, smallest and largest value,
+    and an equi-width histogram of the numeric values in an index, to
+    estimate how many rows a criterion matches.
+
+    They are computed from every value by the constructor, then kept up to
+    date by add() and remove(). Values out of the range of the histogram are
+    counted in its first or last bucket, and the distinct count is only
+    scaled with the number of rows, so the estimates drift as the index
+    changes: `stale` tells when it is time to compute them again.
+    """
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.rows = len(values)
+        self._built_rows = self.rows
+        self.changes = 0
+        if self.rows:
+            self.min = float(values.min())
+            self.max = float(values.max())
+            self._distinct = len(np.unique(values))
+            self.counts, self.edges = np.histogram(values, bins=BUCKETS, range=(self.min, self.max))
+        else:
+            self.min = self.max = None
+            self._distinct = 0
+            self.counts = np.zeros(BUCKETS, dtype=np.int64)
+            self.edges = None
+
+    @property
+    def distinct(self):
+        if not self._built_rows:
+            return self.rows
+        return max(1, round(self._distinct * self.rows / self._built_rows)) if self.rows else 0
+
+    @property
+    def stale(self):
+        return self.changes > max(REBUILD_MIN, REBUILD_FRACTION * self._built_rows) \
+               or (self.edges is None and self.rows > 0)
+
+    def _bucket(self, value):
+        "helper function to return the histogram bucket of a value"
+        n = int(np.searchsorted(self.edges, value, side='right')) - 1
+        return min(max(n, 0), BUCKETS - 1)
+
+    def add(self, value):
+        self.rows += 1
+        self.changes += 1
+        if self.edges is None:
+            return
+        self.counts[self._bucket(value)] += 1
+        self.min = min(self.min, float(value))
+        self.max = max(self.max, float(value))
+
+    def remove(self, value):
+        self.rows -= 1
+        self.changes += 1
+        if self.edges is not None:
+            n = self._bucket(value)
+            self.counts[n] = max(0, self.counts[n] - 1)
+
+    def _below(self, value):
+        "helper function to estimate the number of rows with values below value"
+        if value <= self.edges[0]:
+            return 0.0
+        if value >= self.edges[-1]:
+            return float(self.counts.sum())
+        n = self._bucket(value)
+        width = self.edges[n+1] - self.edges[n]
+        inside = (value - self.edges[n]) / width if width > 0 else 0.0
+        return float(self.counts[:n].sum() + self.counts[n] * inside)
+
+    def estimate(self, op, value):
+        """
+        estimated number of rows whose value compares with value by op
+        ('<', '>', '==', '!=', '<=' or '>=')
+        """
+        if not self.rows:
+            return 0
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return self.rows
+        if self.edges is None:
+            return self.rows
+        # the histogram may count fewer rows than there are after removals
+        scale = self.rows / max(1, self.counts.sum())
+        # an average share of the rows, no more than the bucket of value holds
+        equal = 0.0
+        if self.edges[0] <= value <= self.edges[-1]:
+            equal = min(self.rows / self.distinct, self.counts[self._bucket(value)] * scale)
+        below = self._below(value) * scale
+        if op == '==':
+            n = equal
+        elif op == '!=':
+            n = self.rows - equal
+        elif op == '<':
+            n = below
+        elif op == '<=':
+            n = below + equal
+        elif op == '>':
+            n = self.rows - below - equal
+        elif op == '>=':
+            n = self.rows - below
+        else:
+            raise ValueError("Unknown operator '{}'".format(op))
+        return int(round(min(max(n, 0.0), self.rows)))
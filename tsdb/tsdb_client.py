@@ -45,6 +45,20 @@ class TSDBClient(object):
         status, payload =  await self._send(msg.to_json())
         return TSDBStatus(status), payload
 
+    async def insert_many(self, rows):
+        """
+        Send the server a request to insert many timeseries into the database
+        over a single connection.
+
+        Parameters
+        ----------
+        `rows`: list
+            (primary_key, ts) or (primary_key, ts, metadata_dict) tuples
+        """
+        msg = TSDBOp_InsertMany(rows)
+        status, payload =  await self._send(msg.to_json())
+        return TSDBStatus(status), payload
+
     async def delete_ts(self, primary_key):
         """
         Send the server a request to delete a timeseries from the database.
@@ -84,7 +98,7 @@ class TSDBClient(object):
         status, payload =  await self._send(msg.to_json())
         return TSDBStatus(status), payload
 
-    async def select(self, metadata_dict={}, fields=None, additional=None):
+    async def select(self, metadata_dict={}, fields=None, additional=None, explain=False):
         """
         Send the server a request for the selection of timeseries elements in
         the database that match the criteria set in metadata_dict.
@@ -98,16 +112,44 @@ class TSDBClient(object):
             Otherwise, the timeseries are returned.
         additional: a dictionary object
             additional computation to perform on the query matches before they're
-            returned. You can sort or limit the number of results that you receive.
+            returned. You can sort ('sort_by'), limit ('limit') and page through
+            ('offset') the results that you receive.
+        explain: boolean
+            If `True`, the plan of the query (the order its criteria were
+            matched in, how, and how long it took) is returned instead of its
+            results.
         """
         #DNY: TODO, need to redo
-        msg = TSDBOp_Select(metadata_dict,fields,additional)
+        msg = TSDBOp_Select(metadata_dict,fields,additional,explain)
         # msg = {}
         # msg['op'] = 'select'
         # msg['md'] = metadata_dict
         status, payload =  await self._send(msg.to_json())
         return TSDBStatus(status), payload
 
+    async def aggregate(self, metadata_dict={}, aggregates=['count'], group_by=None, bins=10):
+        """
+        Send the server a request to compute aggregates of the timeseries
+        elements in the database that match the criteria set in
+        metadata_dict. Only the aggregates are sent back.
+
+        Parameters
+        ----------
+        metadata_dict: a dictionary object
+            the selection criteria (filters)
+        aggregates: a list object
+            the aggregates to compute: 'count', or one of 'count', 'sum',
+            'min', 'max', 'mean' or 'histogram' of a field, as in 'mean(std)'
+        group_by: a string
+            If not `None`, the aggregates are computed for every value of
+            this field, and a list of them is returned.
+        bins: an int
+            number of buckets of the histograms
+        """
+        msg = TSDBOp_Aggregate(metadata_dict, aggregates, group_by, bins)
+        status, payload = await self._send(msg.to_json())
+        return TSDBStatus(status), payload
+
     async def augmented_select(self, proc, target, arg=None, metadata_dict={}, additional=None):
         """
         Send the server a request for the selection of timeseries elements in
@@ -122,7 +164,8 @@ class TSDBClient(object):
             the selection criteria (filters)
         additional: a dictionary object
             additional computation to perform on the query matches before they're
-            returned. You can sort or limit the number of results that you receive.
+            returned. You can sort ('sort_by'), limit ('limit') and page through
+            ('offset') the results that you receive.
         target : list
             what the results of the stored procedure will be stored in
         """
@@ -130,7 +173,7 @@ class TSDBClient(object):
         status, payload =  await self._send(msg.to_json())
         return TSDBStatus(status), payload
 
-    async def find_similar(self, arg):
+    async def find_similar(self, arg, k=1, max_distances=None, max_leaves=None, epsilon=0.0):
         """Send the server a request to find the closest ts to this one
 
         Parameters
@@ -138,8 +181,38 @@ class TSDBClient(object):
 
         arg : TimeSeries
             reference time series
+        k : int
+            number of closest ts to find, returned nearest first
+        max_distances : int
+            if not `None`, the most distances to compute
+        max_leaves : int
+            if not `None`, the most leaves of the vantage point tree to visit
+        epsilon : float
+            slack of the pruning of the vantage point tree: the distances
+            returned are at most 1 + epsilon times the exact ones
+
+        With a budget or an epsilon, the search is approximate, and the
+        payload holds the closest ts found as 'results', with the number of
+        'candidates' and 'leaves' of the tree the search looked at.
+        """
+        msg = TSDBOp_FindSimilar(arg, k, max_distances, max_leaves, epsilon)
+        status, payload =  await self._send(msg.to_json())
+        return TSDBStatus(status), payload
+
+    async def find_within(self, arg, radius, limit=None):
+        """Send the server a request to find the ts within a distance of this one
+
+        Parameters
+        ----------
+
+        arg : TimeSeries
+            reference time series
+        radius : float
+            distance to find the ts within
+        limit : int
+            if not `None`, the most ts to return. They are returned nearest first
         """
-        msg = TSDBOp_FindSimilar(arg)
+        msg = TSDBOp_FindWithin(arg, radius, limit)
         status, payload =  await self._send(msg.to_json())
         return TSDBStatus(status), payload
 
@@ -72,6 +72,20 @@ class TSDBOp_InsertTS(TSDBOp):
         return cls(json_dict['pk'], ts.TimeSeries(*(json_dict['ts'])))
         #DNY: timeseries encoded as list [[t1,t2,...], [v1,v2,...]]
 
+class TSDBOp_InsertMany(TSDBOp):
+    """Insert many timeseries, each with optional metadata, in one request
+    """
+    def __init__(self, rows):
+        super().__init__('insert_many')
+        # DNY: stored as dicts, so that to_json can encode the timeseries
+        self['rows'] = [{'pk': row[0], 'ts': row[1],
+                         'md': row[2] if len(row) > 2 else None} for row in rows]
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls([(row['pk'], ts.TimeSeries(*row['ts']), row['md'])
+                    for row in json_dict['rows']])
+
 class TSDBOp_DeleteTS(TSDBOp):
     def __init__(self, pk):
         super().__init__('delete_ts')
@@ -105,15 +119,34 @@ class TSDBOp_UpsertMeta(TSDBOp):
 
 class TSDBOp_Select(TSDBOp):
 
-    def __init__(self, md, fields, additional):
+    def __init__(self, md, fields, additional, explain=False):
         super().__init__('select')
         self['md'] = md
         self['fields'] = fields
         self['additional'] = additional
+        self['explain'] = explain
 
     @classmethod
     def from_json(cls, json_dict):
-        return cls(json_dict['md'], json_dict['fields'], json_dict['additional'])
+        return cls(json_dict['md'], json_dict['fields'], json_dict['additional'],
+                   json_dict.get('explain', False))
+
+class TSDBOp_Aggregate(TSDBOp):
+    """Compute aggregates (such as 'count' or 'mean(std)') of the timeseries
+    matching the metadata md in the database, optionally for every value of
+    the field group_by, rather than sending every row back
+    """
+    def __init__(self, md, aggregates, group_by=None, bins=10):
+        super().__init__('aggregate')
+        self['md'] = md
+        self['aggregates'] = aggregates
+        self['group_by'] = group_by
+        self['bins'] = bins
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict['md'], json_dict['aggregates'], json_dict.get('group_by'),
+                   json_dict.get('bins', 10))
 
 class TSDBOp_AddTrigger(TSDBOp):
 
@@ -160,19 +193,39 @@ class TSDBOp_AugmentedSelect(TSDBOp):
         return cls(json_dict['proc'], json_dict['target'], json_dict['arg'], json_dict['md'], json_dict['additional'])
 
 class TSDBOp_FindSimilar(TSDBOp):
-    """Find the timeseries in the DB closest to this one based on the predefined
-    distance metric
+    """Find the k timeseries in the DB closest to this one based on the
+    predefined distance metric, approximately if given a budget of distances
+    or leaves of the vantage point tree, or an epsilon
     """
-    def __init__(self, arg):
+    def __init__(self, arg, k=1, max_distances=None, max_leaves=None, epsilon=0.0):
         super().__init__('find_similar')
         self['arg'] = arg
+        self['k'] = k
+        self['max_distances'] = max_distances
+        self['max_leaves'] = max_leaves
+        self['epsilon'] = epsilon
 
     @classmethod
     def from_json(cls, json_dict):
         # print("in TSDBOp_FindSimilar: ", type(json_dict))
         arg = json_dict['arg']
         # print("extracted")
-        return cls(json_dict['arg'])
+        return cls(json_dict['arg'], json_dict.get('k', 1), json_dict.get('max_distances'),
+                   json_dict.get('max_leaves'), json_dict.get('epsilon', 0.0))
+
+class TSDBOp_FindWithin(TSDBOp):
+    """Find the timeseries in the DB within distance radius of this one based
+    on the predefined distance metric, at most limit of them, nearest first
+    """
+    def __init__(self, arg, radius, limit=None):
+        super().__init__('find_within')
+        self['arg'] = arg
+        self['radius'] = radius
+        self['limit'] = limit
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict['arg'], json_dict['radius'], json_dict.get('limit'))
 
 class TSDBOp_MakeVPTree(TSDBOp):
     """Make a vantage point tree given the current state of the database
@@ -187,12 +240,15 @@ class TSDBOp_MakeVPTree(TSDBOp):
 # This simplifies reconstructing TSDBOp instances from network data.
 typemap = {
   'insert_ts': TSDBOp_InsertTS,
+  'insert_many': TSDBOp_InsertMany,
   'upsert_meta': TSDBOp_UpsertMeta,
   'select': TSDBOp_Select,
+  'aggregate': TSDBOp_Aggregate,
   'augmented_select': TSDBOp_AugmentedSelect,
   'add_trigger': TSDBOp_AddTrigger,
   'remove_trigger': TSDBOp_RemoveTrigger,
   'delete_ts': TSDBOp_DeleteTS,
   'find_similar': TSDBOp_FindSimilar,
+  'find_within': TSDBOp_FindWithin,
   'make_vp_tree': TSDBOp_MakeVPTree
 }
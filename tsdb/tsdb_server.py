@@ -9,9 +9,15 @@ from .tsdb_serialization import Deserializer, serialize
 from .tsdb_error import *
 from .tsdb_ops import *
 import procs
+import logging
+import os
+import threading
 import time
 import vptrees
 
+# the search counters of find_similar, too many to print for every query
+logger = logging.getLogger(__name__)
+
 def trigger_callback_maker(pk, target, calltomake):
     def callback_(future):
         result = future.result()
@@ -38,6 +44,22 @@ class TSDBProtocol(asyncio.Protocol):
         """
         self.server.db.insert_ts(op['pk'], op['ts'])
         self._run_trigger('insert_ts', [op['pk']])
+        self.server._update_vp_tree('insert', [op['pk']])
+        return TSDBOp_Return(TSDBStatus.OK, op['op'])
+
+    def _insert_many(self, op):
+        """
+        Insert many timeseries, and their metadata, into the database.
+
+        Parameters
+        ----------
+        op : a TSDBOp object
+            contains the rows (`op[rows]`) to insert
+        """
+        rows = [(row['pk'], row['ts'], row['md']) for row in op['rows']]
+        pks = self.server.db.insert_many(rows)
+        self._run_trigger('insert_ts', pks)
+        self.server._update_vp_tree('insert', pks)
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
     def _delete_ts(self, op):
@@ -51,6 +73,7 @@ class TSDBProtocol(asyncio.Protocol):
         """
         self.server.db.delete_ts(op['pk'])
         self._run_trigger('delete_ts', [op['pk']])
+        self.server._update_vp_tree('delete', [op['pk']])
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
     def _upsert_meta(self, op):
@@ -75,8 +98,12 @@ class TSDBProtocol(asyncio.Protocol):
         op : a TSDBOp object
             contains metadata specifications (`op[md]`) to match in the query. Also
             contains fields of the matched timeseries to return. If left to
-            default value of `None`, everything is returned.
+            default value of `None`, everything is returned. If `op['explain']`
+            is set, the plan of the query is returned instead of its results.
         """
+        if op['explain']:
+            plan = self.server.db.explain(op['md'], op['fields'], op['additional'])
+            return TSDBOp_Return(TSDBStatus.OK, op['op'], plan)
         loids, fields = self.server.db.select(op['md'], op['fields'], op['additional'])
         self._run_trigger('select', loids)
         if fields is not None:
@@ -87,6 +114,21 @@ class TSDBProtocol(asyncio.Protocol):
             return TSDBOp_Return(TSDBStatus.OK, op['op'], d)
 
 
+    def _aggregate(self, op):
+        """
+        Compute aggregates of the timeseries matching a select in the database.
+
+        Parameters
+        ----------
+        op : a TSDBOp object
+            contains metadata specifications (`op[md]`) to match, the
+            aggregates to compute (`op['aggregates']`), and optionally the
+            field to group them by (`op['group_by']`) and the number of
+            buckets of histograms (`op['bins']`).
+        """
+        result = self.server.db.aggregate(op['md'], op['aggregates'], op['group_by'], op['bins'])
+        return TSDBOp_Return(TSDBStatus.OK, op['op'], result)
+
     def _augmented_select(self, op):
         """
         Run a select and then synchronously run some computation on it
@@ -111,39 +153,46 @@ class TSDBProtocol(asyncio.Protocol):
         target = op['target'] #not used to upsert any more, but rather to
         # return results in a dictionary with the targets mapped to the return
         # values from proc_main
-        results=[]
-        for pk in loids:
-            row = self.server.db[pk]
-            result = self.server._run_proc(proc, pk, row, arg)
-            results.append(dict(zip(target, result)))
+        rows = [self.server.db[pk] for pk in loids]
+        results = [dict(zip(target, result))
+                   for result in self.server._run_proc_many(proc, loids, rows, arg)]
         return TSDBOp_Return(TSDBStatus.OK, op['op'], dict(zip(loids, results)))
 
     def _find_similar(self, op):
         """
         Find the most similar timeseies to the given timeseies from the database
 
-        If Vantage Point trees are implemented this will change.
+        With a vantage point tree, the search is exact and computes as few
+        distances as the tree allows, unless it is given a budget or an
+        epsilon (see VPTree.knn). Otherwise it only looks within twice the
+        distance to the closest vantage point, which holds the nearest one.
         Parameters
         ----------
         op : a TSDBOp object
-            contains a query timeseries (`op[arg]`)
+            contains a query timeseries (`op[arg]`), the number of
+            timeseries to return (`op[k]`), and optionally the most distances
+            to compute (`op[max_distances]`) or leaves of the tree to visit
+            (`op[max_leaves]`), and the slack of the pruning (`op[epsilon]`).
+            The timeseries are returned nearest first, as a dict of pk:
+            distance. An approximate search returns that dict as 'results',
+            with the number of 'candidates' it computed the distance of and
+            of 'leaves' it visited.
         """
         arg = op['arg']
-
-        if self.server.vptree is not None:
-            # find the right subgroup within the tree and compute distance to
-            # all the points within it
-            loids = self.server.vptree.getCloseSubset(arg, self.server._dist_vp_arg)
-
-            results={}
-            for pk in loids:
-                row = self.server.db[pk]
-                results[pk] = self.server._run_proc('corr', pk, row, arg)[0]
-
-            # find the smallest distance amongst this ( or k smallest)
-            n = min(results.keys(),key=lambda p: results[p])
-
-            return TSDBOp_Return(TSDBStatus.OK, op['op'], {n:results[n]})
+        k = op['k']
+        approximate = op['max_distances'] is not None or op['max_leaves'] is not None or op['epsilon']
+
+        if self.server.vptree is not None and not self.server.vptree.stale:
+            tree = self.server.vptree
+            nearest = OrderedDict(tree.knn(arg, k, self.server._dist_vp_arg, op['max_distances'],
+                                           op['max_leaves'], op['epsilon']))
+            logger.debug("Find Similar :: %d searches computed %d distances, saved %d",
+                         tree.searches, tree.distances, tree.distances_saved)
+            if approximate:
+                return TSDBOp_Return(TSDBStatus.OK, op['op'], {'results': nearest,
+                                     'candidates': tree.last_search['distances'],
+                                     'leaves': tree.last_search['leaves']})
+            return TSDBOp_Return(TSDBStatus.OK, op['op'], nearest)
 
         else:
             vpkeys, _ = self.server.db.select({'vp': True}, None, {'sort_by' : '+vp_num'})
@@ -165,22 +214,65 @@ class TSDBProtocol(asyncio.Protocol):
             # this is an augmented select to the same proc in correlation
             md = {closest_vpk_dist_col: {'<=': 2*vpdist[closest_vpk]}}
             loids, fields = self.server.db.select(md, None, None)
+            if len(loids) < k:
+                loids, fields = self.server.db.select({}, None, None)
 
             print("Find Similar :: Select retured {} rows".format(len(loids)))
 
             # find distances to all timeseries within this circle around the Vantage
             # Point
-            results={}
-            for pk in loids:
-                row = self.server.db[pk]
-                results[pk] = self.server._run_proc('corr', pk, row, arg)[0]
+            rows = [self.server.db[pk] for pk in loids]
+            results = {pk: result[0] for pk, result
+                       in zip(loids, self.server._run_proc_many('corr', loids, rows, arg))}
 
-            # find the smallest distance amongst this ( or k smallest)
-            n = min(results.keys(),key=lambda p: results[p])
+            # find the k smallest distances amongst this
+            nearest = sorted(results.keys(), key=lambda p: results[p])[:k]
+            nearest = OrderedDict((n, results[n]) for n in nearest)
 
-            return TSDBOp_Return(TSDBStatus.OK, op['op'], {n:results[n]})
+            if approximate:
+                return TSDBOp_Return(TSDBStatus.OK, op['op'], {'results': nearest,
+                                     'candidates': len(vpkeys) + len(loids), 'leaves': 0})
+            return TSDBOp_Return(TSDBStatus.OK, op['op'], nearest)
 
 
+    def _find_within(self, op):
+        """
+        Find the timeseries within a distance of the given timeseries
+
+        Candidates are pruned with the distances of every row to every
+        vantage point (the d_vp-* columns): by the triangle inequality, a
+        timeseries x within radius r of the query q has |d(q,vp) - d(x,vp)| <= r.
+        The upper bounds are selected from the database, the lower bounds
+        checked on the rows selected, and the distance to the query is only
+        computed for the rows left. Rows without distances to the vantage
+        points are not found.
+        Parameters
+        ----------
+        op : a TSDBOp object
+            contains a query timeseries (`op[arg]`), the distance to find
+            timeseries within (`op[radius]`) and the most to return
+            (`op[limit]`, `None` for all of them). They are returned nearest
+            first, as a dict of pk: distance.
+        """
+        arg, radius, limit = op['arg'], op['radius'], op['limit']
+
+        md, lower = {}, {}
+        for vpk, column in self.server._vp_dist_columns(self.server.db):
+            d = self.server._dist_vp_arg(vpk, arg)
+            md[column] = {'<=': d + radius}
+            lower[column] = d - radius
+        loids, fields = self.server.db.select(md, list(lower), None)
+        candidates = [pk for pk, field in zip(loids, fields)
+                      if all(field[column] >= bound for column, bound in lower.items())]
+        logger.debug("Find Within :: Select returned %d rows, %d left to check", len(loids), len(candidates))
+
+        rows = [self.server.db[pk] for pk in candidates]
+        results = {pk: result[0] for pk, result
+                   in zip(candidates, self.server._run_proc_many('corr', candidates, rows, arg))
+                   if result[0] <= radius}
+        nearest = sorted(results.keys(), key=lambda p: results[p])[:limit]
+        return TSDBOp_Return(TSDBStatus.OK, op['op'], OrderedDict((n, results[n]) for n in nearest))
+
     def _add_trigger(self, op):#DNY: Trigger is "if something happens, run this particular process", similar to a stored procedure.
         """
         Send the server a request to add a trigger.
@@ -222,12 +314,7 @@ class TSDBProtocol(asyncio.Protocol):
                 task.add_done_callback(trigger_callback_maker(pk, target, self.server.db.upsert_meta))
 
     def _make_vp_tree(self, op):
-        # get all the pks
-        pks, fields = self.server.db.select({},['vp'],None)
-        vps = [p for p,d in zip(pks, fields) if d['vp']]
-        # print("pks", pks)
-        # print("vps", vps)
-        self.server.vptree = vptrees.VPTree(pks, vps, self.server._dist_vp_pks)
+        self.server.make_vp_tree()
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
     def connection_made(self, conn):
@@ -250,10 +337,14 @@ class TSDBProtocol(asyncio.Protocol):
 
                 if isinstance(op, TSDBOp_InsertTS):
                     response = self._insert_ts(op)
+                elif isinstance(op, TSDBOp_InsertMany):
+                    response = self._insert_many(op)
                 elif isinstance(op, TSDBOp_UpsertMeta):
                     response = self._upsert_meta(op)
                 elif isinstance(op, TSDBOp_Select):
                     response = self._select(op)
+                elif isinstance(op, TSDBOp_Aggregate):
+                    response = self._aggregate(op)
                 elif isinstance(op, TSDBOp_AugmentedSelect):
                     response = self._augmented_select(op)
                 elif isinstance(op, TSDBOp_AddTrigger):
@@ -264,6 +355,8 @@ class TSDBProtocol(asyncio.Protocol):
                     response = self._delete_ts(op)
                 elif isinstance(op, TSDBOp_FindSimilar):
                     response = self._find_similar(op)
+                elif isinstance(op, TSDBOp_FindWithin):
+                    response = self._find_within(op)
                 elif isinstance(op, TSDBOp_MakeVPTree):
                     response = self._make_vp_tree(op)
                 else:
@@ -299,8 +392,11 @@ class TSDBServer(object):
         database engine
     triggers :
         a default dict of triggers
+    vptree :
+        the vantage point tree, if one was made, kept up to date by inserts
+        and deletes
     """
-    def __init__(self, db, port=9999):
+    def __init__(self, db, port=9999, vptree_file=None):
         """
         Instantiate an instance of the server. This accepts requests from the
         client, processes them, and dispatches a response.
@@ -311,23 +407,142 @@ class TSDBServer(object):
             port to listen on. Defaults to 9999.
         db : a DictDB
             database engine
+        vptree_file : str
+            file the vantage point tree is saved in, and loaded from if it
+            exists. By default vptree.p with the files of a PersistentDB,
+            and none for other databases.
         """
         self.port = port
         self.db = db
         self.triggers = defaultdict(list)
         self.autokeys = {}
+        if vptree_file is None and hasattr(db, 'data_dir'):
+            vptree_file = os.path.join(db.data_dir, 'vptree.p')
+        self.vptree_file = vptree_file
         self.vptree = None
+        self._vptree_lock = threading.RLock()
+        self._vp_changes = None # inserts and deletes made during a rebuild
+        self._vp_rebuilder = None
+        if vptree_file is not None and os.path.exists(vptree_file):
+            self.vptree = vptrees.VPTree.load(vptree_file, self._dist_vp_pks)
 
-    def _dist_vp_pks(self, vp, pks):
-
-        # get the info on this vp
-        row = self.db[vp]
-
-        # get the distance to all other keys
-        dist_col = 'd_vp-'+str(row['vp_num'])
-        loids, fields = self.db.select({},[dist_col],None)
-
-        return [fields[loids.index(p)][dist_col] for p in pks]
+    def make_vp_tree(self, background=False):
+        """
+        Build the vantage point tree over every row, with the rows where
+        'vp' is set as vantage points, and save it to vptree_file.
+
+        In the background, the tree is built in a daemon thread, which is
+        returned, from a snapshot of the database. The tree in use is
+        replaced when it is done, after the inserts and deletes made
+        meanwhile are replayed on the new one. Databases that do not take
+        snapshots, whose rows could change under the build, are built from
+        before returning.
+        """
+        with self._vptree_lock:
+            if not background or not hasattr(self.db, 'snapshot'):
+                self._set_vp_tree(self._build_vp_tree(self.db))
+                return None
+            if self._vp_rebuilder is not None:
+                return self._vp_rebuilder
+            self._vp_changes = []
+            view = self.db.snapshot()
+            self._vp_rebuilder = threading.Thread(target=self._rebuild_vp_tree, args=(view,), daemon=True)
+        self._vp_rebuilder.start()
+        return self._vp_rebuilder
+
+    def _rebuild_vp_tree(self, view):
+        "helper function to build the vantage point tree from view, and replace the tree in use with it"
+        try:
+            tree = self._build_vp_tree(view)
+        except Exception as e:
+            print('S> Exception rebuilding the vantage point tree:', e)
+            tree = None
+        finally:
+            if view is not self.db:
+                view.close()
+        with self._vptree_lock:
+            if tree is not None:
+                # the last change of each pk is its state now
+                changes = OrderedDict()
+                for change, pk in self._vp_changes:
+                    changes.pop(pk, None)
+                    changes[pk] = change
+                for pk, change in changes.items():
+                    getattr(tree, change)(pk)
+                self._set_vp_tree(tree)
+            self._vp_changes = None
+            self._vp_rebuilder = None
+
+    def _build_vp_tree(self, db):
+        "helper function to build a vantage point tree over the rows of db"
+        pks, _ = db.select({}, None, None)
+        vps, _ = db.select({'vp': True}, None, None)
+        distances = self._vp_distances(db)
+        tree = vptrees.VPTree(pks, vps, lambda vp, pks: self._dist_vp_pks(vp, pks, db, distances))
+        tree.dist_func = self._dist_vp_pks
+        return tree
+
+    def _set_vp_tree(self, tree):
+        "helper function to use tree from now on, and save it"
+        self.vptree = tree
+        if self.vptree_file is not None:
+            tree.save(self.vptree_file)
+
+    def _update_vp_tree(self, change, pks):
+        """
+        helper function to insert pks into the vantage point tree, or delete
+        them from it, and rebuild it in the background once it needs to be
+        """
+        with self._vptree_lock:
+            if self._vp_changes is not None:
+                self._vp_changes.extend((change, pk) for pk in pks)
+            tree = self.vptree
+            if tree is None or tree.stale:
+                return
+            for pk in pks:
+                getattr(tree, change)(pk)
+            rebuild = tree.needs_rebuild and self._vp_rebuilder is None
+        if rebuild:
+            self.make_vp_tree(background=True)
+
+    def _vp_dist_columns(self, db):
+        "helper function to return the vantage points, each with the column of the distances to it"
+        vpkeys, _ = db.select({'vp': True}, None, None)
+        columns = []
+        for vpk in vpkeys:
+            column = 'd_vp-' + str(db[vpk]['vp_num'])
+            if column in self.db.schema:
+                columns.append((vpk, column))
+        return columns
+
+    def _vp_distances(self, db):
+        """
+        helper function to select the distances of every row to every
+        vantage point from their d_vp-* columns, all in one select. Returns
+        a dictionary of vantage point: {pk: distance}, of the rows set.
+        """
+        columns = self._vp_dist_columns(db)
+        if not columns:
+            return {}
+        loids, fields = db.select({}, list(set(column for _, column in columns)), None)
+        return {vpk: {pk: field[column] for pk, field in zip(loids, fields) if field[column] != 'NA'}
+                for vpk, column in columns}
+
+    def _dist_vp_pks(self, vp, pks, db=None, distances=None):
+        """
+        Distances from the vantage point vp to the rows pks, of db (the
+        database by default). Those in distances (see _vp_distances) are
+        looked up, the others computed by the corr proc.
+        """
+        db = self.db if db is None else db
+        known = {} if distances is None else distances.get(vp, {})
+        missing = [p for p in pks if p not in known]
+        if missing:
+            rows = [db[p] for p in missing]
+            computed = self._run_proc_many('corr', missing, rows, db[vp]['ts'].to_json())
+            known = dict(known)
+            known.update((p, result[0]) for p, result in zip(missing, computed))
+        return [known[p] for p in pks]
 
     def _dist_vp_arg(self, vp, arg):
 
@@ -341,6 +556,20 @@ class TSDBServer(object):
         storedproc = getattr(mod,'proc_main')
         return storedproc(pk, row, arg)
 
+    def _run_proc_many(self, proc, pks, rows, arg):
+        """
+        Run a proc over many rows, returning its result for each. Procs with
+        a proc_main_many, such as corr, are handed them all at once, and the
+        proc_main of the others is run on one row after the other.
+        """
+        if not rows:
+            return []
+        mod = import_module('procs.'+proc)
+        if hasattr(mod, 'proc_main_many'):
+            return mod.proc_main_many(pks, rows, arg)
+        storedproc = getattr(mod,'proc_main')
+        return [storedproc(pk, row, arg) for pk, row in zip(pks, rows)]
+
     def exception_handler(self, loop, context):
         print('S> EXCEPTION:', str(context))
         loop.stop()
@@ -0,0 +1,178 @@
+"""Write ahead log used by the persistentdb implementation
+
+Every record is framed as
+
+    [payload length : 4 bytes][crc32 of payload : 4 bytes][lsn : 8 bytes][payload]
+
+where the payload is a pickled (operation name, arguments) tuple. The file
+starts with a small header holding the lsn of the first record, so the log
+can be emptied at a checkpoint without the sequence numbers starting over.
+"""
+
+import os
+import struct
+import pickle
+import threading
+import time
+import zlib
+
+MAGIC = b'TSWAL001'
+FILE_HEADER = struct.Struct('<8sQ') # magic, lsn of the first record
+RECORD_HEADER = struct.Struct('<IIQ') # payload length, crc32, lsn
+
+class WriteAheadLog:
+    """
+    Binary, checksummed, append-only log with group commit.
+
+    Appended records are flushed to the operating system before append
+    returns, so they survive the process crashing, but are only fsync'd
+    once `sync_every` records are pending, or `sync_ms` milliseconds after
+    the oldest pending record, whichever comes first. A background thread
+    takes care of the timer, so a lone write is not left unsynced for long.
+
+    Pages changed by a record must not reach disk before the record does:
+    writers call sync_to() with the lsn of the last record a page depends
+    on before writing it (see BufferPool and HeapFile).
+
+    Attributes
+    ----------
+    next_lsn :
+        log sequence number that the next record will get
+    synced_lsn :
+        every record with a lower lsn is known to be on disk
+    """
+    def __init__(self, filename, sync_every=64, sync_ms=10):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_ms = sync_ms
+        self._lock = threading.RLock()
+
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) < FILE_HEADER.size:
+            self._reset(0)
+        self.fd = open(self.filename, 'r+b')
+        magic, self.first_lsn = FILE_HEADER.unpack(self.fd.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("'{}' is not a write ahead log".format(self.filename))
+
+        # find the end of the valid records, dropping a torn tail if any
+        self.next_lsn = self.first_lsn
+        end = FILE_HEADER.size
+        for lsn, _, _, end in self._scan():
+            self.next_lsn = lsn + 1
+        self.fd.truncate(end)
+        self.fd.seek(end)
+        self.synced_lsn = self.next_lsn
+        self._pending = 0
+        self._oldest_pending = None
+
+        # group commit timer
+        self._closed = threading.Event()
+        self._syncer = threading.Thread(target=self._sync_loop, daemon=True)
+        self._syncer.start()
+
+    def _reset(self, first_lsn):
+        "write a new, empty log starting at first_lsn"
+        with open(self.filename+'.new', 'wb') as fd:
+            fd.write(FILE_HEADER.pack(MAGIC, first_lsn))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(self.filename+'.new', self.filename)
+
+    def _scan(self):
+        "generator over (lsn, op, args, end offset) of the valid records"
+        self.fd.seek(FILE_HEADER.size)
+        while True:
+            header = self.fd.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc, lsn = RECORD_HEADER.unpack(header)
+            payload = self.fd.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            op, args = pickle.loads(payload)
+            yield lsn, op, args, self.fd.tell()
+
+    def append(self, op, *args):
+        """
+        log an operation before it is applied, return its lsn
+
+        Parameters
+        ----------
+        op : string
+            name of the operation, eg 'insert_ts'
+        args : anything picklable
+            arguments needed to apply the operation again
+        """
+        payload = pickle.dumps((op, args), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            lsn = self.next_lsn
+            self.fd.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), lsn))
+            self.fd.write(payload)
+            self.fd.flush()
+            self.next_lsn += 1
+            self._pending += 1
+            if self._oldest_pending is None:
+                self._oldest_pending = time.monotonic()
+            if self._pending >= self.sync_every or \
+               (time.monotonic() - self._oldest_pending)*1000 >= self.sync_ms:
+                self.sync()
+        return lsn
+
+    def sync(self):
+        "make every appended record durable"
+        with self._lock:
+            if self.fd.closed:
+                return
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.synced_lsn = self.next_lsn
+            self._pending = 0
+            self._oldest_pending = None
+
+    def sync_to(self, lsn):
+        "make every record up to lsn durable, if it is not yet"
+        if lsn >= self.synced_lsn:
+            self.sync()
+
+    @property
+    def last_lsn(self):
+        "lsn of the last record appended, which every change made so far depends on"
+        return self.next_lsn - 1
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_ms / 1000):
+            if self._pending:
+                self.sync()
+
+    def replay(self):
+        "list of the (lsn, op, args) records in the log, oldest first"
+        with self._lock:
+            self.fd.flush()
+            records = [(lsn, op, args) for lsn, op, args, _ in self._scan()]
+            self.fd.seek(0, 2)
+            return records
+
+    def __len__(self):
+        return self.next_lsn - self.first_lsn
+
+    def truncate(self):
+        """
+        empty the log, once everything it holds has been checkpointed.
+        Sequence numbers carry on from where they were.
+        """
+        with self._lock:
+            self.fd.close()
+            self._reset(self.next_lsn)
+            self.first_lsn = self.next_lsn
+            self.synced_lsn = self.next_lsn
+            self._pending = 0
+            self._oldest_pending = None
+            self.fd = open(self.filename, 'r+b')
+            self.fd.seek(0, 2)
+
+    def close(self):
+        self._closed.set()
+        self._syncer.join()
+        with self._lock:
+            self.sync()
+            self.fd.close()
@@ -2,10 +2,16 @@
 """
 
 import numpy as np
+import heapq
+import json
+import os
+import pickle
 import uuid
 from graphviz import Digraph
 
 MAX_NODES = 10000
+MIN_LEAF_SIZE = 16 # leaves can grow to this size at least before a rebuild
+LEAF_GROWTH = 2 # or to this many times the largest leaf the tree was built with
 
 class VPNode():
     """Node of a vantage point tree
@@ -43,10 +49,173 @@ class VPTreeLeaf(VPNode):
         self.uid = uid
 
 class VPTree:
-    def __init__(self, pks, vp_pks, dist_func):
+    """Vantage point tree over primary keys
+
+    Attributes
+    ----------
+    size : int
+        number of primary keys in the tree
+    searches, distances, distances_saved : int
+        number of knn searches run, of distances they computed, and of
+        distances they did not need to compute thanks to the tree
+    last_search : dict
+        number of 'distances' computed and of 'leaves' visited by the last
+        knn search
+    pks : set
+        primary keys in the tree
+    deleted : set
+        primary keys deleted from the tree, which are still in its leaves
+    max_leaf_size : int
+        size a leaf can grow to by inserts before the tree needs a rebuild
+    stale : bool
+        whether a vantage point was deleted: the tree can not be searched or
+        inserted into until it is rebuilt
+    filename : str
+        file the tree was last saved to or loaded from, if any. Inserts and
+        deletes since are appended to filename + '.log'
+    """
+    def __init__(self, pks, vp_pks, dist_func, max_leaf_size=None):
         self.vps_pks = vp_pks
         self.dist_func = dist_func
+        self.pks = set(pks)
+        self.deleted = set()
+        self.stale = False
+        self.filename = None
+        self.searches = 0
+        self.distances = 0
+        self.distances_saved = 0
+        self.last_search = {'distances': 0, 'leaves': 0}
         self.root = self.makeVPTree(pks, vp_pks)
+        if max_leaf_size is None:
+            largest = max(len(leaf.pk_list) for leaf, _, _ in self.root.preorder()
+                          if isinstance(leaf, VPTreeLeaf))
+            max_leaf_size = max(MIN_LEAF_SIZE, LEAF_GROWTH * largest)
+        self.max_leaf_size = max_leaf_size
+        self._overfull = False
+
+    @property
+    def size(self):
+        "number of primary keys in the tree"
+        return len(self.pks)
+
+    @property
+    def needs_rebuild(self):
+        """
+        whether the tree should be rebuilt: a vantage point was deleted, a
+        leaf grew past max_leaf_size, or the tombstones outnumber the pks
+        """
+        return self.stale or self._overfull or len(self.deleted) > len(self.pks)
+
+    def insert(self, pk, path=None):
+        """Insert a primary key into the leaf it belongs to
+
+        The key goes down the tree as a build would have sent it, left of
+        a vantage point closer than median_dist and right otherwise, so the
+        bounds of knn hold. A key already in the tree is moved.
+
+        Parameters
+        ----------
+        pk : primary key
+            key to insert, whose distances to the vantage points dist_func
+            computes
+        path : str
+            if not None, the '0' (left) and '1' (right) turns to its leaf,
+            as returned by an earlier insert, instead of computing distances
+
+        Returns
+        -------
+        str
+            the turns taken to its leaf
+        """
+        if self.stale:
+            raise ValueError("vantage point tree is stale, a vantage point was deleted")
+        if pk in self.pks or pk in self.deleted:
+            self._purge(pk)
+        turns = []
+        node = self.root
+        while not isinstance(node, VPTreeLeaf):
+            if path is not None:
+                right = path[len(turns)] == '1'
+            else:
+                right = self.dist_func(node.pk, [pk])[0] >= node.median_dist
+            turns.append('1' if right else '0')
+            node = node.right_child if right else node.left_child
+        node.pk_list.append(pk)
+        self.pks.add(pk)
+        if len(node.pk_list) > self.max_leaf_size:
+            self._overfull = True
+        path = ''.join(turns)
+        self._log('+', pk, path)
+        return path
+
+    def delete(self, pk):
+        """Delete a primary key from the tree
+
+        The key is only tombstoned: searches skip it, and it stays in its
+        leaf until the tree is rebuilt. Deleting a vantage point makes the
+        tree stale.
+        """
+        if pk not in self.pks:
+            return
+        self.pks.discard(pk)
+        self.deleted.add(pk)
+        if pk in self.vps_pks:
+            self.stale = True
+        self._log('-', pk)
+
+    def _purge(self, pk):
+        "helper function to take a primary key out of its leaf, when it is inserted again"
+        for node, _, _ in self.root.preorder():
+            if isinstance(node, VPTreeLeaf) and pk in node.pk_list:
+                node.pk_list.remove(pk)
+        self.pks.discard(pk)
+        self.deleted.discard(pk)
+
+    def _log(self, change, pk, path=None):
+        "helper function to append an insert or a delete to the log of the file the tree is saved in"
+        if self.filename is not None:
+            with open(self.filename+'.log', 'a') as fd:
+                fd.write(json.dumps([change, pk, path])+'\n')
+
+    def save(self, filename):
+        """Pickle the tree to filename, without its dist_func
+
+        The inserts and deletes made afterwards are appended to
+        filename + '.log', which load() replays.
+        """
+        with open(filename+'.tmp', 'wb') as fd:
+            pickle.dump(self, fd)
+        os.replace(filename+'.tmp', filename)
+        if os.path.exists(filename+'.log'):
+            os.remove(filename+'.log')
+        self.filename = filename
+
+    @classmethod
+    def load(cls, filename, dist_func):
+        """Load a tree saved to filename, with the inserts and deletes logged
+        since, and give it dist_func
+        """
+        with open(filename, 'rb') as fd:
+            tree = pickle.load(fd)
+        tree.dist_func = dist_func
+        if os.path.exists(filename+'.log'):
+            with open(filename+'.log', 'r') as fd:
+                for line in fd:
+                    if not line.endswith('\n'):
+                        break # torn by a crash while it was written
+                    change, pk, path = json.loads(line)
+                    if change == '+':
+                        tree.insert(pk, path)
+                    else:
+                        tree.delete(pk)
+        tree.filename = filename
+        return tree
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['dist_func']
+        state['filename'] = None
+        return state
 
     def dot(self):
         """Create a graphviz dot file to visualize the tree
@@ -134,7 +303,89 @@ class VPTree:
             else:
                 curr = curr.right_child
 
-        return curr.pk_list
+        return [pk for pk in curr.pk_list if pk not in self.deleted]
+
+    def knn(self, arg, k, dist_arg, max_distances=None, max_leaves=None, epsilon=0.0):
+        """Get the k nearest primary keys to this argument, exactly by default
+
+        Nodes are visited best first, from a priority queue ordered by a
+        lower bound of the distance from their points to arg. Below a vantage
+        point at distance d from arg, the points of the left child (closer
+        than median_dist to it) are at least d - median_dist away from arg,
+        and those of the right child at least median_dist - d, by the
+        triangle inequality. The search stops when no node left can hold a
+        point closer than the k-th found so far, so dist_arg must be a metric.
+        Deleted keys are skipped.
+
+        The search can be made approximate, and faster, by a budget of
+        distances or leaves, after which it returns the nearest found so far,
+        or by epsilon: a node is also left out when its lower bound is within
+        a factor 1 + epsilon of the k-th distance, so the distances returned
+        are at most 1 + epsilon times the exact ones.
+
+        Parameters
+        ----------
+        arg : anything
+            query argument
+        k : int
+            number of primary keys to return
+        dist_arg : function
+            takes a primary key and the arg and returns the distance between them
+        max_distances : int
+            if not None, the most distances to compute
+        max_leaves : int
+            if not None, the most leaves to visit
+        epsilon : float
+            slack of the pruning, 0 for an exact search
+
+        Returns
+        -------
+        list
+            (primary key, distance) of the k nearest primary keys, nearest
+            first; fewer if the budget ran out first
+        """
+        dists = {} # vantage points are in the leaves too: compute each once
+        def dist(pk):
+            if pk not in dists:
+                dists[pk] = dist_arg(pk, arg)
+            return dists[pk]
+
+        def spent():
+            return max_distances is not None and len(dists) >= max_distances
+
+        best = [] # heap of (-distance, pk) of the k nearest so far
+        queue = [(0.0, 0, self.root)] # (lower bound, tie breaker, node)
+        n_queued = 1
+        leaves = 0
+        while queue and k > 0 and not spent():
+            bound, _, node = heapq.heappop(queue)
+            if len(best) == k and bound * (1 + epsilon) >= -best[0][0]:
+                break
+            if isinstance(node, VPTreeLeaf):
+                if max_leaves is not None and leaves >= max_leaves:
+                    break
+                leaves += 1
+                for pk in node.pk_list:
+                    if pk in self.deleted:
+                        continue
+                    if pk not in dists and spent():
+                        break
+                    d = dist(pk)
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, pk))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, pk))
+            else:
+                d = dist(node.pk)
+                heapq.heappush(queue, (max(bound, d - node.median_dist), n_queued, node.left_child))
+                heapq.heappush(queue, (max(bound, node.median_dist - d), n_queued + 1, node.right_child))
+                n_queued += 2
+
+        self.searches += 1
+        self.distances += len(dists)
+        self.distances_saved += self.size - len(dists)
+        self.last_search = {'distances': len(dists), 'leaves': leaves}
+        return [(pk, -d) for d, pk in sorted(best, reverse=True)]
 
 if __name__ == "__main__":
     np.random.seed(12345)
@@ -79,6 +79,52 @@ class Handlers:
         finally:
             return web.Response(body=json.dumps(payload).encode('utf-8'))
 
+    async def aggregate_handler(self,request):
+        """Handler for Aggregate
+
+        Parameters
+        ----------
+        request : aiotttp.request
+            request object with details of the request that was sent to the server
+
+            request.GET['query'] should exist or an error is returned **REQUIRED**
+
+            request.GET['query']['aggregates'] -> json encoded list of aggregates to compute,
+            such as ["count", "mean(std)", "histogram(mean)"]. Default is just the count
+
+            request.GET['query']['where'] -> json encoded metadata_dict describing the select criteria.
+            Default will aggregate all rows in the database
+
+            request.GET['query']['group_by'] -> field to compute the aggregates for every value of.
+            Default computes them over all the selected rows
+
+            request.GET['query']['bins'] -> number of buckets of histograms. Default is 10
+
+        Returns
+        -------
+        web.Response
+            JSON encoded values of the aggregates
+        """
+        try:
+            if 'query' not in request.GET:
+                raise ValueError("'query' must be sent with an aggregate",request.GET)
+
+            json_query = json.loads(request.GET['query'])
+
+            aggregates = json_query['aggregates'] if 'aggregates' in json_query else ['count']
+            metadata_dict = json_query['where'] if 'where' in json_query else {}
+            group_by = json_query['group_by'] if 'group_by' in json_query else None
+            bins = json_query['bins'] if 'bins' in json_query else 10
+            status,payload = await self.client.aggregate(metadata_dict,aggregates,group_by,bins)
+
+        except Exception as error:
+            payload = {"msg": "Could not parse request. Please see documentation."}
+            payload["type"] = str(type(error))
+            payload["args"] = str(error.args)
+
+        finally:
+            return web.Response(body=json.dumps(payload).encode('utf-8'))
+
     async def make_vp_tree_handler(self,request):
         """Handler for Make VP Tree
 
@@ -175,6 +221,16 @@ class Handlers:
             request.json()['vpkeys'] -> list of vantage point trees that correspond
             to [d_vp-1, d_vp-2, ...] in the correct order **REQUIRED**
 
+            request.json()['k'] -> number of closest matches to return, nearest first.
+            Default is 1
+
+            request.json()['max_distances'], request.json()['max_leaves'] -> budget of
+            distances to compute or leaves of the vantage point tree to visit. Default is none
+
+            request.json()['epsilon'] -> slack of the pruning of the tree. Default is 0. With
+            a budget or an epsilon the matches are under 'results', with the number of
+            'candidates' and 'leaves' looked at
+
         Returns
         -------
         web.Response
@@ -183,8 +239,12 @@ class Handlers:
         try:
             json_query = await request.json()
             arg = json_query['arg']
+            k = json_query['k'] if 'k' in json_query else 1
+            max_distances = json_query['max_distances'] if 'max_distances' in json_query else None
+            max_leaves = json_query['max_leaves'] if 'max_leaves' in json_query else None
+            epsilon = json_query['epsilon'] if 'epsilon' in json_query else 0.0
 
-            status,payload = await self.client.find_similar(arg)
+            status,payload = await self.client.find_similar(arg,k,max_distances,max_leaves,epsilon)
         except Exception as error:
             payload = {"msg": "Could not parse request. Please see documentation."}
             payload["type"] = str(type(error))
@@ -194,6 +254,42 @@ class Handlers:
             return web.Response(body=json.dumps(payload).encode('utf-8'))
 
 
+    async def find_within_handler(self,request):
+        """Handler for Find Within
+
+        Parameters
+        ----------
+        request : aiotttp.request
+            request object with details of the request that was sent to the server
+
+            request.json()['arg'] -> json encoded timeseries that is the reference to
+            which we're trying to find the close matches **REQUIRED**
+
+            request.json()['radius'] -> distance to find the matches within **REQUIRED**
+
+            request.json()['limit'] -> most matches to return, nearest first.
+            Default returns all of them
+
+        Returns
+        -------
+        web.Response
+            JSON encoded matches and their distances
+        """
+        try:
+            json_query = await request.json()
+            arg = json_query['arg']
+            radius = json_query['radius']
+            limit = json_query['limit'] if 'limit' in json_query else None
+
+            status,payload = await self.client.find_within(arg,radius,limit)
+        except Exception as error:
+            payload = {"msg": "Could not parse request. Please see documentation."}
+            payload["type"] = str(type(error))
+            payload["args"] = str(error.args)
+
+        finally:
+            return web.Response(body=json.dumps(payload).encode('utf-8'))
+
     async def add_ts_handler(self,request):
         """Handler for add time series
 
@@ -401,9 +497,11 @@ class WebServer:
         self.app = web.Application()
         self.app.router.add_route('GET', '/tsdb', self.handler.homepage_handler)
         self.app.router.add_route('GET', '/tsdb/select',self.handler.select_handler)
+        self.app.router.add_route('GET', '/tsdb/aggregate',self.handler.aggregate_handler)
         self.app.router.add_route('GET', '/tsdb/add/vptree',self.handler.make_vp_tree_handler)
         self.app.router.add_route('POST', '/tsdb/augselect',self.handler.augselect_handler)
         self.app.router.add_route('POST', '/tsdb/find_similar', self.handler.find_similar_handler)
+        self.app.router.add_route('POST', '/tsdb/find_within', self.handler.find_within_handler)
         self.app.router.add_route('POST', '/tsdb/add/ts', self.handler.add_ts_handler)
         self.app.router.add_route('POST', '/tsdb/add/trigger', self.handler.add_trigger_handler)
         self.app.router.add_route('POST', '/tsdb/delete/trigger', self.handler.remove_trigger_handler)
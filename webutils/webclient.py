@@ -18,8 +18,10 @@ class WebClient:
         self.endpoints = {
             'homepage' : ['GET', '/tsdb'],
             'select': ['GET', '/tsdb/select'],
+            'aggregate': ['GET', '/tsdb/aggregate'],
             'augselect' : ['POST', '/tsdb/augselect'],
             'find_similar' : ['POST', '/tsdb/find_similar'],
+            'find_within' : ['POST', '/tsdb/find_within'],
             'insert_ts' : ['POST', '/tsdb/add/ts'],
             'add_trigger' : ['POST', '/tsdb/add/trigger'],
             'remove_trigger' : ['POST', '/tsdb/delete/trigger'],
@@ -63,19 +65,33 @@ class WebClient:
         verb, endpoint = self.endpoints['delete_ts']
         return self._dispatch_request(verb, endpoint, json_query)
 
-    def find_similar(self, arg):
+    def find_similar(self, arg, k = 1, max_distances = None, max_leaves = None, epsilon = 0.0):
         if hasattr(arg,'to_json'):
             arg = arg.to_json()
-        json_query = json.dumps({'arg':arg})
+        json_query = json.dumps({'arg':arg, 'k':k, 'max_distances':max_distances,
+                                'max_leaves':max_leaves, 'epsilon':epsilon})
         verb, endpoint = self.endpoints['find_similar']
         return self._dispatch_request(verb, endpoint, json_query)
 
+    def find_within(self, arg, radius, limit = None):
+        if hasattr(arg,'to_json'):
+            arg = arg.to_json()
+        json_query = json.dumps({'arg':arg, 'radius':radius, 'limit':limit})
+        verb, endpoint = self.endpoints['find_within']
+        return self._dispatch_request(verb, endpoint, json_query)
+
     def select(self, where = {}, fields = None, additional = None):
         json_query = json.dumps({'where': where, 'fields': fields,
                                 'additional': additional})
         verb, endpoint = self.endpoints['select']
         return self._dispatch_request(verb, endpoint, json_query)
 
+    def aggregate(self, aggregates = ['count'], where = {}, group_by = None, bins = 10):
+        json_query = json.dumps({'aggregates': aggregates, 'where': where,
+                                'group_by': group_by, 'bins': bins})
+        verb, endpoint = self.endpoints['aggregate']
+        return self._dispatch_request(verb, endpoint, json_query)
+
     def make_vp_tree(self):
         json_query = json.dumps({})
         verb, endpoint = self.endpoints['make_vp_tree']